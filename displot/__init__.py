@@ -5,13 +5,21 @@ Author: Bohdan Starosta
 University of Strathclyde Physics Department
 """
 
+import json
+import inspect
 import logging
+import threading
 import displot.io
-import displot.detection
-import displot.tf
+import displot.profiling
+
+# displot.detection and displot.tf pull in Tensorflow, so they are imported
+# only where needed. Blob detection worker processes import this package.
 
 log = logging.getLogger('displot')
 
+_gpu_check = None
+_gpu_check_lock = threading.Lock()
+
 
 class Displot(object):
     """Program functionality class.
@@ -21,37 +29,282 @@ class Displot(object):
 
     Attributes:
         data_obj (io.DisplotData): Data object (main model).
+        detection_report (dict): Time and memory use of the last detection
+            run. See displot.profiling.StageProfiler.report().
 
     """
 
     def __init__(self):
         self.data_obj = None
-        displot.tf.detect_gpu_support()
+        self.detection_report = None
+        detect_gpu_support()
 
     def load_data(self, path):
         self.data_obj = displot.io.load_displot_data(path)
         log.info('Loaded file: "{0}".'.format(path))
 
-    def save_data(self, path):
-        displot.io.save_displot_data(path, self.data_obj)
+    def save_data(self, path, prediction=True, image=None, compress=False):
+        displot.io.save_displot_data(
+            path, self.data_obj, prediction, image, compress)
         log.info('Saved file: "{0}".'.format(path))
 
-    def save_features(self, path):
-        displot.io.save_features(path, self.data_obj)
+    def save_features(self, path, metadata=False):
+        meta = None
+        if metadata is True:
+            meta = displot.io.image_metadata(self.data_obj)
+        displot.io.save_features(path, self.data_obj, meta)
         log.info('Saved features: "{0}".'.format(path))
 
-    def detection(self, *args, **kwargs):
+    def detection(self, image, weights, roi=None, **kwargs):
+        """Run detection and replace the markers of the data object.
+
+        If keep_prediction is set, the prediction map is kept in the data
+        object. Maps made in 'mosaic' blob mode can be used to repeat
+        detection later using redetection(). See
+        displot.detection.detection() for the arguments.
+
+        Args:
+            roi (tuple): Region of interest in (x1, y1, x2, y2) format.
+                If set, only the tiles covering it and a margin around it
+                are processed, and only the markers within it replaced.
+
+        Returns:
+            dict: Time and memory use of each processing stage.
+
+        """
+        import displot.detection
+
         if self.data_obj is None:
             log.error('Data object is not loaded.')
 
-        tds = displot.detection.detection(*args, **kwargs)
-        log.info('Detection process completed. Features found: {0}.'.format(
-            len(tds[0])
-        ))
-        log.info('Average prediction confidence: {:.3f}.'.format(tds[1]))
-        self.data_obj.markers = tds[0]
+        profiler = kwargs.setdefault(
+            'profiler', displot.profiling.StageProfiler())
+        keep_prediction = kwargs.setdefault('keep_prediction', False)
+
+        if roi is not None:
+            window = displot.detection.roi_window(image.shape, roi)
+            log.info('Detection restricted to x: {0}-{2}, y: {1}-{3}.'
+                .format(*roi))
+            tds = displot.detection.detection(
+                _crop(image, window), weights, **kwargs)
+            self._replace_roi_markers(tds[0], roi, window)
+        else:
+            tds = displot.detection.detection(image, weights, **kwargs)
+            log.info('Detection process completed. Features found: {0}.'
+                .format(len(tds[0])))
+            log.info('Average prediction confidence: {:.3f}.'.format(tds[1]))
+            self.data_obj.markers = tds[0]
+
+        if keep_prediction is True and roi is None:
+            self.data_obj.prediction = tds[2]
+            self.data_obj.prediction_meta = self._prediction_meta(
+                weights, **kwargs)
+        elif keep_prediction is True and self.has_prediction(
+            weights, **kwargs
+        ):
+            # Only the region itself, the margin lacks context.
+            x1, y1, x2, y2 = roi
+            self.data_obj.prediction[y1:y2, x1:x2] = tds[2][
+                y1 - window[1]:y2 - window[1], x1 - window[0]:x2 - window[0]]
+        elif keep_prediction is False and roi is None:
+            self.data_obj.prediction = None
+            self.data_obj.prediction_meta = None
+
+        self.detection_report = profiler.report()
+        for line in profiler.summary():
+            log.info(line)
+        return self.detection_report
+
+    def detect_frames(self, weights, indices=None, **kwargs):
+        """Run detection on every frame of a multi-frame image.
+
+        Frames are processed one at a time. The markers of the data object
+        are replaced by the features of all processed frames, with a
+        'frame' column holding the frame index, and the stored prediction
+        map is dropped. See displot.detection.detect_frames() for the
+        arguments.
+
+        Returns:
+            dict: Features of each processed frame, keyed by frame index.
+
+        """
+        import displot.detection
+
+        if self.data_obj is None:
+            log.error('Data object is not loaded.')
+
+        profiler = kwargs.setdefault(
+            'profiler', displot.profiling.StageProfiler())
+        frames = self.data_obj.frames
+        if frames is None:
+            frames = [self.data_obj.image]
+
+        results = {}
+        for i, (tds, conf) in displot.detection.detect_frames(
+            frames, weights, indices, **kwargs
+        ):
+            log.info('Frame {0}: features found: {1}, average prediction '
+                'confidence: {2:.3f}.'.format(i + 1, len(tds), conf))
+            results[i] = tds
+
+        self.data_obj.markers = displot.io.FeatureTable.concatenate(
+            results.values())
+        self.data_obj.prediction = None
+        self.data_obj.prediction_meta = None
+        log.info('Detection process completed on {0} frames. Features '
+            'found: {1}.'.format(len(results), len(self.data_obj.markers)))
+
+        self.detection_report = profiler.report()
+        for line in profiler.summary():
+            log.info(line)
+        return results
+
+    def redetection(self, roi=None, **kwargs):
+        """Repeat detection using the stored prediction map.
+
+        Only blob detection and discrimination are run, and the markers of
+        the data object replaced. The map must have been made in 'mosaic'
+        blob mode, which redetection() repeats exactly. See
+        displot.detection.redetection() for the arguments.
+
+        Args:
+            roi (tuple): Region of interest in (x1, y1, x2, y2) format.
+                If set, only the markers within it are replaced.
+
+        Returns:
+            dict: Time and memory use of each processing stage.
+
+        """
+        import displot.detection
+
+        if self.data_obj is None:
+            log.error('Data object is not loaded.')
+        if self.data_obj.prediction is None:
+            raise ValueError('There is no stored prediction map.')
+        meta = self.data_obj.prediction_meta or {}
+        if meta.get('blob_mode') != 'mosaic':
+            raise ValueError('The stored prediction map was not made in '
+                '\'mosaic\' blob mode.')
+
+        profiler = kwargs.setdefault(
+            'profiler', displot.profiling.StageProfiler())
+
+        image = self.data_obj.image
+        prediction = self.data_obj.prediction
+        if roi is not None:
+            window = displot.detection.roi_window(image.shape, roi)
+            image = _crop(image, window)
+            prediction = _crop(prediction, window)
+
+        tds = displot.detection.redetection(image, prediction, **kwargs)
+        if roi is not None:
+            self._replace_roi_markers(tds[0], roi, window)
+        else:
+            log.info('Detection from stored prediction completed. '
+                'Features found: {0}.'.format(len(tds[0])))
+            log.info('Average prediction confidence: {:.3f}.'.format(tds[1]))
+            self.data_obj.markers = tds[0]
+
+        self.detection_report = profiler.report()
+        for line in profiler.summary():
+            log.info(line)
+        return self.detection_report
+
+    def scan(self, image, weights, roi=None, **kwargs):
+        """Run detection, reusing the stored prediction map if possible.
+
+        If has_prediction() finds the stored map was made with the same
+        prediction settings, redetection() is run on it and the neural
+        network is skipped. Otherwise detection() is run.
+
+        Args:
+            image (numpy.ndarray): Image to run detection on.
+            weights (tuple): Weights identifier.
+            roi (tuple): Region of interest in (x1, y1, x2, y2) format.
+            **kwargs: Arguments of detection(). Those redetection() does not
+                take are left out when it is used.
+
+        Returns:
+            dict: Time and memory use of each processing stage.
+
+        """
+        import displot.detection
+
+        if not self.has_prediction(weights, **kwargs):
+            return self.detection(image, weights, roi=roi, **kwargs)
+
+        log.info('Using the stored prediction map.')
+        params = inspect.signature(displot.detection.redetection).parameters
+        return self.redetection(roi=roi, **{
+            k: v for k, v in kwargs.items() if k in params})
+
+    def has_prediction(self, weights, **kwargs):
+        """Check if the stored prediction map was made with given settings.
+
+        Args:
+            weights (tuple): Weights identifier.
+            **kwargs: model, stride, tiling, backend and blob_mode, as
+                passed to detection(). Defaults are assumed for missing ones.
+
+        Returns:
+            bool: True if redetection() would find the same features as
+                detection() with these settings. Only maps made in
+                'mosaic' blob mode qualify, as blob detection in 'tile'
+                mode cannot be repeated from the fused map.
+
+        """
+        if self.data_obj is None or self.data_obj.prediction is None:
+            return False
+        meta = self._prediction_meta(weights, **kwargs)
+        return (meta['blob_mode'] == 'mosaic'
+            and self.data_obj.prediction_meta == meta)
+
+    def _replace_roi_markers(self, tds, roi, window):
+        """Replace the markers within a region of interest.
+
+        Args:
+            tds (io.FeatureTable): Features found on the window around the
+                region.
+            roi (tuple): Region of interest in (x1, y1, x2, y2) format.
+            window (tuple): Window the features were found on.
+
+        Returns:
+            None
+
+        """
+        import displot.detection
+
+        tds = displot.detection.roi_features(tds, roi, window)
+        markers = self.data_obj.markers
+        kept = markers[~displot.detection.in_roi(markers, roi)]
+        log.info('Detection process completed. Features replaced within the '
+            'region: {0} -> {1}.'.format(len(markers) - len(kept), len(tds)))
+        if len(tds) > 0:
+            log.info('Average prediction confidence: {:.3f}.'.format(
+                tds.confidence.mean()))
+        self.data_obj.markers = displot.io.FeatureTable.concatenate(
+            [kept, tds])
+
+    def _prediction_meta(self, weights, model='fusionnet', stride=(256, 256),
+        tiling='reflect', backend='keras', blob_mode='tile', **kwargs
+    ):
+        return {
+            'weights': list(weights),
+            'model': model,
+            'stride': list(stride),
+            'tiling': tiling,
+            'backend': backend,
+            'blob_mode': blob_mode
+        }
+
+    def save_report(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.detection_report, f, indent=2)
+        log.info('Saved detection report: "{0}".'.format(path))
 
     def discrimination(self, *args, **kwargs):
+        import displot.detection
+
         if self.data_obj is None:
             log.error('Data object is not loaded.')
 
@@ -60,13 +313,41 @@ class Displot(object):
             return
 
         tds = displot.detection.discrimination(*args, **kwargs)
-        for i, td in enumerate(self.data_obj.markers):
-            if td in tds[0]:
-                self.data_obj.markers[i].isHidden = False
-            else:
-                self.data_obj.markers[i].isHidden = True
+        markers = self.data_obj.markers
+        visible = set(zip(
+            tds[0].x.tolist(), tds[0].y.tolist(), tds[0].r.tolist()))
+        markers.isHidden = [k not in visible for k in zip(
+            markers.x.tolist(), markers.y.tolist(), markers.r.tolist())]
 
         log.info('Discrimination completed. Visible features: {0}.'.format(
             len(tds[0])
         ))
         log.info('Avg. visible prediction confidence: {:.3f}.'.format(tds[1]))
+
+
+def detect_gpu_support():
+    """Log the state of GPU support once, from a background thread.
+
+    The check imports Tensorflow, which takes seconds, so it is done in the
+    background the first time this is called, and never again afterwards.
+
+    Returns:
+        threading.Thread: Thread running the check.
+
+    """
+    global _gpu_check
+    with _gpu_check_lock:
+        if _gpu_check is None:
+            _gpu_check = threading.Thread(target=_detect_gpu_support,
+                name='displot-gpu-check', daemon=True)
+            _gpu_check.start()
+    return _gpu_check
+
+
+def _detect_gpu_support():
+    import displot.tf
+    displot.tf.detect_gpu_support()
+
+
+def _crop(image, window):
+    return image[window[1]:window[3], window[0]:window[2]]
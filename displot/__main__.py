@@ -6,6 +6,11 @@ Example:
 
         $ python -m displot.py
 
+    Run detection on a batch of images without starting the GUI. See
+    displot.cli for the available options.
+
+        $ python -m displot detect path/to/images
+
 """
 
 import os
@@ -16,8 +21,6 @@ import json
 import webbrowser
 import urllib.request
 
-from displot.ui import DisplotUi, GenericDialog, ConsoleHandler
-
 
 def check_releases():
     """Perform a version check on the repository.
@@ -25,6 +28,7 @@ def check_releases():
     If the repository has a new version on the master branch, a dialog window
     will be displayed reminding the user to update.
     """
+    from displot.ui import GenericDialog
 
     ch = 'https://raw.githubusercontent.com/bjstarosta/'\
         'displot/master/displot/meta.json'
@@ -66,6 +70,8 @@ def check_releases():
 
 
 def setup_logger(console, level=logging.INFO):
+    from displot.ui import ConsoleHandler
+
     logger = logging.getLogger('displot')
     logger.setLevel(level)
 
@@ -84,6 +90,14 @@ def setup_logger(console, level=logging.INFO):
 
 def main():
 
+    # The GUI and its dependencies are only imported when no subcommand is
+    # given, so headless runs work without a display or Qt.
+    if len(sys.argv) > 1 and sys.argv[1] in ('detect', 'convert'):
+        import displot.cli
+        sys.exit(displot.cli.main(sys.argv[1:]))
+
+    from displot.ui import DisplotUi
+
     if len(sys.argv) > 1 and '--debug' in sys.argv:
         level = logging.DEBUG
     else:
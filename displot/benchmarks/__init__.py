@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""displot - Performance benchmarks.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""displot - Blob confidence scoring benchmark.
+
+Compares the vectorised blob confidence scorer against the per-pixel loop it
+replaced, on synthetic prediction tiles with thousands of blobs.
+
+Example:
+    $ python -m displot.benchmarks.blob_scoring
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import timeit
+
+import numpy as np
+
+from displot.blobs import blob_confidence
+
+
+def blob_confidence_loop(im, blobs):
+    """Reference implementation scoring blobs one pixel at a time.
+
+    Pixel values are accumulated as Python numbers, which matches the
+    arithmetic of the original loop under NumPy 1.x scalar promotion rules.
+
+    Args:
+        im (numpy.ndarray): Image slice the blobs were detected on.
+        blobs (numpy.ndarray): Array of blobs in (y, x, radius) format.
+
+    Returns:
+        numpy.ndarray: Confidence value for each blob.
+
+    """
+    conf = []
+    for c_y, c_x, r in blobs:
+        c_y = int(c_y)
+        c_x = int(c_x)
+        r_i = int(r)
+        sq = im[c_y - r_i:c_y + r_i, c_x - r_i:c_x + r_i]
+
+        pred_n = 0
+        pred = 0
+        for sq_r, sq_r_ in enumerate(sq):
+            for sq_c, sq_c_ in enumerate(sq_r_):
+                if (sq_r - r_i)**2 + (sq_c - r_i)**2 > r_i**2:
+                    continue
+                pred += sq[sq_r, sq_c].item()
+                pred_n += 1
+
+        if pred_n > 0:
+            pred = (pred / pred_n) / 255
+        else:
+            pred = 0
+        conf.append(pred)
+
+    return np.array(conf, dtype=float)
+
+
+def synthetic_tile(n_blobs, hw=(512, 512), min_r=5, max_r=14, seed=0):
+    """Generate a random prediction tile and a set of blobs on it.
+
+    Args:
+        n_blobs (int): Number of blobs.
+        hw (tuple): Tile size in (height, width) format.
+        min_r (int): Minimum blob radius.
+        max_r (int): Maximum blob radius.
+        seed (int): Random number generator seed.
+
+    Returns:
+        tuple: (numpy.ndarray: uint8 tile, numpy.ndarray: blobs)
+
+    """
+    rng = np.random.RandomState(seed)
+    im = rng.randint(0, 256, size=hw).astype('uint8')
+    blobs = np.column_stack((
+        rng.randint(0, hw[0], n_blobs).astype(float),
+        rng.randint(0, hw[1], n_blobs).astype(float),
+        rng.uniform(min_r, max_r, n_blobs)
+    ))
+    return im, blobs
+
+
+def run(n_blobs=(1000, 5000), repeat=3):
+    """Time both scorers and check that their results are identical.
+
+    Args:
+        n_blobs (tuple): Blob counts to benchmark.
+        repeat (int): Number of timing repetitions. The best one is kept.
+
+    Returns:
+        list: List of dicts, one per blob count.
+
+    """
+    results = []
+    for n in n_blobs:
+        im, blobs = synthetic_tile(n)
+
+        t_loop = min(timeit.repeat(
+            lambda: blob_confidence_loop(im, blobs), number=1, repeat=repeat))
+        t_vec = min(timeit.repeat(
+            lambda: blob_confidence(im, blobs), number=1, repeat=repeat))
+
+        results.append({
+            'n_blobs': n,
+            'loop_s': t_loop,
+            'vectorised_s': t_vec,
+            'speedup': t_loop / t_vec,
+            'identical': bool(np.array_equal(
+                blob_confidence_loop(im, blobs), blob_confidence(im, blobs)))
+        })
+
+    return results
+
+
+def main():
+    fmt = '{n_blobs:>8} {loop_s:>10.4f} {vectorised_s:>12.4f} '\
+        '{speedup:>8.1f}x {identical!s:>10}'
+    print('{:>8} {:>10} {:>12} {:>9} {:>10}'.format(
+        'blobs', 'loop (s)', 'vector (s)', 'speedup', 'identical'))
+    for r in run():
+        print(fmt.format(**r))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+"""displot - Detection pipeline stage benchmark.
+
+Times the tiling, prediction, blob detection and discrimination stages of
+displot.detection separately, across image sizes and sliding window strides,
+on synthetic ECCI images. Prediction uses a small randomly initialised
+FusionNet, so no weights file is needed.
+
+Prediction and blob detection are too slow to run on every tile of the
+largest images, so they are timed on an evenly spread sample of tiles and
+the time for the whole image is extrapolated from it.
+
+Example:
+    $ python -m displot.benchmarks.detection -o before.json
+    $ python -m displot.benchmarks.detection --sizes 1024 2048 -o after.json
+    $ python -m displot.benchmarks.detection --stages blob_detect \
+        --blob-backends log dog fft_log peaks
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import datetime
+import multiprocessing as mp
+
+import numpy as np
+import skimage
+import tensorflow as tf
+
+import displot.tf
+import displot.blobs
+import displot.detection
+import displot.workers
+from displot.models import fusionnet
+
+SIZES = (1024, 2048, 4096, 8192, 16384)
+STRIDES = (128, 256, 512)
+STAGES = ('tiling', 'predict', 'blob_detect', 'discrimination')
+
+# Identifiers the random model is registered under in the model registry.
+BENCH_WEIGHTS = ('benchmark', 'random')
+
+_HW = (512, 512)
+
+
+def synthetic_image(shape, density=1e-4, min_r=5, max_r=10, seed=0):
+    """Generate a synthetic ECCI image and its ideal prediction map.
+
+    Threading dislocations show up in ECCI micrographs as small spots of
+    black-white contrast on a noisy grey background. They are drawn as
+    Gaussian dipoles, and the prediction map has a Gaussian blob under each.
+
+    Args:
+        shape (tuple): Image shape in (height, width) format.
+        density (float): Number of dislocations per pixel.
+        min_r (int): Minimum dislocation radius.
+        max_r (int): Maximum dislocation radius.
+        seed (int): Random number generator seed.
+
+    Returns:
+        tuple: (numpy.ndarray: uint8 image, numpy.ndarray: uint8 prediction
+            map, numpy.ndarray: dislocations in (x, y, radius) format)
+
+    """
+    rng = np.random.RandomState(seed)
+    h, w = shape
+
+    # Built in row chunks so that the float noise of the largest images
+    # never exists in full.
+    image = np.empty(shape, dtype=np.uint8)
+    for i in range(0, h, 1024):
+        noise = rng.normal(128, 12, (min(1024, h - i), w)).astype('float32')
+        image[i:i + 1024] = np.clip(noise, 0, 255)
+    pred = np.zeros(shape, dtype=np.uint8)
+
+    n = int(h * w * density)
+    tds = np.column_stack((
+        rng.randint(0, w, n),
+        rng.randint(0, h, n),
+        rng.randint(min_r, max_r + 1, n)
+    ))
+
+    kernels = {}
+    for x, y, r in tds:
+        if r not in kernels:
+            kernels[r] = _kernels(r)
+        dipole, blob = kernels[r]
+
+        sl_dst, sl_src = _clip(shape, dipole.shape, x, y)
+        stamped = image[sl_dst].astype(np.int16) + dipole[sl_src]
+        image[sl_dst] = np.clip(stamped, 0, 255)
+        pred[sl_dst] = np.maximum(pred[sl_dst], blob[sl_src])
+
+    return image, pred, tds
+
+
+def candidates(tds, samples=4, false_rate=.1, seed=0):
+    """Generate the candidate features blob detection would hand over.
+
+    Every dislocation is found once per overlapping sliding window, with a
+    pixel of jitter, and a fraction of low confidence false positives is
+    mixed in.
+
+    Args:
+        tds (numpy.ndarray): Dislocations in (x, y, radius) format.
+        samples (int): Number of times every dislocation is found.
+        false_rate (float): Number of false positives per dislocation.
+        seed (int): Random number generator seed.
+
+    Returns:
+        io.FeatureTable: Candidate features.
+
+    """
+    rng = np.random.RandomState(seed)
+
+    x = np.repeat(tds[:, 0], samples) + rng.randint(-1, 2, len(tds) * samples)
+    y = np.repeat(tds[:, 1], samples) + rng.randint(-1, 2, len(tds) * samples)
+    r = np.repeat(tds[:, 2], samples).astype(float)
+    conf = rng.uniform(.3, .9, len(x))
+
+    n_false = int(len(tds) * false_rate)
+    x = np.concatenate((x, rng.randint(0, tds[:, 0].max() + 1, n_false)))
+    y = np.concatenate((y, rng.randint(0, tds[:, 1].max() + 1, n_false)))
+    r = np.concatenate((r, rng.uniform(5, 14, n_false)))
+    conf = np.concatenate((conf, rng.uniform(0, .3, n_false)))
+
+    order = rng.permutation(len(x))
+    return displot.detection._features(
+        np.column_stack((x, y, r, conf))[order])
+
+
+def random_model(n_filters=8, seed=0):
+    """Build a randomly initialised FusionNet and register it for predict().
+
+    Args:
+        n_filters (int): Number of filters in the first encoder level.
+        seed (int): Random number generator seed.
+
+    Returns:
+        None
+
+    """
+    tf.random.set_seed(seed)
+    model_nn = fusionnet.build(n_filters=n_filters)
+    displot.tf.registry.put(model_nn, *BENCH_WEIGHTS)
+
+
+def run(
+    sizes=SIZES, strides=STRIDES, stages=STAGES,
+    max_tiles=16, n_filters=8, batch_size=4, repeat=1, pool=None,
+    blob_backends=('log',)
+):
+    """Time each detection stage for every image size and stride.
+
+    Args:
+        sizes (tuple): Square image sizes in pixels.
+        strides (tuple): Sliding window strides in pixels, used for both
+            rows and columns.
+        stages (tuple): Stages to time. See STAGES.
+        max_tiles (int): Maximum number of tiles timed by the prediction
+            and blob detection stages.
+        n_filters (int): Number of filters in the first encoder level of
+            the random model.
+        batch_size (int): Prediction batch size.
+        repeat (int): Number of timing repetitions. The best one is kept.
+        pool (displot.workers.BlobWorkerPool): Worker pool to run blob
+            detection in. If not set, the process-wide pool is used.
+        blob_backends (tuple): Blob detection backends to time.
+            See displot.blobs.BACKENDS.
+
+    Returns:
+        list: List of dicts, one per size, stride and stage, and per blob
+            detection backend for the blob detection stage.
+
+    """
+    if pool is None:
+        pool = displot.workers.get_pool()
+    if 'blob_detect' in stages:
+        pool.warm()
+    if 'predict' in stages:
+        random_model(n_filters)
+
+    results = []
+    for size in sizes:
+        image, pred, tds = synthetic_image((size, size))
+
+        for s in strides:
+            stride = (s, s)
+            padding = displot.detection._padding(image.shape, stride, _HW)
+            n_tiles = _n_tiles(image.shape, stride, padding)
+            common = {'size': size, 'stride': s, 'n_tiles': n_tiles}
+
+            for stage in stages:
+                if stage == 'tiling':
+                    runs = [_best(repeat, _time_tiling, image, stride,
+                        padding)]
+                elif stage == 'predict':
+                    X = _sample(image, stride, padding, n_tiles, max_tiles)
+                    runs = [_best(repeat, _time_predict, X, batch_size)]
+                elif stage == 'blob_detect':
+                    Y, offsets = _sample(
+                        pred, stride, padding, n_tiles, max_tiles, True)
+                    runs = [
+                        _best(repeat, _time_blob_detect, Y, offsets, pool, b)
+                        for b in blob_backends
+                    ]
+                elif stage == 'discrimination':
+                    runs = [_best(repeat, _time_discrimination, image, tds)]
+                else:
+                    raise ValueError('Unknown stage: {0}'.format(stage))
+
+                for r in runs:
+                    r.update(common, stage=stage)
+                    if 'n_measured' in r:
+                        r['est_total_s'] = (
+                            r['wall_s'] * n_tiles / r['n_measured'])
+                    results.append(r)
+                    print(_format(r), file=sys.stderr)
+
+        del image, pred, tds
+
+    return results
+
+
+def metadata(**params):
+    """Describe the machine and software the benchmark was run with.
+
+    Args:
+        **params: Benchmark parameters to record.
+
+    Returns:
+        dict: Metadata.
+
+    """
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': mp.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'skimage': skimage.__version__,
+        'tensorflow': tf.__version__,
+        'params': params
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m displot.benchmarks.detection',
+        description='Time the detection pipeline stages separately.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--strides', type=int, nargs='+', default=STRIDES)
+    parser.add_argument('--stages', nargs='+', choices=STAGES,
+        default=STAGES)
+    parser.add_argument('--max-tiles', type=int, default=16)
+    parser.add_argument('--filters', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--blob-backends', nargs='+',
+        choices=sorted(displot.blobs.BACKENDS), default=['log'])
+    parser.add_argument('-o', '--output', default=None,
+        help='JSON file to write results to. '
+        '(default: benchmark-<date>.json)')
+    args = parser.parse_args(argv)
+
+    params = dict(
+        sizes=args.sizes, strides=args.strides, stages=args.stages,
+        max_tiles=args.max_tiles, n_filters=args.filters,
+        batch_size=args.batch_size, repeat=args.repeat,
+        blob_backends=args.blob_backends
+    )
+    meta = metadata(**params)
+    results = run(**params)
+
+    path = args.output
+    if path is None:
+        path = 'benchmark-{0}.json'.format(
+            datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+    print('Results written to "{0}".'.format(os.path.abspath(path)),
+        file=sys.stderr)
+
+
+def _time_tiling(image, stride, padding):
+    n = 0
+    t, c = time.perf_counter(), time.process_time()
+    for _ in displot.detection._tiles(image, stride, _HW, padding):
+        n += 1
+    return _elapsed(t, c)
+
+
+def _time_predict(X, batch_size):
+    # The first call builds the inference graph and is not timed.
+    displot.tf.predict(X[:1], 'fusionnet', BENCH_WEIGHTS, batch_size=1)
+
+    t, c = time.perf_counter(), time.process_time()
+    displot.tf.predict(X, 'fusionnet', BENCH_WEIGHTS, batch_size=batch_size)
+    r = _elapsed(t, c)
+    r['n_measured'] = len(X)
+    return r
+
+
+def _time_blob_detect(Y, offsets, pool, backend):
+    t, c = time.perf_counter(), time.process_time()
+    found = pool.blob_detect(Y, offsets, min_sigma=3, max_sigma=15,
+        num_sigma=15, threshold=.1, min_r=5, max_r=14, backend=backend)
+    r = _elapsed(t, c)
+    r['blob_backend'] = backend
+    r['n_measured'] = len(Y)
+    r['n_candidates'] = int(sum(len(b) for b in found))
+    return r
+
+
+def _time_discrimination(image, tds):
+    features = candidates(tds)
+    t, c = time.perf_counter(), time.process_time()
+    found, _ = displot.detection.discrimination(
+        image, features, detect_samples=4)
+    r = _elapsed(t, c)
+    r['n_candidates'] = len(features)
+    r['n_found'] = len(found)
+    return r
+
+
+def _elapsed(t, c):
+    # CPU time is that of this process only, so it excludes blob detection
+    # worker processes.
+    return {
+        'wall_s': time.perf_counter() - t,
+        'cpu_s': time.process_time() - c
+    }
+
+
+def _best(repeat, fn, *args):
+    return min((fn(*args) for _ in range(repeat)), key=lambda r: r['wall_s'])
+
+
+def _sample(image, stride, padding, n_tiles, k, offsets=False):
+    """Cut an evenly spread sample of sliding window tiles from an image.
+
+    Args:
+        image (numpy.ndarray): Unpadded image.
+        stride (tuple): Sliding window stride in (row, column) format.
+        padding (tuple): Padding in (left, top, right, bottom) format.
+        n_tiles (int): Total number of tiles.
+        k (int): Number of tiles in the sample.
+        offsets (bool): If True, tile offsets relative to the image are
+            returned as well.
+
+    Returns:
+        numpy.ndarray: Stack of tiles, or a tuple of it and a list of
+            (x_offset, y_offset) tuples if offsets is True.
+
+    """
+    keep = set(np.linspace(0, n_tiles - 1, min(k, n_tiles)).astype(int))
+    tiles = []
+    offs = []
+    tiling = displot.detection._tiles(image, stride, _HW, padding)
+    for i, (row, col, tile) in enumerate(tiling):
+        if i in keep:
+            tiles.append(tile)
+            offs.append((col * stride[1] - padding[0],
+                row * stride[0] - padding[1]))
+
+    if offsets is True:
+        return np.array(tiles), offs
+    return np.array(tiles)
+
+
+def _n_tiles(shape, stride, padding):
+    h_padded = padding[1] + shape[0] + padding[3]
+    w_padded = padding[0] + shape[1] + padding[2]
+    return (int(h_padded / stride[0]) - 1) * (int(w_padded / stride[1]) - 1)
+
+
+def _kernels(r):
+    """Return the image dipole and prediction blob kernels for a radius."""
+    yy, xx = np.mgrid[-2 * r:2 * r + 1, -2 * r:2 * r + 1]
+    g = np.exp(-(xx**2 + yy**2) / (2 * (r / 2)**2))
+    dipole = (60 * g * xx / r).astype(np.int16)
+    blob = (255 * g).astype(np.uint8)
+    return dipole, blob
+
+
+def _clip(shape, k_shape, x, y):
+    """Return slices pasting a centred kernel onto an image, within bounds."""
+    ky, kx = k_shape[0] // 2, k_shape[1] // 2
+    y1, x1 = max(y - ky, 0), max(x - kx, 0)
+    y2 = min(y + k_shape[0] - ky, shape[0])
+    x2 = min(x + k_shape[1] - kx, shape[1])
+    dst = (slice(y1, y2), slice(x1, x2))
+    src = (slice(y1 - y + ky, y2 - y + ky), slice(x1 - x + kx, x2 - x + kx))
+    return dst, src
+
+
+def _format(r):
+    stage = r['stage']
+    if 'blob_backend' in r:
+        stage += ':' + r['blob_backend']
+    s = '{size:>6} {stride:>4} {0:<19} {n_tiles:>6} tiles'\
+        ' {wall_s:>9.3f}s'.format(stage, **r)
+    if 'est_total_s' in r:
+        s += ' ({0} measured, est. {1:.1f}s total)'.format(
+            r['n_measured'], r['est_total_s'])
+    return s
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""displot - Startup time benchmark.
+
+Measures how long a fresh Python process takes to import what each entry
+point of displot needs before it can do any work, and whether Tensorflow or
+scikit-image were loaded on the way. Every measurement runs in a new
+interpreter, so nothing is cached in memory between runs, although the
+operating system may still cache the files read.
+
+Targets:
+    io: `import displot.io`, as needed to open and save data files.
+    gui: The modules `python -m displot` imports before opening the window.
+    cli: The modules `python -m displot detect` imports before processing
+        the first image.
+
+Example:
+    $ python -m displot.benchmarks.startup
+    $ python -m displot.benchmarks.startup --targets io --repeat 10
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import collections
+
+# Statements timed for each target.
+TARGETS = collections.OrderedDict((
+    ('io', 'import displot.io'),
+    ('gui', 'import displot.__main__; import displot.ui'),
+    ('cli', 'import displot.cli'),
+))
+
+# Modules that are expensive to import, and only needed for detection.
+HEAVY_MODULES = ('tensorflow', 'skimage')
+
+_CHILD = '''
+import sys, time, json
+t = time.perf_counter()
+{0}
+t = time.perf_counter() - t
+print(json.dumps({{
+    'import_s': t,
+    'loaded': [m for m in {1!r} if m in sys.modules]
+}}))
+'''
+
+
+def measure(target, python=None):
+    """Time a target in a new Python process.
+
+    Args:
+        target (str): Target name. See TARGETS.
+        python (str): Python interpreter to run. If not set, the one
+            running this function is used.
+
+    Returns:
+        dict: Time spent importing ('import_s'), lifetime of the whole
+            process ('process_s'), and the heavy modules that were loaded
+            ('loaded'). If the import failed, 'error' holds its message.
+
+    """
+    code = _CHILD.format(TARGETS[target], HEAVY_MODULES)
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (root, env.get('PYTHONPATH')) if p)
+
+    t = time.perf_counter()
+    proc = subprocess.run([python or sys.executable, '-c', code], env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    process_s = time.perf_counter() - t
+
+    if proc.returncode != 0:
+        lines = proc.stderr.strip().splitlines()
+        return {'error': lines[-1] if lines else 'exit code {0}'.format(
+            proc.returncode)}
+    r = json.loads(proc.stdout.strip().splitlines()[-1])
+    r['process_s'] = process_s
+    return r
+
+
+def run(targets=tuple(TARGETS), repeat=5, python=None):
+    """Measure every target several times.
+
+    Args:
+        targets (tuple): Target names. See TARGETS.
+        repeat (int): Number of processes started per target. The median
+            time is reported.
+        python (str): Python interpreter to run. See measure().
+
+    Returns:
+        list: List of dicts, one per target.
+
+    """
+    results = []
+    for target in targets:
+        runs = [measure(target, python) for _ in range(repeat)]
+        failed = [r for r in runs if 'error' in r]
+        if len(failed) > 0:
+            results.append({'target': target, 'error': failed[0]['error']})
+            continue
+
+        runs.sort(key=lambda r: r['import_s'])
+        r = runs[len(runs) // 2]
+        r.update(target=target, statement=TARGETS[target],
+            best_import_s=runs[0]['import_s'], repeat=repeat)
+        results.append(r)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m displot.benchmarks.startup',
+        description='Time the imports done by the displot entry points.')
+    parser.add_argument('--targets', nargs='+', choices=list(TARGETS),
+        default=list(TARGETS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--python', default=None,
+        help='Python interpreter to measure. (default: this one)')
+    parser.add_argument('-o', '--output', default=None,
+        help='JSON file to write results to.')
+    args = parser.parse_args(argv)
+
+    results = run(args.targets, args.repeat, args.python)
+    for r in results:
+        print(_format(r))
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print('Results written to "{0}".'.format(
+            os.path.abspath(args.output)), file=sys.stderr)
+
+
+def _format(r):
+    if 'error' in r:
+        return '{target:<4} failed: {error}'.format(**r)
+    return '{target:<4} {import_s:>7.3f}s import (best {best_import_s:.3f}s)'\
+        ' {process_s:>7.3f}s process  loaded: {0}'.format(
+            ', '.join(r['loaded']) or '-', **r)
+
+
+if __name__ == '__main__':
+    main()
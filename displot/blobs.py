@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""displot - Blob detection on neural network predictions.
+
+Only depends on NumPy, SciPy and scikit-image, so that it can be imported
+cheaply by blob detection worker processes.
+
+Several blob detection backends are available, see BACKENDS:
+
+    log: Laplacian of Gaussian scale space using skimage.feature.blob_log.
+        The most accurate and the slowest, as every scale is a separate pair
+        of convolutions.
+    dog: Difference of Gaussian scale space using skimage.feature.blob_dog.
+        Approximates 'log' with fewer, cheaper scales.
+    fft_log: Laplacian of Gaussian scale space computed for all scales at
+        once in the frequency domain. Finds nearly the same blobs as 'log'.
+    peaks: Local maxima of the prediction map above the threshold, with the
+        radius estimated from the area of the connected region around them.
+        No scale space is built. Suited to clean, well separated blobs.
+
+The threshold applies to the scale space response for the scale space
+backends, and to the prediction value scaled to (0, 1) for 'peaks'.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import math
+
+import numpy as np
+import scipy.fft
+import scipy.ndimage as ndi
+import scipy.spatial
+import skimage.feature
+import skimage.util
+
+
+def blob_detect(
+    im, x_offset, y_offset,
+    min_sigma, max_sigma, num_sigma, threshold,
+    min_r, max_r, backend='log'
+):
+    """Perform blob detection on an image data slice.
+
+    See: https://scikit-image.org/docs/dev/api/skimage.feature.html
+
+    Args:
+        im (numpy.ndarray): Image slice to detect blobs on.
+            Should be single channel greyscale for performance.
+        x_offset (int): X coordinate of the image slice on the full image
+            relative to its top left corner.
+        y_offset (int): X coordinate of the image slice on the full image
+            relative to its top left corner.
+        min_sigma (int): Blob detection parameter.
+            Minimum standard deviation for Gaussian kernel.
+        max_sigma (int): Blob detection parameter.
+            Maximum standard deviation for Gaussian kernel.
+        num_sigma (int): Blob detection parameter.
+            Number of intermediate values of standard deviations to consider
+            between min_sigma and max_sigma.
+        threshold (float): Blob detection parameter.
+            The absolute lower bound for scale space maxima. Local maxima
+            smaller than thresh are ignored. Reduce this to detect blobs
+            with less intensities.
+        min_r (int): Minimum blob radius.
+        max_r (int): Maximum blob radius.
+        backend (str): Blob detection backend. See BACKENDS.
+
+    Returns:
+        numpy.ndarray: Array of detected blobs, with each row in
+            (x, y, radius, confidence) format. Coordinates are relative to
+            the full image.
+
+    """
+    if backend not in BACKENDS:
+        raise ValueError('Unknown blob detection backend: {0}'.format(
+            backend))
+
+    blobs_log = BACKENDS[backend](
+        im, min_sigma, max_sigma, num_sigma, threshold)
+
+    # Compute blob radius and clip its values.
+    blobs_log[:, 2] = np.clip(blobs_log[:, 2] * np.sqrt(2), min_r, max_r)
+
+    # Average of pixel values within each blob radius is set as the
+    # prediction confidence of that marker. This is because the
+    # autoencoder delivers fainter blobs the more "unsure" it is.
+    conf = blob_confidence(im, blobs_log)
+
+    return np.column_stack((
+        blobs_log[:, 1].astype(int) + x_offset,
+        blobs_log[:, 0].astype(int) + y_offset,
+        blobs_log[:, 2],
+        conf
+    ))
+
+
+def blob_log(im, min_sigma, max_sigma, num_sigma, threshold):
+    """Find blobs using skimage.feature.blob_log.
+
+    Args:
+        im (numpy.ndarray): Image slice to detect blobs on.
+
+    See blob_detect() for the description of the remaining arguments.
+
+    Returns:
+        numpy.ndarray: Array of blobs, with each row in (y, x, sigma) format.
+
+    """
+    # This line is very slow.
+    return skimage.feature.blob_log(
+        im,
+        min_sigma=min_sigma,
+        max_sigma=max_sigma,
+        num_sigma=num_sigma,
+        threshold=threshold
+    )
+
+
+def blob_dog(im, min_sigma, max_sigma, num_sigma, threshold):
+    """Find blobs using skimage.feature.blob_dog.
+
+    num_sigma is ignored, the scales are spaced by a ratio of 1.6.
+    See blob_log() for the arguments and return value.
+
+    """
+    return skimage.feature.blob_dog(
+        im,
+        min_sigma=min_sigma,
+        max_sigma=max_sigma,
+        threshold=threshold
+    )
+
+
+def blob_fft_log(im, min_sigma, max_sigma, num_sigma, threshold):
+    """Find blobs in a Laplacian of Gaussian scale space built using FFT.
+
+    The image is transformed once, and all scales are obtained with a single
+    batched inverse transform, instead of a pair of convolutions per scale.
+    The image is mirrored at its borders first, like in blob_log(), and
+    the transforms are computed in single precision.
+    See blob_log() for the arguments and return value.
+
+    """
+    im = skimage.util.img_as_float32(im)
+    sigmas = np.linspace(min_sigma, max_sigma, num_sigma)
+
+    # Mirror by the kernel radius, then up to sizes the FFT is fast for.
+    pad = int(np.ceil(4 * max_sigma))
+    h = scipy.fft.next_fast_len(im.shape[0] + 2 * pad, True)
+    w = scipy.fft.next_fast_len(im.shape[1] + 2 * pad, True)
+    padded = np.pad(im, (
+        (pad, h - im.shape[0] - pad), (pad, w - im.shape[1] - pad)
+    ), 'symmetric')
+
+    # Scale normalised negative Laplacian of Gaussian in the frequency
+    # domain: 4 pi^2 s^2 |f|^2 exp(-2 pi^2 s^2 |f|^2)
+    f2 = (scipy.fft.fftfreq(h)[:, np.newaxis]**2
+        + scipy.fft.rfftfreq(w)[np.newaxis, :]**2)
+    s2 = (sigmas**2)[:, np.newaxis, np.newaxis]
+    kernels = (4 * np.pi**2 * s2 * f2
+        * np.exp(-2 * np.pi**2 * s2 * f2)).astype(np.float32)
+
+    cube = scipy.fft.irfft2(scipy.fft.rfft2(padded) * kernels, s=(h, w))
+    cube = np.moveaxis(
+        cube[:, pad:pad + im.shape[0], pad:pad + im.shape[1]], 0, -1)
+
+    peaks = skimage.feature.peak_local_max(
+        cube,
+        threshold_abs=threshold,
+        threshold_rel=0.0,
+        exclude_border=False,
+        footprint=np.ones((3, 3, 3))
+    )
+    if len(peaks) == 0:
+        return np.zeros((0, 3))
+
+    blobs = np.column_stack((peaks[:, :2], sigmas[peaks[:, 2]]))
+    return _prune_blobs(blobs, .5)
+
+
+def blob_peaks(im, min_sigma, max_sigma, num_sigma, threshold):
+    """Find blobs as local maxima of the image.
+
+    Blobs are local maxima of the slightly smoothed image within a window
+    the size of the smallest blob, that are above the threshold. Plateaus
+    count as a single maximum. The radius of a blob is estimated from the
+    area of the connected region above the threshold it lies in, shared
+    equally by all maxima in it.
+    num_sigma is ignored. See blob_log() for the arguments and return value.
+
+    """
+    # Light smoothing keeps noise from splitting maxima.
+    im = ndi.gaussian_filter(skimage.util.img_as_float32(im), 1)
+    mask = im > threshold
+
+    size = 2 * int(np.ceil(min_sigma * np.sqrt(2))) + 1
+    peaks = mask & (im == ndi.maximum_filter(im, size=size))
+    peak_labels, n_peaks = ndi.label(peaks)
+    if n_peaks == 0:
+        return np.zeros((0, 3))
+    index = np.arange(1, n_peaks + 1)
+    centres = np.array(ndi.center_of_mass(peaks, peak_labels, index))
+
+    regions, n_regions = ndi.label(mask)
+    area = np.bincount(regions.ravel(), minlength=n_regions + 1)
+    region = ndi.maximum(regions, peak_labels, index).astype(int)
+    n_shared = np.bincount(region, minlength=n_regions + 1)
+
+    r = np.sqrt(area[region] / n_shared[region] / np.pi)
+    sigma = np.clip(r / np.sqrt(2), min_sigma, max_sigma)
+    return np.column_stack((centres, sigma))
+
+
+# Blob detection backends by name. Each is called with the image slice and
+# the min_sigma, max_sigma, num_sigma and threshold parameters, and returns
+# an array of blobs in (y, x, sigma) format. Backends must be defined in
+# this module, so that worker processes can find them.
+BACKENDS = {
+    'log': blob_log,
+    'dog': blob_dog,
+    'fft_log': blob_fft_log,
+    'peaks': blob_peaks
+}
+
+
+def blob_confidence(im, blobs):
+    """Calculate the mean pixel value within each blob, scaled to (0, 1).
+
+    Pixels are sampled from a square of side 2r starting r pixels above and
+    to the left of the blob centre (truncated to the image bounds), keeping
+    those within r pixels of the centre, where r is the integer blob radius.
+    Blobs are grouped by integer radius so every group is scored with a
+    single precomputed disk mask in one batched array operation.
+
+    For integer images the results are identical to summing the pixels one
+    at a time. For floating point images they may differ in the last digit
+    due to a different summation order.
+
+    Args:
+        im (numpy.ndarray): Image slice the blobs were detected on.
+        blobs (numpy.ndarray): Array of blobs, with each row in
+            (y, x, radius) format.
+
+    Returns:
+        numpy.ndarray: Confidence value for each blob.
+
+    """
+    conf = np.zeros(len(blobs))
+    if len(blobs) == 0:
+        return conf
+
+    if np.issubdtype(im.dtype, np.integer):
+        acc_dtype = np.int64
+    else:
+        acc_dtype = np.float64
+
+    c_y = blobs[:, 0].astype(int)
+    c_x = blobs[:, 1].astype(int)
+    r_i = blobs[:, 2].astype(int)
+
+    for r in np.unique(r_i):
+        sel = np.nonzero(r_i == r)[0]
+
+        # disk mask relative to the top left corner of the blob square
+        p = np.arange(2 * r)
+        disk = (p[:, None] - r)**2 + (p[None, :] - r)**2 <= r**2
+
+        y1, h = _slice_bounds(c_y[sel] - r, c_y[sel] + r, im.shape[0])
+        x1, w = _slice_bounds(c_x[sel] - r, c_x[sel] + r, im.shape[1])
+        mask = (disk[None, :, :]
+            & (p[None, :, None] < h[:, None, None])
+            & (p[None, None, :] < w[:, None, None]))
+
+        rows = np.minimum(y1[:, None] + p[None, :], im.shape[0] - 1)
+        cols = np.minimum(x1[:, None] + p[None, :], im.shape[1] - 1)
+        values = im[rows[:, :, None], cols[:, None, :]]
+
+        pred = np.where(mask, values, 0).sum(axis=(1, 2), dtype=acc_dtype)
+        pred_n = mask.sum(axis=(1, 2))
+        conf[sel] = np.where(
+            pred_n > 0, (pred / np.maximum(pred_n, 1)) / 255, 0)
+
+    return conf
+
+
+def _slice_bounds(start, stop, n):
+    """Resolve arrays of slice bounds the way Python slicing would.
+
+    Args:
+        start (numpy.ndarray): Slice start indices.
+        stop (numpy.ndarray): Slice stop indices.
+        n (int): Length of the sliced axis.
+
+    Returns:
+        tuple: (numpy.ndarray: resolved start, numpy.ndarray: slice length)
+
+    """
+    start = np.where(start < 0, start + n, start).clip(0, n)
+    stop = np.where(stop < 0, stop + n, stop).clip(0, n)
+    return start, np.maximum(stop - start, 0)
+
+
+def _prune_blobs(blobs, overlap):
+    """Remove the smaller of every two blobs overlapping by more than given.
+
+    Same as the pruning done by skimage.feature.blob_log(), whose helper is
+    not part of the public scikit-image API.
+
+    Args:
+        blobs (numpy.ndarray): Blobs in (y, x, sigma) format. Modified in
+            place.
+        overlap (float): Largest allowed fraction of the area of the
+            smaller blob covered by the larger one.
+
+    Returns:
+        numpy.ndarray: Remaining blobs.
+
+    """
+    tree = scipy.spatial.cKDTree(blobs[:, :2])
+    pairs = tree.query_pairs(2 * math.sqrt(2) * blobs[:, 2].max())
+    for i, j in pairs:
+        b1, b2 = blobs[i], blobs[j]
+        if _blob_overlap(b1, b2) > overlap:
+            if b1[2] > b2[2]:
+                b2[2] = 0
+            else:
+                b1[2] = 0
+    return blobs[blobs[:, 2] > 0]
+
+
+def _blob_overlap(b1, b2):
+    """Return the fraction of the smaller blob's area covered by the other.
+
+    Blobs are disks of radius sigma * sqrt(2). Blobs already removed by
+    _prune_blobs() have a sigma of zero.
+    """
+    if b1[2] == b2[2] == 0:
+        return 0.0
+    s = max(b1[2], b2[2])
+    r1 = b1[2] / s
+    r2 = b2[2] / s
+    d = math.hypot(b1[0] - b2[0], b1[1] - b2[1]) / (s * math.sqrt(2))
+    if d > r1 + r2:
+        return 0.0
+    if d <= abs(r1 - r2):
+        return 1.0
+
+    acos1 = math.acos(min(max((d**2 + r1**2 - r2**2) / (2 * d * r1), -1), 1))
+    acos2 = math.acos(min(max((d**2 + r2**2 - r1**2) / (2 * d * r2), -1), 1))
+    area = (r1**2 * acos1 + r2**2 * acos2 - 0.5 * math.sqrt(abs(
+        (-d + r2 + r1) * (d - r2 + r1) * (d + r2 - r1) * (d + r2 + r1))))
+    return area / (math.pi * min(r1, r2)**2)
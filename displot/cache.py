@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""displot - On-disk cache of network predictions.
+
+Predicted tiles are stored in compressed archives named by a hash of the
+image content and every parameter that affects the prediction, so that
+detection can be rerun with different blob detection and discrimination
+settings without predicting again. The least recently used archives are
+removed once the cache exceeds its size budget.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import os
+import json
+import uuid
+import hashlib
+import logging
+import zipfile
+import threading
+
+import numpy as np
+
+log = logging.getLogger('displot')
+
+# Per user directory of files kept between runs, such as predictions and
+# converted models. The DISPLOT_CACHE_DIR environment variable overrides it.
+CACHE_DIR = os.environ.get('DISPLOT_CACHE_DIR') or os.path.join(
+    os.path.expanduser('~'), '.cache', 'displot')
+DEFAULT_PATH = os.path.join(CACHE_DIR, 'predictions')
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+_EXT = '.zip'
+_FN_META = 'meta.json'
+_FN_BATCH = '{0:06d}.npy'
+_KEY_ROWS = 256
+
+
+class PredictionCache(object):
+    """Directory of predicted tile archives with LRU eviction.
+
+    Args:
+        path (str): Cache directory. Created if it does not exist.
+            If None, DEFAULT_PATH is used.
+        max_bytes (int): Size budget of the cache directory in bytes.
+            If None, archives are never evicted.
+
+    Attributes:
+        path
+        max_bytes
+
+    """
+
+    def __init__(self, path=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path or DEFAULT_PATH
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Allows the cache to be passed to other processes.
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        """int: Combined size of all cached archives in bytes."""
+        return sum(e[2] for e in self._entries())
+
+    def key(self, image, **params):
+        """Return the cache key of the predictions for an image.
+
+        Args:
+            image (numpy.ndarray): Image the predictions are made on.
+            **params: Everything else the predictions depend on. Must be
+                serialisable to JSON.
+
+        Returns:
+            str: Hexadecimal hash.
+
+        """
+        h = hashlib.sha256()
+        h.update(json.dumps(
+            [image.shape, image.dtype.str, params], sort_keys=True).encode())
+        # Block by block, so that lazily loaded images are never read into
+        # memory as a whole.
+        for i in range(0, image.shape[0], _KEY_ROWS):
+            h.update(np.ascontiguousarray(image[i:i + _KEY_ROWS]).data)
+        return h.hexdigest()
+
+    def get(self, key):
+        """Open cached predictions for reading.
+
+        Marks the archive as recently used.
+
+        Args:
+            key (str): Cache key.
+
+        Returns:
+            CacheReader: Reader, or None if the key is not cached.
+
+        """
+        p = self._path(key)
+        try:
+            os.utime(p)
+            return CacheReader(p)
+        except (OSError, zipfile.BadZipFile, KeyError):
+            return None
+
+    def writer(self, key, **meta):
+        """Open an archive for writing predictions under a key.
+
+        Args:
+            key (str): Cache key.
+            **meta: Description of the cached predictions. Must be
+                serialisable to JSON.
+
+        Returns:
+            CacheWriter: Writer.
+
+        """
+        os.makedirs(self.path, exist_ok=True)
+        return CacheWriter(self, self._path(key), meta)
+
+    def evict(self):
+        """Remove least recently used archives until within the size budget.
+
+        Returns:
+            int: Number of archives removed.
+
+        """
+        if self.max_bytes is None:
+            return 0
+
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda e: e[1])
+            total = sum(e[2] for e in entries)
+            n = 0
+            for p, _, size in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(p)
+                except OSError:
+                    continue
+                total -= size
+                n += 1
+                log.debug('Prediction cache evicted: "{0}".'.format(p))
+        return n
+
+    def clear(self):
+        """Remove all cached archives.
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            for p, _, _ in self._entries():
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+
+    def _path(self, key):
+        return os.path.join(self.path, key + _EXT)
+
+    def _entries(self):
+        """Return (path, last use time, size) of every cached archive."""
+        if not os.path.isdir(self.path):
+            return []
+        ret = []
+        for e in os.scandir(self.path):
+            if e.is_file() and e.name.endswith(_EXT):
+                st = e.stat()
+                ret.append((e.path, st.st_mtime, st.st_size))
+        return ret
+
+
+class CacheReader(object):
+    """Reader of a cached prediction archive.
+
+    Args:
+        path (str): Path to the archive.
+
+    Attributes:
+        meta (dict): Description of the cached predictions.
+        path
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with zipfile.ZipFile(path, 'r') as zf:
+            self.meta = json.loads(zf.read(_FN_META).decode())
+
+    def batches(self):
+        """Read the cached batches of predicted tiles in order.
+
+        Yields:
+            numpy.ndarray: Stack of predicted tiles.
+
+        """
+        with zipfile.ZipFile(self.path, 'r') as zf:
+            for name in sorted(zf.namelist()):
+                if name == _FN_META:
+                    continue
+                with zf.open(name) as f:
+                    yield np.lib.format.read_array(f, allow_pickle=False)
+
+
+class CacheWriter(object):
+    """Writer of a prediction archive, one batch at a time.
+
+    The archive is written under a temporary name, and only becomes visible
+    to readers once commit() is called. Use as a context manager to discard
+    incomplete archives on errors.
+
+    Args:
+        cache (PredictionCache): Cache the archive belongs to.
+        path (str): Final path of the archive.
+        meta (dict): Description of the cached predictions.
+
+    """
+
+    def __init__(self, cache, path, meta):
+        self._cache = cache
+        self._path = path
+        self._tmp = '{0}.{1}.part'.format(path, uuid.uuid4().hex)
+        self._zf = zipfile.ZipFile(self._tmp, 'w', zipfile.ZIP_DEFLATED,
+            compresslevel=1)
+        self._zf.writestr(_FN_META, json.dumps(meta))
+        self._n = 0
+
+    def write(self, Y):
+        """Append a batch of predicted tiles.
+
+        Args:
+            Y (numpy.ndarray): Stack of predicted tiles.
+
+        Returns:
+            None
+
+        """
+        with self._zf.open(_FN_BATCH.format(self._n), 'w',
+            force_zip64=True
+        ) as f:
+            np.lib.format.write_array(f, np.ascontiguousarray(Y),
+                allow_pickle=False)
+        self._n += 1
+
+    def commit(self):
+        """Finish the archive and make it available in the cache.
+
+        Returns:
+            None
+
+        """
+        self._zf.close()
+        os.replace(self._tmp, self._path)
+        log.debug('Prediction cache stored: "{0}".'.format(self._path))
+        self._cache.evict()
+
+    def discard(self):
+        """Delete the incomplete archive.
+
+        Returns:
+            None
+
+        """
+        self._zf.close()
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.discard()
@@ -0,0 +1,531 @@
+# -*- coding: utf-8 -*-
+"""displot - Headless command line interface.
+
+Example:
+    Detect dislocations on all images in a directory using four processes,
+    writing a displot data file next to each image:
+
+        $ python -m displot detect path/to/images -p 4
+
+    Images whose outputs are newer than both the image and the weights file,
+    and were made with the same settings, are skipped, so an interrupted
+    batch can be resumed by rerunning it.
+
+    Convert the latest FusionNet weights to an int8 Tensorflow Lite model
+    and check its agreement with the float32 model on reference images:
+
+        $ python -m displot convert path/to/reference/images -q int8
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import argparse
+import multiprocessing as mp
+import concurrent.futures
+
+import displot
+import displot.io
+import displot.cache
+import displot.detection
+import displot.weights
+import displot.tflite
+
+log = logging.getLogger('displot')
+
+BACKENDS = ('keras',) + displot.tflite.QUANTIZATIONS
+
+IMAGE_EXT = ['.tif', '.tiff', '.png']
+OUTPUT_EXT = {
+    'dpa': displot.io.DP_EXT, 'csv': '.csv', 'npy': '.npy', 'npz': '.npz',
+    'h5': '.h5'
+}
+
+# Detection options that do not change the results, and so do not make an
+# output out of date.
+RUN_OPTIONS = ('stream', 'batch_size', 'memory_budget_mb', 'cache')
+
+
+def main(argv=None):
+    """Run the command line interface.
+
+    Args:
+        argv (list): Command line arguments, excluding the program name.
+            If not set, sys.argv is used.
+
+    Returns:
+        int: Exit status.
+
+    """
+    args = build_parser().parse_args(argv)
+    setup_logger(logging.DEBUG if args.debug else logging.INFO)
+    return args.func(args)
+
+
+def build_parser():
+    """Build the command line argument parser.
+
+    Returns:
+        argparse.ArgumentParser: Argument parser.
+
+    """
+    parser = argparse.ArgumentParser(prog='python -m displot')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('detect',
+        help='Detect dislocations on many images without the GUI.')
+    p.set_defaults(func=detect)
+    p.add_argument('inputs', nargs='+', metavar='PATH',
+        help='Image file, directory of images, or glob pattern.')
+    p.add_argument('-w', '--weights', default='fusionnet',
+        help='Weights to use, as MODEL or MODEL:ITERATION. The latest '
+        'iteration is used if none is given. (default: %(default)s)')
+    p.add_argument('-o', '--output-dir', default=None,
+        help='Directory to write outputs to. (default: next to each image)')
+    p.add_argument('-f', '--format', choices=sorted(OUTPUT_EXT),
+        default='dpa', help='Output format. (default: %(default)s)')
+    p.add_argument('-b', '--backend', choices=BACKENDS, default='keras',
+        help='Inference backend. Anything but keras uses a quantised '
+        'Tensorflow Lite model, made beforehand with the convert '
+        'subcommand. (default: %(default)s)')
+    p.add_argument('-p', '--processes', type=int, default=1,
+        help='Number of images processed in parallel. (default: %(default)s)')
+    p.add_argument('-t', '--threads', type=int, default=None,
+        help='Number of Tensorflow and blob detection threads per process. '
+        '(default: all CPUs divided between the processes)')
+    p.add_argument('--force', action='store_true',
+        help='Process images even if their outputs are up to date.')
+    p.add_argument('--report', action='store_true',
+        help='Write a JSON report of time and memory use per processing '
+        'stage next to each output.')
+    p.add_argument('--no-prediction', action='store_true',
+        help='Do not store the prediction map in displot data files. '
+        'It is only stored in \'mosaic\' blob mode. Without it, detection '
+        'cannot be repeated from the file without running the neural '
+        'network again.')
+    p.add_argument('--image', choices=['embed', 'reference'],
+        default=None,
+        help='Store the image in displot data files, or only its path and '
+        'a digest. Referencing files avoids copying the image, but it '
+        'must stay in place or next to the data file. (default: embed, '
+        'or reference for multi-frame images)')
+    p.add_argument('--compress-image', action='store_true',
+        help='Compress images embedded in displot data files. Makes files '
+        'smaller, but slower to save and open.')
+    p.add_argument('--feature-metadata', action='store_true',
+        help='Add the image file name and size as columns to exported '
+        'features. Not used for displot data files.')
+    p.add_argument('--cache', action='store_true',
+        help='Reuse cached network predictions, and cache new ones, so '
+        'that reruns with different blob detection or discrimination '
+        'parameters skip prediction.')
+    p.add_argument('--cache-dir', default=None,
+        help='Prediction cache directory. (default: {0})'.format(
+            displot.cache.DEFAULT_PATH))
+    p.add_argument('--cache-size-mb', type=int,
+        default=displot.cache.DEFAULT_MAX_BYTES // 1024**2,
+        help='Prediction cache size budget. (default: %(default)s)')
+    p.add_argument('--debug', action='store_true',
+        help='Enable debug logging.')
+
+    g = p.add_argument_group('detection parameters')
+    g.add_argument('--stride', type=int, nargs=2, default=(256, 256),
+        metavar=('ROW', 'COL'))
+    g.add_argument('--min-r', type=int, default=5)
+    g.add_argument('--max-r', type=int, default=14)
+    g.add_argument('--min-sigma', type=int, default=3)
+    g.add_argument('--max-sigma', type=int, default=15)
+    g.add_argument('--num-sigma', type=int, default=15)
+    g.add_argument('--threshold', type=float, default=.1)
+    g.add_argument('--td-border', type=int, default=3)
+    g.add_argument('--td-overlap', type=int, default=2)
+    g.add_argument('--pred-tolerance', type=float, default=.33)
+    g.add_argument('--blob-mode', choices=['tile', 'mosaic'], default='tile')
+    g.add_argument('--blob-backend', choices=displot.detection.BLOB_BACKENDS,
+        default='log')
+    g.add_argument('--tiling', choices=['reflect', 'context'],
+        default='reflect')
+    g.add_argument('--stream', action='store_true')
+    g.add_argument('--batch-size', type=int, default=None)
+    g.add_argument('--memory-budget-mb', type=int, default=None)
+
+    p = sub.add_parser('convert',
+        help='Convert weights to a quantised Tensorflow Lite model.')
+    p.set_defaults(func=convert)
+    p.add_argument('inputs', nargs='+', metavar='PATH',
+        help='Reference image file, directory of images, or glob pattern, '
+        'used for calibration and for checking agreement with float32.')
+    p.add_argument('-w', '--weights', default='fusionnet',
+        help='Weights to convert, as MODEL or MODEL:ITERATION. '
+        '(default: %(default)s)')
+    p.add_argument('-q', '--quantization', nargs='+',
+        choices=displot.tflite.QUANTIZATIONS,
+        default=list(displot.tflite.QUANTIZATIONS),
+        help='Quantisation modes to convert to. (default: all)')
+    p.add_argument('-n', '--tiles', type=int, default=32,
+        help='Number of reference tiles. (default: %(default)s)')
+    p.add_argument('--debug', action='store_true',
+        help='Enable debug logging.')
+
+    return parser
+
+
+def setup_logger(level=logging.INFO):
+    logger = logging.getLogger('displot')
+    logger.setLevel(level)
+
+    stream = logging.StreamHandler()
+    stream.setLevel(level)
+    stream.setFormatter(logging.Formatter(
+        '[%(levelname)s] %(asctime)s %(processName)s - %(message)s'))
+    logger.addHandler(stream)
+
+
+def detect(args):
+    """Run the detect subcommand.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments.
+
+    Returns:
+        int: Exit status. Non-zero if any image failed.
+
+    """
+    weights = parse_weights(args.weights)
+    if args.backend != 'keras':
+        try:
+            displot.tflite.require(weights[0], weights[1], args.backend)
+        except ValueError as e:
+            raise SystemExit(str(e))
+    params = dict(
+        stride=tuple(args.stride),
+        min_r=args.min_r, max_r=args.max_r,
+        min_sigma=args.min_sigma, max_sigma=args.max_sigma,
+        num_sigma=args.num_sigma, threshold=args.threshold,
+        td_border=args.td_border, td_overlap=args.td_overlap,
+        pred_tolerance=args.pred_tolerance, backend=args.backend,
+        blob_mode=args.blob_mode, blob_backend=args.blob_backend,
+        tiling=args.tiling, stream=args.stream,
+        batch_size=args.batch_size, memory_budget_mb=args.memory_budget_mb
+    )
+    # The prediction map is only stored in displot data files.
+    # Only mosaic blob detection can be repeated from the fused map.
+    params['keep_prediction'] = (args.format == 'dpa'
+        and args.blob_mode == 'mosaic' and args.no_prediction is False)
+    if args.cache is True:
+        params['cache'] = displot.cache.PredictionCache(
+            args.cache_dir, args.cache_size_mb * 1024**2)
+    if args.format == 'dpa':
+        save = dict(image=args.image, compress=args.compress_image)
+    else:
+        save = dict(metadata=args.feature_metadata)
+
+    settings = run_settings(weights, args.format, params, save)
+
+    inputs = find_inputs(args.inputs)
+    weights_mtime = os.path.getmtime(displot.weights.path(*weights))
+
+    jobs = []
+    skipped = 0
+    for path in inputs:
+        out = output_path(path, args.output_dir, args.format)
+        if args.force is False and is_up_to_date(
+            out, path, weights_mtime, settings
+        ):
+            log.debug('Up to date, skipping: "{0}".'.format(path))
+            skipped += 1
+            continue
+        jobs.append((path, out))
+
+    log.info('{0} images found, {1} to process, {2} up to date.'.format(
+        len(inputs), len(jobs), skipped))
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    # Without a thread count, parallel processes share the CPUs rather than
+    # each starting a thread and blob detection process per CPU.
+    threads = args.threads
+    if threads is None and args.processes > 1:
+        threads = max(mp.cpu_count() // args.processes, 1)
+
+    failed = 0
+    if args.processes <= 1:
+        _init_process(threads, log.level)
+        for path, out in jobs:
+            failed += not detect_file(
+                path, out, weights, params, args.report, save, settings)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.processes,
+            mp_context=mp.get_context('spawn'),
+            initializer=_init_process,
+            initargs=(threads, log.level)
+        )
+        with executor:
+            futures = [
+                executor.submit(
+                    detect_file, path, out, weights, params, args.report,
+                    save, settings)
+                for path, out in jobs
+            ]
+            for f in concurrent.futures.as_completed(futures):
+                failed += not f.result()
+
+    log.info('Done. Processed: {0}, skipped: {1}, failed: {2}.'.format(
+        len(jobs) - failed, skipped, failed))
+    return 1 if failed > 0 else 0
+
+
+def convert(args):
+    """Run the convert subcommand.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments.
+
+    Returns:
+        int: Exit status.
+
+    """
+    weights = parse_weights(args.weights)
+    inputs = find_inputs(args.inputs)
+    if len(inputs) == 0:
+        raise SystemExit('No reference images found.')
+
+    images = [displot.io.load_displot_data(p).image for p in inputs]
+    reference = displot.tflite.reference_tiles(images, args.tiles)
+    del images
+
+    for q in args.quantization:
+        displot.tflite.convert(weights[0], weights[1], q, reference)
+        log.info('Saved: "{0}".'.format(displot.tflite.path(*weights, q)))
+    return 0
+
+
+def detect_file(path, out, weights, params, report=False, save=None,
+    settings=None
+):
+    """Run detection on a single image and write the output file.
+
+    The output is written to a temporary file first and then moved into
+    place, so that an interrupted run never leaves an output behind that
+    looks up to date.
+
+    Args:
+        path (str): Path to image.
+        out (str): Path to output file. The format is determined by the
+            extension.
+        weights (tuple): Weights identifier of the form (model_id, iter_id).
+        params (dict): Keyword arguments passed to Displot.detection().
+        report (bool): If True, a JSON report of the time and memory use of
+            each processing stage is written next to the output file.
+        save (dict): Keyword arguments passed to Displot.save_data() when
+            writing displot data files, or to Displot.save_features()
+            otherwise.
+        settings (dict): Settings the output is made with, as returned by
+            run_settings(). If set, they are written next to the output
+            file, once it is in place. See is_up_to_date().
+
+    Returns:
+        bool: True on success, False otherwise.
+
+    """
+    root, ext = os.path.splitext(out)
+    tmp = root + '.part' + ext
+
+    t = time.time()
+    try:
+        dp = displot.Displot()
+        dp.load_data(path)
+        if dp.data_obj.frames is not None:
+            dp.detect_frames(weights, model=weights[0], **params)
+        else:
+            dp.detection(
+                dp.data_obj.image, weights, model=weights[0], **params)
+        if ext == displot.io.DP_EXT:
+            dp.save_data(tmp, **(save or {}))
+        else:
+            dp.save_features(tmp, **(save or {}))
+        os.replace(tmp, out)
+        if settings is not None:
+            with open(settings_path(out), 'w', encoding='utf-8') as f:
+                json.dump(settings, f, indent=2)
+        if report is True:
+            dp.save_report(root + '.report.json')
+    except Exception:
+        log.error('Failed to process "{0}".'.format(path), exc_info=True)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+
+    log.info('Processed "{0}" in {1:.1f}s.'.format(path, time.time() - t))
+    return True
+
+
+def find_inputs(patterns):
+    """Expand files, directories and glob patterns into a list of images.
+
+    Args:
+        patterns (list): List of paths or glob patterns.
+
+    Returns:
+        list: Sorted list of unique image paths.
+
+    """
+    paths = []
+    for p in patterns:
+        if os.path.isdir(p):
+            paths.extend(os.path.join(p, f) for f in os.listdir(p))
+        elif glob.has_magic(p):
+            paths.extend(glob.glob(p, recursive=True))
+        else:
+            paths.append(p)
+
+    return sorted(set(
+        os.path.abspath(p) for p in paths
+        if os.path.isfile(p) and os.path.splitext(p)[1].lower() in IMAGE_EXT
+    ))
+
+
+def output_path(path, output_dir, fmt):
+    """Return the output path for an input image.
+
+    Args:
+        path (str): Path to image.
+        output_dir (str): Output directory. If None, the directory of the
+            image is used.
+        fmt (str): Output format. See OUTPUT_EXT.
+
+    Returns:
+        str: Path to output file.
+
+    """
+    if output_dir is None:
+        output_dir = os.path.dirname(path)
+    bn = os.path.splitext(os.path.basename(path))[0] + OUTPUT_EXT[fmt]
+    return os.path.join(output_dir, bn)
+
+
+def is_up_to_date(out, path, weights_mtime, settings=None):
+    """Check if an output file is newer than its image and weights file.
+
+    Args:
+        out (str): Path to output file.
+        path (str): Path to image.
+        weights_mtime (float): Modification time of the weights file.
+        settings (dict): Settings the output must have been made with, as
+            returned by run_settings(). If set, outputs without a matching
+            settings file next to them are out of date.
+
+    Returns:
+        bool: True if the output exists and is up to date.
+
+    """
+    if not os.path.exists(out):
+        return False
+    mtime = os.path.getmtime(out)
+    if mtime < os.path.getmtime(path) or mtime < weights_mtime:
+        return False
+    if settings is None:
+        return True
+
+    try:
+        with open(settings_path(out), encoding='utf-8') as f:
+            return json.load(f) == settings
+    except (OSError, ValueError):
+        return False
+
+
+def run_settings(weights, fmt, params, save):
+    """Return the settings that determine the output of a detection run.
+
+    Args:
+        weights (tuple): Weights identifier of the form (model_id, iter_id).
+        fmt (str): Output format. See OUTPUT_EXT.
+        params (dict): Keyword arguments passed to Displot.detection().
+            RUN_OPTIONS are left out.
+        save (dict): Keyword arguments used when writing the output.
+
+    Returns:
+        dict: Settings, in the form they take once stored as JSON.
+
+    """
+    settings = {
+        'weights': weights,
+        'format': fmt,
+        'detection': {
+            k: v for k, v in params.items() if k not in RUN_OPTIONS},
+        'save': save
+    }
+    return json.loads(json.dumps(settings, sort_keys=True))
+
+
+def settings_path(out):
+    """Return the path of the settings file stored next to an output.
+
+    Args:
+        out (str): Path to output file.
+
+    Returns:
+        str: Path to settings file.
+
+    """
+    return out + '.settings.json'
+
+
+def parse_weights(s):
+    """Parse a weights identifier given on the command line.
+
+    Args:
+        s (str): Weights identifier of the form MODEL or MODEL:ITERATION.
+
+    Returns:
+        tuple: Tuple of the form (model_id, iter_id).
+
+    """
+    model_id, _, iter_id = s.partition(':')
+    if iter_id == '':
+        lst = displot.weights.list_weights(model_id)
+        if len(lst) == 0:
+            raise SystemExit('No weights found for model `{0}` in {1}.'.format(
+                model_id, displot.weights.PATH_WEIGHTS))
+        iter_id = lst[-1][1]
+
+    if not displot.weights.weights_exist(model_id, iter_id):
+        raise SystemExit('Weights not found: {0}'.format(
+            displot.weights.path(model_id, iter_id)))
+
+    return model_id, iter_id
+
+
+def _init_process(threads, level):
+    """Set up logging and thread counts in a processing process.
+
+    Args:
+        threads (int): Number of Tensorflow and blob detection threads.
+            If None, defaults are left in place.
+        level (int): Logging level.
+
+    Returns:
+        None
+
+    """
+    if len(log.handlers) == 0:
+        setup_logger(level)
+
+    if threads is not None:
+        import displot.tf
+        import displot.workers
+        displot.tf.set_threads(threads)
+        displot.workers.get_pool().processes = threads
+
+
+if __name__ == '__main__':
+    sys.exit(main())
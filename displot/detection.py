@@ -5,24 +5,43 @@ Author: Bohdan Starosta
 University of Strathclyde Physics Department
 """
 
+import os
 import logging
-import functools
+import contextlib
 import multiprocessing as mp
 
 import numpy as np
-import skimage.feature
 
-from displot.io import DisplotDataFeature
-import displot.tf
+from displot.io import FeatureTable
+from displot.profiling import StageProfiler
+from displot.progress import Progress, Cancelled, check
+import displot.models
+import displot.tflite
+import displot.weights
+import displot.workers
+
+# displot.tf and displot.blobs pull in Tensorflow and scikit-image, so they
+# are imported only once prediction or blob detection runs.
 
 log = logging.getLogger('displot')
 
+# Names of the blob detection backends in displot.blobs.BACKENDS, for use
+# where importing scikit-image would be wasted, such as option lists.
+BLOB_BACKENDS = ('dog', 'fft_log', 'log', 'peaks')
+
+# Image context processed around a region of interest, so that features near
+# its edges are detected as they would be on the whole image.
+ROI_MARGIN = 256
+
 
 def detection(
     image, weights, model='fusionnet', stride=(256, 256),
     min_r=5, max_r=14,
     min_sigma=3, max_sigma=15, num_sigma=15, threshold=.1,
     td_border=3, td_overlap=2, pred_tolerance=0.33,
+    stream=False, batch_size=None, memory_budget_mb=None, pool=None,
+    blob_mode='tile', tiling='reflect', backend='keras', cache=None,
+    keep_prediction=False, blob_backend='log', profiler=None, cancel=None,
     _qt5signals=None
 ):
     """Perform machine learning assisted detection of dislocations on an image.
@@ -53,15 +72,65 @@ def detection(
         td_border (int): Remove all TDs within this many pixels of the border.
         td_overlap (int): Allow this many pixels of overlap between blobs.
         pred_tolerance (float): Prune all TDs below this confidence value.
+        stream (bool): If True, sliding window tiles are generated, predicted
+            and blob detected in batches of batch_size, and freed as soon as
+            each batch is processed. Peak memory then scales with the batch
+            size rather than the image area.
+        batch_size (int): Number of tiles predicted at once. If not set,
+            it is derived from memory_budget_mb.
+        memory_budget_mb (int): Memory available for inference activations
+            in megabytes. See displot.tf.auto_batch_size().
+        pool (displot.workers.BlobWorkerPool): Worker pool to run blob
+            detection in. If not set, the process-wide pool is used.
+        blob_mode (str): 'tile' runs blob detection on every predicted tile,
+            finding each TD once per overlapping tile. 'mosaic' averages the
+            overlapping predictions into a single probability map the size
+            of the image and runs blob detection over it in parallel
+            overlapping chunks, finding each TD once. The map is zero padded
+            at its border. The mosaic map needs 3 bytes per image pixel,
+            also in streaming mode.
+        tiling (str): 'reflect' cuts tiles from the virtually zero padded
+            image, and the model reflect pads every tile to give it context.
+            'context' reflect pads the image once at its true border, and
+            cuts every network input including its context from that copy
+            as a view, so tiles see real neighbouring image data.
+        backend (str): Inference backend. See displot.tf.predict().
+            Quantised Tensorflow Lite models must have been converted
+            beforehand, see displot.tflite.require().
+        cache (displot.cache.PredictionCache): If set, predicted tiles are
+            looked up in this cache and stored in it on a miss. On a hit,
+            tiling and prediction are skipped.
+        keep_prediction (bool): If True, the fused prediction map is also
+            returned. In 'tile' mode this stitches the predicted tiles as
+            well, needing 3 bytes per image pixel. See redetection().
+        blob_backend (str): Blob detection backend.
+            See displot.blobs.BACKENDS.
+        profiler (displot.profiling.StageProfiler): If set, time and memory
+            use of every processing stage, and the numbers of tiles,
+            candidates and final features are recorded in it.
+        cancel (displot.progress.CancelToken): If set, it is checked between
+            prediction batches and blob detection chunks. Once it is set,
+            the blob worker pool is terminated and
+            displot.progress.Cancelled raised.
 
     Returns:
-        tuple: (list of DisplotDataFeature, float: average pred. conf.)
+        tuple: (io.FeatureTable, float: average pred. conf.), extended
+            by (numpy.ndarray: uint8 prediction map,) if keep_prediction is
+            True.
 
     """
-    progress = 0
-    if (callable(_qt5signals.progress)
-    and hasattr(_qt5signals.progress, 'emit')):
-        _qt5signals.progress.emit(progress)  # 0%
+    import displot.blobs
+
+    if blob_mode not in ('tile', 'mosaic'):
+        raise ValueError('Unknown blob detection mode: {0}'.format(blob_mode))
+    if tiling not in ('reflect', 'context'):
+        raise ValueError('Unknown tiling mode: {0}'.format(tiling))
+    if blob_backend not in displot.blobs.BACKENDS:
+        raise ValueError('Unknown blob detection backend: {0}'.format(
+            blob_backend))
+
+    if profiler is None:
+        profiler = StageProfiler()
 
     # Get rid of extraneous dimension.
     if len(image.shape) == 3:
@@ -71,167 +140,353 @@ def detection(
     # stride = (256, 256)  # row, column of sliding window stride
 
     # Calculate proper padding so that the predictions can be stiched together
-    l_pad = stride[1]
-    t_pad = stride[0]
-    r_pad = stride[1] - (image.shape[1] % stride[1])
-    b_pad = stride[0] - (image.shape[0] % stride[0])
-    if r_pad % hw[1] > 0:
-        r_pad += stride[1]
-    if b_pad % hw[0] > 0:
-        b_pad += stride[0]
-
-    padding = (l_pad, t_pad, r_pad, b_pad)
+    with profiler.stage('padding'):
+        padding = _padding(image.shape, stride, hw)
     log.debug('l_pad, t_pad, r_pad, b_pad: {0}'.format(padding))
-    log.debug('image.shape (before pad): {0}'.format(image.shape))
+    log.debug('image.shape: {0}'.format(image.shape))
+
+    # Padded image dimensions
+    h_padded = padding[1] + image.shape[0] + padding[3]
+    w_padded = padding[0] + image.shape[1] + padding[2]
+    n_row = int(h_padded / stride[0]) - 1
+    n_col = int(w_padded / stride[1]) - 1
+    n_tiles = n_row * n_col
+    log.debug('n_row: {0}, n_col: {1}'.format(n_row, n_col))
+
+    if backend != 'keras':
+        displot.tflite.require(weights[0], weights[1], backend)
+    if batch_size is None:
+        import displot.tf
+        batch_size = displot.tf.auto_batch_size(model, memory_budget_mb)
+    if pool is None:
+        pool = displot.workers.get_pool()
+
+    # Without streaming all tiles are cut from the image in one go.
+    if stream is True:
+        tile_batch = batch_size
+    else:
+        tile_batch = n_tiles
+
+    profiler.info.update(
+        image_shape=list(image.shape), stride=list(stride), model=model,
+        weights=list(weights), backend=backend, tiling=tiling,
+        blob_mode=blob_mode, blob_backend=blob_backend, stream=stream,
+        batch_size=batch_size
+    )
+
+    bd_kwargs = dict(
+        min_sigma=min_sigma,
+        max_sigma=max_sigma,
+        num_sigma=num_sigma,
+        threshold=threshold,
+        min_r=min_r,
+        max_r=max_r,
+        backend=blob_backend
+    )
 
-    # Pad image to get correct stride coverage
-    image_padded = np.pad(image, ((t_pad, b_pad), (l_pad, r_pad)), 'constant',
-        constant_values=((0, 0), (0, 0)))
-    log.debug('image.shape (after pad): {0}'.format(image.shape))
+    if blob_mode == 'mosaic' or keep_prediction is True:
+        mosaic_sum = np.zeros(image.shape, dtype=np.uint16)
+        mosaic_n = np.zeros(image.shape, dtype=np.uint8)
+    else:
+        mosaic_sum = None
+
+    cached = None
+    writer = None
+    if cache is not None:
+        with profiler.stage('cache'):
+            key = cache.key(image, model=model, weights=list(weights),
+                weights_mtime=_weights_mtime(weights), stride=list(stride),
+                tiling=tiling, backend=backend)
+            cached = cache.get(key)
+        if cached is not None and cached.meta.get('n_tiles') != n_tiles:
+            cached = None
+        if cached is None:
+            writer = cache.writer(key, n_tiles=n_tiles, shape=list(hw))
+        profiler.info['cache'] = 'miss' if cached is None else 'hit'
+        log.info('Prediction cache {0}.'.format(profiler.info['cache']))
+
+    # Every tile is predicted, unless cached, and then either blob detected
+    # or stitched. Mosaic blob detection takes up the second half.
+    progress = Progress(n_tiles * (1 + (cached is None)), _qt5signals,
+        label='Detection', unit='tile steps',
+        span=(0, 50) if blob_mode == 'mosaic' else (0, 100))
+    progress.start()
+
+    if cached is not None:
+        log.info('Starting blob detection on cached predictions '
+            '({0} tiles).'.format(n_tiles))
+        predictions = profiler.iterate('cache', cached.batches())
+    else:
+        log.info('Starting prediction and blob detection '
+            '({0} tiles, batch size {1}).'.format(n_tiles, batch_size))
+        if tiling == 'context':
+            margin = getattr(displot.models.load_model(model), 'PAD', None)
+            if margin is None:
+                raise ValueError('Model `{0}` does not support context '
+                    'tiling.'.format(model))
+            with profiler.stage('padding'):
+                tiles = _context_tiles(image, stride, hw, padding, margin)
+        else:
+            tiles = _tiles(image, stride, hw, padding)
+        predictions = _predict(
+            _batches(tiles, tile_batch), model, weights, batch_size,
+            backend, tiling == 'context', profiler, cancel, progress.advance)
 
-    passes = np.zeros((
-        int(image_padded.shape[0] / stride[0]),
-        int(image_padded.shape[1] / stride[1])
-    ))
-    log.debug('passes.shape: {0}'.format(passes.shape))
+    blobs_found = []
+    n_done = 0
+    try:
+        check(cancel)
+        for Y in predictions:
+            Y = Y.reshape((len(Y),) + hw)
+            if writer is not None:
+                with profiler.stage('cache'):
+                    writer.write(Y)
+
+            # Tiles are in row-major window order.
+            offsets = [
+                ((i % n_col) * stride[1] - padding[0],
+                (i // n_col) * stride[0] - padding[1])
+                for i in range(n_done, n_done + len(Y))
+            ]
+
+            if mosaic_sum is not None:
+                with profiler.stage('stitch'):
+                    _stitch(mosaic_sum, mosaic_n, Y, offsets)
+            if blob_mode == 'tile':
+                with profiler.stage('blob_detect'), _terminate_on_cancel(pool):
+                    for blobs in pool.blob_detect(Y, offsets, cancel=cancel,
+                        callback=progress.advance, **bd_kwargs
+                    ):
+                        blobs_found.append(blobs)
+            else:
+                progress.advance(len(Y))
+
+            n_done += len(Y)
+            profiler.count('tiles', len(Y))
+            del Y
+            log.debug('Processed tiles: {0}/{1}'.format(n_done, n_tiles))
+            check(cancel)
+    except BaseException:
+        if writer is not None:
+            writer.discard()
+        raise
+
+    if writer is not None:
+        with profiler.stage('cache'):
+            writer.commit()
+
+    if mosaic_sum is not None:
+        with profiler.stage('fuse'):
+            mosaic = _fuse(mosaic_sum, mosaic_n)
+        del mosaic_sum, mosaic_n
+
+    if blob_mode == 'mosaic':
+        with profiler.stage('blob_detect'), _terminate_on_cancel(pool):
+            tds = _features(_mosaic_blob_detect(mosaic, pool, bd_kwargs,
+                cancel=cancel, _qt5signals=_qt5signals, span=(50, 100)))
+
+        # Every TD is found exactly once, there is nothing to average.
+        detect_samples = 1
+    else:
+        tds = _features(*blobs_found)
+        detect_samples = 4
+    del blobs_found
+
+    _log_blob_detect(profiler, blob_backend)
+    log.debug('TDs found initially: {0}'.format(len(tds)))
+    profiler.count('candidates', len(tds))
 
-    # Build array of image inputs for prediction using a sliding window
-    X = []
-    for r in range(0, image_padded.shape[0] - stride[0], stride[0]):
-        for c in range(0, image_padded.shape[1] - stride[1], stride[1]):
+    check(cancel)
+    with profiler.stage('discrimination'):
+        ret = discrimination(
+            image, tds,
+            td_border, td_overlap, pred_tolerance, detect_samples, _qt5signals
+        )
+    profiler.count('features', len(ret[0]))
 
-            r_ = int(r / stride[0])
-            c_ = int(c / stride[1])
-            passes[r_:r_ + 2, c_:c_ + 2] += 1
+    if keep_prediction is True:
+        return ret + (mosaic,)
+    return ret
 
-            X.append(image_padded[r:r + hw[0], c:c + hw[1]])
 
-    X = np.array(X)
-    log.debug('X.shape: {0}'.format(X.shape))
+def detect_frames(frames, weights, indices=None, **kwargs):
+    """Perform detection on the frames of a stack one at a time.
 
-    progress += 10
-    if (callable(_qt5signals.progress)
-    and hasattr(_qt5signals.progress, 'emit')):
-        _qt5signals.progress.emit(progress)  # 10%
+    A frame is only opened when its turn comes and closed once it has been
+    processed, and each is streamed through prediction and blob detection
+    like in detection(), so a stack is never held in memory as a whole.
 
-    # Perform predictions
-    log.info('Starting prediction.')
-    try:
-        Y = displot.tf.predict(X, 'fusionnet', weights)
-    except Exception:
-        log.error("Unrecoverable error.", exc_info=True)
-        exit(1)
+    Args:
+        frames (io.TiffStack): Frames to process. Any sequence of images
+            can be passed.
+        weights (tuple): Weights identifier of the form (model_id, iter_id).
+        indices (iterable): Indices of the frames to process. If not set,
+            every frame is processed.
+        **kwargs: Passed to detection(). Prediction maps are never kept.
+
+    Yields:
+        tuple: (int: frame index, tuple: (io.FeatureTable, float: average
+            pred. conf.)). The features have a 'frame' column holding the
+            frame index.
 
-    log.info('Prediction complete.')
-    log.debug('Y.shape: {0}'.format(Y.shape))
+    """
+    kwargs['keep_prediction'] = False
+    if indices is None:
+        indices = range(len(frames))
+
+    for i in indices:
+        log.info('Starting detection on frame {0}/{1}.'.format(
+            i + 1, len(frames)))
+        image = frames[i]
+        try:
+            tds, conf = detection(image, weights, **kwargs)
+        finally:
+            if hasattr(image, 'close'):
+                image.close()
+            del image
+        tds.addColumn('frame', np.int32, i)
+        yield i, (tds, conf)
+
+
+def redetection(
+    image, prediction, min_r=5, max_r=14,
+    min_sigma=3, max_sigma=15, num_sigma=15, threshold=.1,
+    td_border=3, td_overlap=2, pred_tolerance=0.33,
+    blob_backend='log', pool=None, profiler=None, cancel=None,
+    _qt5signals=None
+):
+    """Repeat blob detection and discrimination on a stored prediction map.
 
-    progress += 40
-    if (callable(_qt5signals.progress)
-    and hasattr(_qt5signals.progress, 'emit')):
-        _qt5signals.progress.emit(progress)  # 50%
-
-    # Stitch the predictions into 4 separate blob images.
-    # Find blobs as well while iterating over the predictions.
-    n_row = int(image_padded.shape[0] / stride[0]) - 1
-    n_col = int(image_padded.shape[1] / stride[1]) - 1
-
-    lo_row = np.floor(n_row / 2)
-    hi_row = np.ceil(n_row / 2)
-    lo_col = np.floor(n_col / 2)
-    hi_col = np.ceil(n_col / 2)
-
-    blob_l = np.zeros((int(hw[0] * hi_row), int(hw[1] * hi_col)))
-    blob_t = np.zeros((int(hw[0] * hi_row), int(hw[1] * lo_col)))
-    blob_r = np.zeros((int(hw[0] * lo_row), int(hw[1] * hi_col)))
-    blob_b = np.zeros((int(hw[0] * lo_row), int(hw[1] * lo_col)))
-
-    log.debug('blob_l.shape: {0}, blob_t.shape: {1}, '
-        'blob_r.shape: {2}, blob_b.shape: {3}'.format(
-            blob_l.shape, blob_t.shape, blob_r.shape, blob_b.shape
-        )
-    )
+    The neural network is not run, so blob detection and discrimination
+    parameters can be tuned in seconds. Blob detection runs over the whole
+    map as in the 'mosaic' mode of detection(), so for a map made in that
+    mode the same parameters give the same features as detection() did.
 
-    log.info('Starting blob detection.')
-    tds = []
+    Args:
+        image (numpy.ndarray): Image the prediction map was made on.
+        prediction (numpy.ndarray): Fused uint8 prediction map, as returned
+            by detection() with keep_prediction set and blob_mode 'mosaic'.
+        pool (displot.workers.BlobWorkerPool): Worker pool to run blob
+            detection in. If not set, the process-wide pool is used.
+        profiler (displot.profiling.StageProfiler): If set, time and memory
+            use of every processing stage are recorded in it.
+        cancel (displot.progress.CancelToken): If set, it is checked between
+            blob detection chunks. See detection().
+
+    See detection() for the description of the remaining arguments.
 
-    row = 0
-    col = 0
-    bd_funcs = []
-    for i, Y_ in enumerate(Y):
-        log.debug('ROW: {0}, COL: {1}'.format(row, col))
-        Y_ = np.squeeze(Y_)
+    Returns:
+        tuple: (io.FeatureTable, float: average pred. conf.)
 
-        if col % 2 == 0:
-            x_i = col * stride[1]
-        else:
-            x_i = col * stride[1] - stride[1]
-        log.debug('x_i: {0}'.format(x_i))
-
-        if row % 2 == 0:
-            y_i = row * stride[0]
-            log.debug('y_i: {0}'.format(y_i))
-            if i % 2 == 0:  # left
-                blob_l[y_i:y_i + hw[0], x_i:x_i + hw[1]] = Y_
-            else:  # top
-                blob_t[y_i:y_i + hw[0], x_i:x_i + hw[1]] = Y_
-        else:
-            y_i = row * stride[0] - stride[0]
-            log.debug('y_i: {0}'.format(y_i))
-            if i % 2 == 0:  # bottom
-                blob_b[y_i:y_i + hw[0], x_i:x_i + hw[1]] = Y_
-            else:  # right
-                blob_r[y_i:y_i + hw[0], x_i:x_i + hw[1]] = Y_
-
-        bd_funcs.append(functools.partial(_blob_detect,
-            Y_,
-            x_offset=(col * stride[1]) - padding[0],
-            y_offset=(row * stride[0]) - padding[1],
-            min_sigma=min_sigma,
-            max_sigma=max_sigma,
-            num_sigma=num_sigma,
-            threshold=threshold,
-            min_r=min_r,
-            max_r=max_r
-        ))
-
-        col += 1
-        if col >= n_col:
-            col = 0
-            row += 1
-
-        # progress += 50 / len(Y)
-
-    with mp.Pool() as pool:
-        bd_out = pool.map(_retcall, bd_funcs)
-
-    for i in bd_out:
-        tds.extend(i)
+    """
+    if len(image.shape) == 3:
+        image = np.squeeze(image)
+    if prediction.shape != image.shape:
+        raise ValueError('Prediction map shape {0} does not match image '
+            'shape {1}.'.format(prediction.shape, image.shape))
 
-    progress += 50
-    if (callable(_qt5signals.progress)
-    and hasattr(_qt5signals.progress, 'emit')):
-        _qt5signals.progress.emit(progress)  # 100%
+    if profiler is None:
+        profiler = StageProfiler()
+    if pool is None:
+        pool = displot.workers.get_pool()
+
+    bd_kwargs = dict(
+        min_sigma=min_sigma,
+        max_sigma=max_sigma,
+        num_sigma=num_sigma,
+        threshold=threshold,
+        min_r=min_r,
+        max_r=max_r,
+        backend=blob_backend
+    )
 
-    log.info('Blob detection complete.')
+    log.info('Starting blob detection on stored prediction map.')
+    with profiler.stage('blob_detect'), _terminate_on_cancel(pool):
+        tds = _features(_mosaic_blob_detect(prediction, pool, bd_kwargs,
+            cancel=cancel, _qt5signals=_qt5signals))
+    _log_blob_detect(profiler, blob_backend)
     log.debug('TDs found initially: {0}'.format(len(tds)))
+    profiler.count('candidates', len(tds))
+
+    check(cancel)
+    with profiler.stage('discrimination'):
+        ret = discrimination(
+            image, tds, td_border, td_overlap, pred_tolerance, 1, _qt5signals
+        )
+    profiler.count('features', len(ret[0]))
+
+    return ret
 
-    return discrimination(
-        image, tds,
-        td_border, td_overlap, pred_tolerance, 4, _qt5signals
+
+def roi_window(shape, roi, margin=ROI_MARGIN):
+    """Return the part of an image to process for a region of interest.
+
+    Args:
+        shape (tuple): Image shape.
+        roi (tuple): Region of interest in (x1, y1, x2, y2) format.
+        margin (int): Width of the context around the region in pixels.
+
+    Returns:
+        tuple: Region extended by the margin and clipped to the image,
+            in (x1, y1, x2, y2) format.
+
+    """
+    x1, y1, x2, y2 = roi
+    if x2 <= x1 or y2 <= y1:
+        raise ValueError('Empty region of interest: {0}'.format(roi))
+    return (
+        max(x1 - margin, 0), max(y1 - margin, 0),
+        min(x2 + margin, shape[1]), min(y2 + margin, shape[0])
     )
 
 
+def roi_features(tds, roi, window):
+    """Move features found in a window into image coordinates.
+
+    Args:
+        tds (io.FeatureTable): Features found on the part of the image
+            covered by the window. Their coordinates are changed in place.
+        roi (tuple): Region of interest in (x1, y1, x2, y2) format.
+        window (tuple): Window in (x1, y1, x2, y2) format. See roi_window().
+
+    Returns:
+        io.FeatureTable: Features within the region of interest.
+
+    """
+    tds.x += window[0]
+    tds.y += window[1]
+    return tds[in_roi(tds, roi)]
+
+
+def in_roi(td, roi):
+    """Check if features lie within a region of interest.
+
+    Args:
+        td (io.DisplotDataFeature or io.FeatureTable): Feature, or table of
+            features.
+        roi (tuple): Region of interest in (x1, y1, x2, y2) format.
+
+    Returns:
+        bool or numpy.ndarray: True where the centre of the feature is
+            within the region.
+
+    """
+    return ((roi[0] <= td.x) & (td.x < roi[2])
+        & (roi[1] <= td.y) & (td.y < roi[3]))
+
+
 def discrimination(
-    image, tds=[],
+    image, tds=None,
     td_border=3, td_overlap=2, pred_tolerance=0.33,
     detect_samples=1,
     _qt5signals=None
 ):
-    """Perform discrimination on a list of dislocations.
+    """Perform discrimination on a set of dislocations.
 
     Args:
         image (numpy.ndarray): Image to read properties from.
-        tds (list): A list of DisplotDataFeature objects.
+        tds (io.FeatureTable): Candidate features. A list of
+            DisplotDataFeature objects is converted. Not modified.
         td_border (int): Remove all TDs within this many pixels of the border.
         td_overlap (int): Allow this many pixels of overlap between blobs.
         pred_tolerance (float): Prune all TDs below this confidence value.
@@ -242,35 +497,28 @@ def discrimination(
             together and averages their prediction confidence.
 
     Returns:
-        tuple: (list of DisplotDataFeature, float: average pred. conf.)
+        tuple: (io.FeatureTable, float: average pred. conf.)
 
     """
+    if tds is None:
+        tds = FeatureTable()
+    elif not isinstance(tds, FeatureTable):
+        tds = FeatureTable.fromFeatures(tds)
 
     progress = 0
-    if (callable(_qt5signals.progress)
-    and hasattr(_qt5signals.progress, 'emit')):
-        _qt5signals.progress.emit(progress)  # 0%
-
-    tds_pruned = []
+    _progress(_qt5signals, progress)  # 0%
 
     log.info('Starting discrimination.')
     # First pass for bad candidates
-    for i, td in enumerate(tds):
-        # Prune border TDs as they are largely artifacts
-        if (td.x <= td_border or td.x >= (image.shape[1] - td_border)
-        or td.y < td_border or td.y >= (image.shape[0] - td_border)):
-            continue
-
-        # Prediction < 0.01 means pruned
-        if td.confidence < 0.01:
-            continue
-
-        tds_pruned.append(td)
+    # Prune border TDs as they are largely artifacts
+    keep = ((tds.x > td_border) & (tds.x < image.shape[1] - td_border)
+        & (tds.y >= td_border) & (tds.y < image.shape[0] - td_border))
+    # Prediction < 0.01 means pruned
+    keep &= ~(tds.confidence < 0.01)
+    tds_pruned = tds[keep]
 
     progress += 50
-    if (callable(_qt5signals.progress)
-    and hasattr(_qt5signals.progress, 'emit')):
-        _qt5signals.progress.emit(progress)  # 50%
+    _progress(_qt5signals, progress)  # 50%
 
     # Second pass for prediction ranking
 
@@ -278,38 +526,43 @@ def discrimination(
     # if this function is being run immediately after prediction.
     # We find those four times and use the one with highest pred then average
     # the pred confidence.
-    tds_final = []
-    tds_visited = []
+    final = []
     pred_avg = []
 
-    for i, td in enumerate(tds_pruned):
-        if i in tds_visited:
+    xs = tds_pruned.x.astype(float)
+    ys = tds_pruned.y.astype(float)
+    rs = tds_pruned.r.astype(float)
+    conf = tds_pruned.confidence.tolist()
+    tds_visited = np.zeros(len(tds_pruned), dtype=bool)
+
+    # Two TDs can only overlap if they are closer than this.
+    if len(tds_pruned) > 0:
+        reach = 2 * np.max(rs) - td_overlap
+    else:
+        reach = 0
+    grid = _SpatialGrid(xs, ys, reach)
+
+    for i in range(len(tds_pruned)):
+        if tds_visited[i]:
             continue
 
-        overlap_list = [td]
-
         # find all overlapping TDs
-        for j, td_ in enumerate(tds_pruned):
-            dx = td.x - td_.x
-            dy = td.y - td_.y
-            d = np.hypot(dx, dy)
-            if d >= (td.r + td_.r - td_overlap):
-                continue
-
-            overlap_list.append(td_)
-            tds_visited.append(j)
+        j = grid.neighbours(xs[i], ys[i])
+        d = np.hypot(xs[i] - xs[j], ys[i] - ys[j])
+        j = j[~(d >= (rs[i] + rs[j] - td_overlap))]
+        tds_visited[j] = True
 
         # sort by prediction confidence
         overlap_list = sorted(
-            overlap_list,
-            key=lambda x: x.confidence,
+            [i] + j.tolist(),
+            key=conf.__getitem__,
             reverse=True
         )
 
         # calculate averaged prediction confidence
         # prediction confidence should always be an average of 4 overlapping
         overlap_list = overlap_list[:detect_samples]
-        pred_list = [x.confidence for x in overlap_list]
+        pred_list = [conf[k] for k in overlap_list]
         pred_list += [0] * (detect_samples - len(overlap_list))
         pred = np.average(pred_list)
 
@@ -319,103 +572,444 @@ def discrimination(
 
         # if we are here, it means TD looks valid and is added to the
         # output list.
-        overlap_list[0].confidence = pred
-        tds_final.append(overlap_list[0])
+        conf[overlap_list[0]] = pred
+        final.append(overlap_list[0])
         pred_avg.append(pred)
 
+    tds_final = tds_pruned[np.array(final, dtype=np.intp)]
+    tds_final.confidence = np.array(conf)[final]
+
     progress = 100
-    if (callable(_qt5signals.progress)
-    and hasattr(_qt5signals.progress, 'emit')):
-        _qt5signals.progress.emit(progress)  # 100%
+    _progress(_qt5signals, progress)  # 100%
 
     log.info('Discrimination complete.')
     log.debug('TDs after pruning: {0}'.format(len(tds_final)))
     return tds_final, np.average(pred_avg)
 
 
-def _blob_detect(
-    im, x_offset, y_offset,
-    min_sigma, max_sigma, num_sigma, threshold,
-    min_r, max_r
+class _SpatialGrid(object):
+    """Uniform grid spatial index over a set of points.
+
+    Points are bucketed into square cells, so that all points closer than
+    the cell size to a query point are found in the 3x3 block of cells
+    around it.
+
+    Args:
+        x (numpy.ndarray): X coordinates of the points.
+        y (numpy.ndarray): Y coordinates of the points.
+        cell (float): Cell size. Should be the largest distance that will be
+            searched for. If not positive, no neighbours are ever returned.
+
+    """
+
+    def __init__(self, x, y, cell):
+        self.cell = cell
+        self._cells = {}
+
+        if cell <= 0 or len(x) == 0:
+            return
+
+        kx = np.floor(x / cell).astype(np.int64)
+        ky = np.floor(y / cell).astype(np.int64)
+        order = np.lexsort((np.arange(len(x)), ky, kx))
+        kx = kx[order]
+        ky = ky[order]
+
+        # split the sorted point indices wherever the cell changes
+        split = np.nonzero((np.diff(kx) != 0) | (np.diff(ky) != 0))[0] + 1
+        starts = np.concatenate(([0], split))
+        for start, idx in zip(starts, np.split(order, split)):
+            self._cells[(int(kx[start]), int(ky[start]))] = idx
+
+    def neighbours(self, x, y):
+        """Return indices of candidate points near a query point.
+
+        Args:
+            x (float): X coordinate of the query point.
+            y (float): Y coordinate of the query point.
+
+        Returns:
+            numpy.ndarray: Point indices in ascending order. Includes every
+                point closer than the cell size, and possibly others.
+
+        """
+        if len(self._cells) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        kx = int(np.floor(x / self.cell))
+        ky = int(np.floor(y / self.cell))
+        found = [self._cells[k] for k in (
+            (kx + dx, ky + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+        ) if k in self._cells]
+
+        if len(found) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.concatenate(found))
+
+
+def _features(*blobs):
+    """Convert arrays of detected blobs to a feature table.
+
+    Args:
+        *blobs (numpy.ndarray): Arrays of blobs, with each row in
+            (x, y, radius, confidence) format.
+
+    Returns:
+        io.FeatureTable: Features in the order of the blobs.
+
+    """
+    blobs = [np.asarray(b, dtype=np.float64).reshape(-1, 4) for b in blobs]
+    blobs = np.concatenate(blobs) if blobs else np.zeros((0, 4))
+    return FeatureTable(
+        x=np.trunc(blobs[:, 0]),
+        y=np.trunc(blobs[:, 1]),
+        r=blobs[:, 2],
+        confidence=blobs[:, 3]
+    )
+
+
+def _log_blob_detect(profiler, blob_backend):
+    """Log the blob detection backend and the time spent in it."""
+    s = profiler.stages.get('blob_detect')
+    if s is None:
+        return
+    log.info('Blob detection complete ({0} backend, {1:.2f}s in {2} '
+        'batches).'.format(blob_backend, s['wall_s'], s['calls']))
+
+
+@contextlib.contextmanager
+def _terminate_on_cancel(pool):
+    """Terminate the blob worker pool if the enclosed block is cancelled.
+
+    Args:
+        pool (displot.workers.BlobWorkerPool): Worker pool.
+
+    Yields:
+        None
+
+    """
+    try:
+        yield
+    except Cancelled:
+        log.info('Detection cancelled, stopping blob detection workers.')
+        pool.terminate()
+        raise
+
+
+def _stitch(mosaic_sum, mosaic_n, Y, offsets):
+    """Add predicted tiles to a running sum of overlapping predictions.
+
+    Args:
+        mosaic_sum (numpy.ndarray): Sum of predictions, image sized.
+        mosaic_n (numpy.ndarray): Number of predictions summed per pixel,
+            image sized.
+        Y (numpy.ndarray): Stack of predicted tiles.
+        offsets (list): List of (x_offset, y_offset) tuples of the top left
+            corner of each tile relative to the image.
+
+    Returns:
+        None
+
+    """
+    h, w = mosaic_sum.shape
+    for Y_, (x1, y1) in zip(Y, offsets):
+        x1_ = max(x1, 0)
+        y1_ = max(y1, 0)
+        x2_ = min(x1 + Y_.shape[1], w)
+        y2_ = min(y1 + Y_.shape[0], h)
+        if x2_ <= x1_ or y2_ <= y1_:
+            continue
+        tile = Y_[y1_ - y1:y2_ - y1, x1_ - x1:x2_ - x1]
+        mosaic_sum[y1_:y2_, x1_:x2_] += tile
+        mosaic_n[y1_:y2_, x1_:x2_] += 1
+
+
+def _fuse(mosaic_sum, mosaic_n):
+    """Average summed overlapping predictions into a single map.
+
+    Args:
+        mosaic_sum (numpy.ndarray): Sum of predictions.
+        mosaic_n (numpy.ndarray): Number of predictions summed per pixel.
+
+    Returns:
+        numpy.ndarray: Fused uint8 prediction map.
+
+    """
+    mosaic = np.zeros(mosaic_sum.shape, dtype=np.uint8)
+    for i in range(0, mosaic_sum.shape[0], 1024):
+        s = mosaic_sum[i:i + 1024]
+        n = np.maximum(mosaic_n[i:i + 1024], 1)
+        mosaic[i:i + 1024] = (s + n // 2) // n
+    return mosaic
+
+
+def _mosaic_blob_detect(
+    mosaic, pool, bd_kwargs, chunk=1024, cancel=None, _qt5signals=None,
+    span=(0, 100)
 ):
-    """Perform blob detection on an image data slice.
+    """Perform blob detection over a prediction map in parallel chunks.
+
+    The map is split into square chunks, each extended by a margin wide
+    enough for the largest Gaussian kernel and blob radius, so that blobs
+    found in the centre part of a chunk are unaffected by the split. Only
+    those blobs are kept.
 
-    See: https://scikit-image.org/docs/dev/api/skimage.feature.html
+    Chunks at the border of the map are zero padded. A single blob detection
+    run over the whole map would mirror it at the border instead, so within
+    the margin of the border, blobs and their confidence can differ from
+    such a run. Mirroring the chunks would not make them equal, as blobs
+    would then be pruned against their own mirror images.
 
     Args:
-        im (numpy.ndarray): Image slice to detect blobs on.
-            Should be single channel greyscale for performance.
-        x_offset (int): X coordinate of the image slice on the full image
-            relative to its top left corner.
-        y_offset (int): X coordinate of the image slice on the full image
-            relative to its top left corner.
-        min_sigma (int): Blob detection parameter.
-            Minimum standard deviation for Gaussian kernel.
-        max_sigma (int): Blob detection parameter.
-            Maximum standard deviation for Gaussian kernel.
-        num_sigma (int): Blob detection parameter.
-            Number of intermediate values of standard deviations to consider
-            between min_sigma and max_sigma.
-        threshold (float): Blob detection parameter.
-            The absolute lower bound for scale space maxima. Local maxima
-            smaller than thresh are ignored. Reduce this to detect blobs
-            with less intensities.
-        min_r (int): Minimum blob radius.
-        max_r (int): Maximum blob radius.
+        mosaic (numpy.ndarray): Fused prediction map.
+        pool (displot.workers.BlobWorkerPool): Worker pool to run blob
+            detection in.
+        bd_kwargs (dict): Keyword arguments passed to
+            displot.blobs.blob_detect().
+        chunk (int): Chunk size in pixels, excluding the margin.
+        cancel (displot.progress.CancelToken): Checked between chunks.
+        _qt5signals (ui.WorkerSignals): Signal object or None.
+        span (tuple): Range of progress percent covered, in (start, end)
+            format.
 
     Returns:
-        list: List of DisplotDataFeature objects containing positional
-            information about detected blobs.
+        numpy.ndarray: Array of detected blobs, with each row in
+            (x, y, radius, confidence) format.
 
     """
+    margin = (int(np.ceil(4 * bd_kwargs['max_sigma']))
+        + int(np.ceil(bd_kwargs['max_r'])) + 1)
+    mosaic = np.pad(mosaic, margin, 'constant')
+    h = mosaic.shape[0] - 2 * margin
+    w = mosaic.shape[1] - 2 * margin
+    size = chunk + 2 * margin
+
+    cores = [(x, y) for y in range(0, h, chunk) for x in range(0, w, chunk)]
+    n_batch = 2 * (pool.processes or mp.cpu_count())
+    log.debug('Mosaic blob detection: {0} chunks, margin {1}.'.format(
+        len(cores), margin))
+    progress = Progress(len(cores), _qt5signals, label='Blob detection',
+        unit='chunks', span=span)
+    progress.start()
+
+    blobs = []
+    for batch in _batches(cores, n_batch):
+        check(cancel)
+        tiles = np.zeros((len(batch), size, size), dtype=mosaic.dtype)
+        offsets = []
+        for i, (x, y) in enumerate(batch):
+            tile = mosaic[y:y + size, x:x + size]
+            tiles[i, :tile.shape[0], :tile.shape[1]] = tile
+            offsets.append((x - margin, y - margin))
+
+        found = pool.blob_detect(tiles, offsets, cancel=cancel,
+            callback=progress.advance, **bd_kwargs)
+        for (x, y), b in zip(batch, found):
+            core = ((b[:, 0] >= x) & (b[:, 0] < x + chunk)
+                & (b[:, 1] >= y) & (b[:, 1] < y + chunk))
+            blobs.append(b[core])
+        del tiles
+
+    if len(blobs) == 0:
+        return np.zeros((0, 4))
+    return np.concatenate(blobs)
+
+
+def _padding(shape, stride, hw):
+    """Calculate image padding needed for the sliding window to cover it.
+
+    Predictions made on the padded image can be stitched back together
+    with every image pixel covered by the same number of windows.
+
+    Args:
+        shape (tuple): Image shape in (height, width) format.
+        stride (tuple): Sliding window stride in (row, column) format.
+        hw (tuple): Sliding window size in (height, width) format.
 
-    tds = []
+    Returns:
+        tuple: Padding in (left, top, right, bottom) format.
 
-    # This line is very slow.
-    blobs_log = skimage.feature.blob_log(
-        im,
-        min_sigma=min_sigma,
-        max_sigma=max_sigma,
-        num_sigma=num_sigma,
-        threshold=threshold
+    """
+    l_pad = stride[1]
+    t_pad = stride[0]
+    r_pad = stride[1] - (shape[1] % stride[1])
+    b_pad = stride[0] - (shape[0] % stride[0])
+    if r_pad % hw[1] > 0:
+        r_pad += stride[1]
+    if b_pad % hw[0] > 0:
+        b_pad += stride[0]
+    return (l_pad, t_pad, r_pad, b_pad)
+
+
+def _tiles(image, stride, hw, padding):
+    """Generate sliding window tiles over a virtually zero padded image.
+
+    The padded image is never built. Each tile is cut from the unpadded
+    image and the parts falling outside of it are filled with zeros.
+
+    Args:
+        image (numpy.ndarray): Unpadded image.
+        stride (tuple): Sliding window stride in (row, column) format.
+        hw (tuple): Sliding window size in (height, width) format.
+        padding (tuple): Padding in (left, top, right, bottom) format.
+
+    Yields:
+        tuple: (int: window row, int: window column, numpy.ndarray: tile)
+
+    """
+    h_padded = padding[1] + image.shape[0] + padding[3]
+    w_padded = padding[0] + image.shape[1] + padding[2]
+
+    for r in range(0, h_padded - stride[0], stride[0]):
+        for c in range(0, w_padded - stride[1], stride[1]):
+            # tile bounds in unpadded image coordinates
+            y1 = r - padding[1]
+            x1 = c - padding[0]
+            y1_ = max(y1, 0)
+            x1_ = max(x1, 0)
+            y2_ = min(y1 + hw[0], image.shape[0])
+            x2_ = min(x1 + hw[1], image.shape[1])
+
+            tile = np.zeros(hw, dtype=image.dtype)
+            if y2_ > y1_ and x2_ > x1_:
+                tile[y1_ - y1:y2_ - y1, x1_ - x1:x2_ - x1] = \
+                    image[y1_:y2_, x1_:x2_]
+
+            yield int(r / stride[0]), int(c / stride[1]), tile
+
+
+def _context_tiles(image, stride, hw, padding, margin):
+    """Return sliding window tiles with context, as views of a padded copy.
+
+    The image is reflect padded once, by the sliding window padding plus
+    the context margin. Every tile is a read-only view into that copy,
+    extended by the margin on each side, so tiles see real image data
+    wherever it exists. Only the area outside the image is synthetic.
+
+    Args:
+        image (numpy.ndarray): Unpadded image.
+        stride (tuple): Sliding window stride in (row, column) format.
+        hw (tuple): Sliding window size in (height, width) format,
+            excluding the margin.
+        padding (tuple): Padding in (left, top, right, bottom) format.
+        margin (int): Context in pixels on each side of a tile.
+
+    Returns:
+        list: List of (int: window row, int: window column,
+            numpy.ndarray: tile) tuples, ordered like the output of _tiles().
+
+    """
+    h_padded = padding[1] + image.shape[0] + padding[3]
+    w_padded = padding[0] + image.shape[1] + padding[2]
+    n_row = len(range(0, h_padded - stride[0], stride[0]))
+    n_col = len(range(0, w_padded - stride[1], stride[1]))
+    size = (hw[0] + 2 * margin, hw[1] + 2 * margin)
+
+    # The last windows may reach further than the sliding window padding.
+    top = padding[1] + margin
+    left = padding[0] + margin
+    bottom = max((n_row - 1) * stride[0] + size[0] - top - image.shape[0], 0)
+    right = max((n_col - 1) * stride[1] + size[1] - left - image.shape[1], 0)
+    padded = np.pad(image, ((top, bottom), (left, right)), 'reflect')
+
+    s = padded.strides
+    views = np.lib.stride_tricks.as_strided(
+        padded,
+        shape=(n_row, n_col) + size,
+        strides=(stride[0] * s[0], stride[1] * s[1]) + s,
+        writeable=False
     )
+    return [(r, c, views[r, c]) for r in range(n_row) for c in range(n_col)]
+
+
+def _predict(
+    batches, model, weights, batch_size, backend, padded, profiler,
+    cancel=None, callback=None
+):
+    """Predict batches of sliding window tiles.
+
+    Errors raised by the prediction are re-raised as RuntimeError, leaving
+    it to the caller whether to carry on with other images.
+
+    Args:
+        batches (iterable): Batches of (row, column, tile) tuples.
+        model (str): Neural network model to use.
+        weights (tuple): Neural network weight file to use.
+        batch_size (int): Number of tiles predicted at once.
+        backend (str): Inference backend.
+        padded (bool): True if tiles include the model context.
+        profiler (displot.profiling.StageProfiler): Profiler.
+        cancel (displot.progress.CancelToken): Cancellation token or None.
+        callback (callable): Called with the number of tiles predicted
+            after every batch.
+
+    Yields:
+        numpy.ndarray: Stack of predicted tiles.
+
+    """
+    import displot.tf
+
+    for batch in profiler.iterate('tiling', batches):
+        with profiler.stage('tiling'):
+            X = np.array([t[2] for t in batch])
+        del batch
+        log.debug('X.shape: {0}'.format(X.shape))
+
+        try:
+            Y = displot.tf.predict(X, model, weights, batch_size=batch_size,
+                backend=backend, padded=padded, profiler=profiler,
+                cancel=cancel, callback=callback)
+        except Cancelled:
+            raise
+        except Exception as e:
+            raise RuntimeError('Prediction failed: {0}'.format(e)) from e
+
+        del X
+        yield Y
 
-    # Compute blob radius and clip its values.
-    blobs_log[:, 2] = np.clip(blobs_log[:, 2] * np.sqrt(2), min_r, max_r)
-
-    for c_y, c_x, r in blobs_log:
-        # Extract all pixel values within the blob radius.
-        c_y = int(c_y)
-        c_x = int(c_x)
-        r_i = int(r)
-        sq = im[c_y - r_i:c_y + r_i, c_x - r_i:c_x + r_i]
-
-        pred_n = 0
-        pred = 0
-        for sq_r, sq_r_ in enumerate(sq):
-            for sq_c, sq_c_ in enumerate(sq_r_):
-                if (sq_r - r_i)**2 + (sq_c - r_i)**2 > r_i**2:
-                    continue
-                pred += sq[sq_r, sq_c]
-                pred_n += 1
-
-        # Average of pixel values within each blob radius is set as the
-        # prediction confidence of that marker. This is because the
-        # autoencoder delivers fainter blobs the more "unsure" it is.
-        if pred_n > 0:
-            pred = (pred / pred_n) / 255
-        else:
-            pred = 0
 
-        td = DisplotDataFeature()
-        td.x = c_x + x_offset
-        td.y = c_y + y_offset
-        td.r = r
-        td.confidence = pred
-        tds.append(td)
+def _weights_mtime(weights):
+    """Return the modification time of a weights file, or None."""
+    p = displot.weights.path(*weights)
+    if os.path.exists(p):
+        return os.path.getmtime(p)
+    return None
 
-    return tds
 
+def _batches(iterable, n):
+    """Split an iterable into lists of at most n items.
 
-def _retcall(f):
-    return f()
+    Args:
+        iterable (iterable): Items to split.
+        n (int): Maximum batch size.
+
+    Yields:
+        list: Batch of items.
+
+    """
+    batch = []
+    for i in iterable:
+        batch.append(i)
+        if len(batch) >= n:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def _progress(_qt5signals, progress):
+    """Emit a progress signal if a signal object has been passed.
+
+    Args:
+        _qt5signals (ui.WorkerSignals): Signal object or None.
+        progress (int): Progress percent.
+
+    Returns:
+        None
+
+    """
+    if _qt5signals is None:
+        return
+    if (callable(_qt5signals.progress)
+    and hasattr(_qt5signals.progress, 'emit')):
+        _qt5signals.progress.emit(progress)
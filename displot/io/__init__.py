@@ -8,15 +8,22 @@ University of Strathclyde Physics Department
 """
 
 import os
-from ._io import _load_image, _load_dpfile, _save_dpfile, _save_csv
+
+from ._io import _load_image, _load_dpfile, _save_dpfile
+from ._features import FeatureTable, FeatureView, COLUMNS
+from ._export import export_features, image_metadata, EXPORT_EXT
 
 __all__ = [
-    "DisplotData", "DisplotDataFeature",
-    "save_displot_data", "load_displot_data"
+    "DisplotData", "DisplotDataFeature", "FeatureTable", "FeatureView",
+    "save_displot_data", "load_displot_data", "save_features",
+    "image_metadata"
 ]
 
 DP_EXT = '.dpa'
 
+# Feature attributes always stored in displot data files.
+MARKER_COLUMNS = tuple(COLUMNS)
+
 
 class DisplotData(object):
 
@@ -26,6 +33,23 @@ class DisplotData(object):
         self.image_meta = meta
         self.markers = []
         self.editor_data = {}
+        self.prediction = None
+        self.prediction_meta = None
+        self.image_ref = None
+        # TiffStack of all frames if the image is the first frame of one.
+        self.frames = None
+
+    @property
+    def markers(self):
+        """FeatureTable: Features marked on the image. Can be set to a
+        list of feature objects, which is converted."""
+        return self._markers
+
+    @markers.setter
+    def markers(self, value):
+        if not isinstance(value, FeatureTable):
+            value = FeatureTable.fromFeatures(value)
+        self._markers = value
 
     @property
     def image_width(self):
@@ -47,26 +71,48 @@ class DisplotData(object):
         self.image_path = d['image_path']
         self.image_meta = d['image_meta']
         self.editor_data = d['editor_data']
+        self.prediction_meta = d.get('prediction_meta')
+        self.image_ref = d.get('image_ref')
 
-        self.markers = []
-        for f in d['markers']:
-            o = DisplotDataFeature()
-            o.fromDict(f)
-            self.markers.append(o)
+        self.markers = FeatureTable.fromDicts(d['markers'])
 
-    def toDict(self):
+    def toDict(self, markers=True):
         d = {}
 
-        basic = ['image_path', 'image_meta', 'editor_data']
+        basic = ['image_path', 'image_meta', 'editor_data', 'prediction_meta']
         for i in basic:
             d[i] = getattr(self, i)
 
         d['markers'] = []
-        for f in self.markers:
-            d['markers'].append(f.toDict())
+        if markers is True:
+            d['markers'] = self.markers.toDicts()
 
         return d
 
+    def fromColumns(self, cols):
+        """Replace the markers with features read from columns.
+
+        The arrays are used as they are, without copying.
+
+        Args:
+            cols (dict): Arrays of equal length keyed by column name.
+                Must include MARKER_COLUMNS.
+
+        Returns:
+            None
+
+        """
+        self.markers = FeatureTable(**cols)
+
+    def toColumns(self):
+        """Return the markers as one typed array per attribute.
+
+        Returns:
+            collections.OrderedDict: Arrays keyed by column name.
+
+        """
+        return self.markers.columns
+
 
 class DisplotDataFeature(object):
 
@@ -78,7 +124,7 @@ class DisplotDataFeature(object):
         self.isHidden = False
 
     def __eq__(self, o):
-        if not isinstance(o, DisplotDataFeature):
+        if not isinstance(o, (DisplotDataFeature, FeatureView)):
             return False
         return (self.x == o.x and self.y == o.y and self.r == o.r)
 
@@ -96,11 +142,35 @@ class DisplotDataFeature(object):
         }
 
 
-def save_displot_data(path, obj):
+def save_displot_data(path, obj, prediction=True, image=None,
+    compress=False
+):
+    """Save a data object to a file recognised by displot.
+
+    Args:
+        path (str): Path to data file.
+        obj (io.DisplotData): Displot data object.
+        prediction (bool): If True, the prediction map of the data object
+            is stored in the archive, if it has one.
+        image (str): 'embed' stores the image in the archive, 'reference'
+            only its path and a digest. If None, multi-frame images and data
+            loaded from an archive referencing its image are saved by
+            reference, and any other data embedded. Only the first frame of
+            a multi-frame image can be embedded.
+        compress (bool): If True, an embedded image is compressed.
+
+    Returns:
+        None
+
+    """
     ext = os.path.splitext(path)[1].lower()
+    if image is None:
+        image = 'reference'
+        if obj.image_ref is None and obj.frames is None:
+            image = 'embed'
 
     if ext == DP_EXT:
-        obj = _save_dpfile(path, obj)
+        obj = _save_dpfile(path, obj, prediction, image, compress)
 
 
 def load_displot_data(path):
@@ -127,5 +197,18 @@ def load_displot_data(path):
     return obj
 
 
-def save_features(path, obj):
-    _save_csv(path, obj)
+def save_features(path, obj, metadata=None):
+    """Export the features of a data object.
+
+    Args:
+        path (str): Path to the output file. The format is determined by
+            the extension, see EXPORT_EXT.
+        obj (io.DisplotData): Displot data object.
+        metadata (dict): Values added as columns to every row, keyed by
+            column name. See image_metadata().
+
+    Returns:
+        None
+
+    """
+    export_features(path, obj.markers, metadata)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""displot - Feature export.
+
+Features are written straight from the columns of a FeatureTable, a block
+of rows at a time, so that exports of millions of features never build
+per-feature Python objects. Per-image metadata, such as the image file
+name, can be added as columns holding the same value on every row.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import io
+import os
+import csv
+import zipfile
+
+import numpy as np
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+# Number of rows written at once.
+EXPORT_CHUNK = 65536
+
+
+def export_features(path, table, metadata=None, chunk=EXPORT_CHUNK):
+    """Write features to a file in the format given by its extension.
+
+    Args:
+        path (str): Path to the output file. See EXPORT_EXT for the
+            supported extensions.
+        table (io.FeatureTable): Features to export.
+        metadata (dict): Values added as columns to every row, keyed by
+            column name. Values must be numbers or strings.
+        chunk (int): Number of rows written at once.
+
+    Returns:
+        None
+
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in EXPORT_EXT:
+        raise ValueError('Unknown feature export format: "{0}"'.format(ext))
+
+    columns = list(table.columns.items())
+    meta = [(k, np.asarray(v)) for k, v in (metadata or {}).items()]
+    for k, v in meta:
+        if v.ndim != 0:
+            raise ValueError('Metadata `{0}` is not a single value.'.format(
+                k))
+        if k in table.columns:
+            raise ValueError('Metadata `{0}` has the name of a feature '
+                'column.'.format(k))
+
+    EXPORT_EXT[ext](path, len(table), columns, meta, max(int(chunk), 1))
+
+
+def image_metadata(obj):
+    """Return metadata columns describing the image of a data object.
+
+    Args:
+        obj (io.DisplotData): Data object.
+
+    Returns:
+        dict: Image file name, width and height.
+
+    """
+    return {
+        'image': os.path.basename(obj.image_path or ''),
+        'image_width': obj.image_width,
+        'image_height': obj.image_height
+    }
+
+
+def _export_csv(path, n, columns, meta, chunk):
+    """Write features as comma separated values."""
+    # Metadata is the same on every row, so it is formatted only once.
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator='').writerow([v.item() for _, v in meta])
+    suffix = ',' + buf.getvalue() if meta else ''
+
+    with open(path, mode='w', newline='') as f:
+        csv.writer(f).writerow([k for k, _ in columns + meta])
+        for i in range(0, n, chunk):
+            # Shortest round-trip representation of every value.
+            cells = [map(str, col[i:i + chunk].tolist())
+                for _, col in columns]
+            rows = [','.join(r) + suffix for r in zip(*cells)]
+            f.write('\r\n'.join(rows) + '\r\n')
+
+
+def _export_npy(path, n, columns, meta, chunk):
+    """Write features as a single structured NumPy array."""
+    dtype = np.dtype(
+        [(k, col.dtype) for k, col in columns]
+        + [(k, v.dtype) for k, v in meta])
+
+    with open(path, 'wb') as f:
+        np.lib.format.write_array_header_1_0(f, {
+            'descr': np.lib.format.dtype_to_descr(dtype),
+            'fortran_order': False,
+            'shape': (n,)
+        })
+        for i in range(0, n, chunk):
+            rec = np.empty(min(chunk, n - i), dtype=dtype)
+            for k, col in columns:
+                rec[k] = col[i:i + chunk]
+            for k, v in meta:
+                rec[k] = v
+            f.write(rec.tobytes())
+
+
+def _export_npz(path, n, columns, meta, chunk):
+    """Write features as one NumPy array per column, like numpy.savez()."""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED,
+        allowZip64=True
+    ) as zf:
+        for k, col in columns + meta:
+            with zf.open(k + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array_header_1_0(f, {
+                    'descr': np.lib.format.dtype_to_descr(col.dtype),
+                    'fortran_order': False,
+                    'shape': (n,)
+                })
+                for i in range(0, n, chunk):
+                    if col.ndim == 0:
+                        block = np.full(min(chunk, n - i), col)
+                    else:
+                        block = np.ascontiguousarray(col[i:i + chunk])
+                    f.write(block.tobytes())
+
+
+def _export_hdf5(path, n, columns, meta, chunk):
+    """Write features as one HDF5 dataset per column."""
+    if h5py is None:
+        raise ImportError('Exporting to HDF5 requires the h5py package.')
+
+    with h5py.File(path, 'w') as f:
+        for k, col in columns + meta:
+            dtype = col.dtype
+            if dtype.kind == 'U':
+                # HDF5 has no fixed length unicode type.
+                col = np.char.encode(col, 'utf-8')
+                dtype = col.dtype
+            ds = f.create_dataset(k, shape=(n,), dtype=dtype)
+            for i in range(0, n, chunk):
+                if col.ndim == 0:
+                    ds[i:i + chunk] = np.full(min(chunk, n - i), col)
+                else:
+                    ds[i:i + chunk] = col[i:i + chunk]
+
+
+# Feature export writers keyed by file extension.
+EXPORT_EXT = {
+    '.csv': _export_csv,
+    '.npy': _export_npy,
+    '.npz': _export_npz,
+    '.h5': _export_hdf5,
+    '.hdf5': _export_hdf5
+}
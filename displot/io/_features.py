@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""displot - Columnar feature storage.
+
+Features are kept as one NumPy array per attribute rather than as a list of
+objects, so that detection results of any size are created, filtered,
+saved and sent between processes as a handful of arrays.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import collections
+
+import numpy as np
+
+# Standard feature attributes, their types and default values.
+COLUMNS = collections.OrderedDict((
+    ('x', (np.int32, 0)),
+    ('y', (np.int32, 0)),
+    ('r', (np.float64, 10)),
+    ('confidence', (np.float64, 1)),
+    ('isHidden', (np.bool_, False)),
+))
+
+
+class FeatureTable(object):
+    """Structure of arrays holding a set of features.
+
+    Columns are accessible by name, as table['x'] or table.x. Indexing with
+    an integer returns a FeatureView of a single feature, and indexing with
+    a slice, boolean mask or integer array returns a new table.
+
+    Args:
+        n (int): Number of features. If not set, it is taken from the
+            columns passed.
+        **columns: Initial column values, keyed by column name. Standard
+            columns not passed are filled with their default value.
+
+    """
+
+    def __init__(self, n=None, **columns):
+        if n is None:
+            n = len(next(iter(columns.values()))) if columns else 0
+
+        cols = collections.OrderedDict()
+        for name, (dtype, default) in COLUMNS.items():
+            if name in columns:
+                cols[name] = _column(columns.pop(name), dtype, n, name)
+            else:
+                cols[name] = np.full(n, default, dtype=dtype)
+        for name, values in columns.items():
+            values = np.asarray(values)
+            cols[name] = _column(values, values.dtype, n, name)
+
+        object.__setattr__(self, '_cols', cols)
+
+    @classmethod
+    def fromFeatures(cls, features, columns=None):
+        """Make a table from feature objects.
+
+        Args:
+            features (iterable): Objects with attributes named like the
+                standard columns, such as DisplotDataFeature instances.
+            columns (dict): Additional columns to read from the attributes
+                of the same name, as a dtype keyed by column name. Objects
+                without the attribute get a zero.
+
+        Returns:
+            FeatureTable: New table.
+
+        """
+        features = list(features)
+        cols = {
+            name: np.array([getattr(f, name) for f in features],
+                dtype=dtype)
+            for name, (dtype, _) in COLUMNS.items()
+        }
+        for name, dtype in (columns or {}).items():
+            cols[name] = np.array([getattr(f, name, 0) for f in features],
+                dtype=dtype)
+        return cls(len(features), **cols)
+
+    @classmethod
+    def fromDicts(cls, rows):
+        """Make a table from dicts keyed by column name.
+
+        Args:
+            rows (list): One dict per feature. Missing standard columns are
+                filled with their default value.
+
+        Returns:
+            FeatureTable: New table.
+
+        """
+        names = list(COLUMNS)
+        for row in rows:
+            names.extend(k for k in row if k not in names)
+        cols = {}
+        for name in names:
+            default = COLUMNS.get(name, (None, 0))[1]
+            cols[name] = [row.get(name, default) for row in rows]
+        return cls(len(rows), **cols)
+
+    @classmethod
+    def concatenate(cls, tables):
+        """Join tables end to end.
+
+        Columns missing from some of the tables are filled with their
+        default value, or with zeros if they are not standard columns.
+
+        Args:
+            tables (iterable): FeatureTable instances.
+
+        Returns:
+            FeatureTable: New table.
+
+        """
+        tables = [t for t in tables]
+        names = []
+        for t in tables:
+            names.extend(k for k in t.columns if k not in names)
+
+        cols = {}
+        for name in names:
+            parts = []
+            dtype = next(t[name].dtype for t in tables if name in t.columns)
+            for t in tables:
+                if name in t.columns:
+                    parts.append(t[name])
+                else:
+                    default = COLUMNS.get(name, (None, 0))[1]
+                    parts.append(np.full(len(t), default, dtype=dtype))
+            cols[name] = np.concatenate(parts) if parts else []
+        return cls(sum(len(t) for t in tables), **cols)
+
+    @property
+    def columns(self):
+        """collections.OrderedDict: Column arrays keyed by name."""
+        return self._cols
+
+    def addColumn(self, name, dtype, default=0):
+        """Add a column filled with a default value.
+
+        Args:
+            name (str): Column name.
+            dtype (numpy.dtype): Column type.
+            default: Initial value of every feature.
+
+        Returns:
+            None
+
+        """
+        if name in self._cols:
+            raise ValueError('Column `{0}` already exists.'.format(name))
+        self._cols[name] = np.full(len(self), default, dtype=dtype)
+
+    def copy(self):
+        """Return a copy of the table with all columns held in memory.
+
+        Returns:
+            FeatureTable: New table.
+
+        """
+        return FeatureTable(len(self), **{
+            k: np.array(v) for k, v in self._cols.items()})
+
+    def toDicts(self):
+        """Return the features as a list of dicts of Python values.
+
+        Returns:
+            list: One dict per feature, keyed by column name.
+
+        """
+        names = list(self._cols)
+        rows = zip(*(self._cols[k].tolist() for k in names))
+        return [dict(zip(names, row)) for row in rows]
+
+    def __len__(self):
+        return len(self._cols['x'])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield FeatureView(self, i)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._cols[key]
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError('Feature index out of range.')
+            return FeatureView(self, int(key))
+        cols = {k: v[key] for k, v in self._cols.items()}
+        return FeatureTable(len(cols['x']), **cols)
+
+    def __setitem__(self, key, values):
+        if not isinstance(key, str):
+            raise TypeError('Only whole columns can be assigned.')
+        dtype = COLUMNS[key][0] if key in COLUMNS else np.asarray(
+            values).dtype
+        self._cols[key] = _column(values, dtype, len(self), key)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_cols'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, values):
+        if name in self._cols:
+            self[name] = values
+        else:
+            object.__setattr__(self, name, values)
+
+    def __repr__(self):
+        return 'FeatureTable({0} features, columns: {1})'.format(
+            len(self), ', '.join(self._cols))
+
+
+class FeatureView(object):
+    """Access to a single feature of a FeatureTable.
+
+    Reading and setting attributes reads and writes the table columns.
+
+    Args:
+        table (FeatureTable): Table holding the feature.
+        i (int): Index of the feature in the table.
+
+    """
+
+    __slots__ = ('_table', '_i')
+
+    def __init__(self, table, i):
+        object.__setattr__(self, '_table', table)
+        object.__setattr__(self, '_i', i)
+
+    def __getattr__(self, name):
+        try:
+            return self._table.columns[name][self._i].item()
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name not in self._table.columns:
+            raise AttributeError(name)
+        self._table.columns[name][self._i] = value
+
+    def __eq__(self, o):
+        if not all(hasattr(o, k) for k in ('x', 'y', 'r')):
+            return False
+        return (self.x == o.x and self.y == o.y and self.r == o.r)
+
+    def toDict(self):
+        return {k: v[self._i].item() for k, v in self._table.columns.items()}
+
+
+def _column(values, dtype, n, name):
+    """Return values as a column array of a given type and length."""
+    values = np.asarray(values)
+    if values.dtype != dtype:
+        values = values.astype(dtype)
+    if values.shape != (n,):
+        raise ValueError('Column `{0}` has shape {1}, expected ({2},).'
+            .format(name, values.shape, n))
+    return values
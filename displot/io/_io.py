@@ -7,17 +7,46 @@ University of Strathclyde Physics Department
 
 import os
 import io
-import csv
+import gc
 import json
+import logging
+import hashlib
 import tarfile
 import time
 
 import numpy as np
 import imageio
+# The standalone package is tried first, because importing the copy bundled
+# with older scikit-image versions loads scikit-image as a whole.
 try:
-    import skimage.external.tifffile as tifffile
-except ImportError:
     import tifffile
+except ImportError:
+    import skimage.external.tifffile as tifffile
+
+from ._tiff import open_tiff, TiffStack
+
+log = logging.getLogger('displot')
+
+# Archive member holding the prediction map.
+FN_PREDICTION = 'dp_prediction.tif'
+
+# Version 1 archives store the markers in dp.json. Version 2 archives store
+# every marker attribute as an uncompressed .npy member, so that loading
+# needs no parsing and the columns can be memory-mapped from the archive.
+DP_VERSION = 2
+FN_MARKER_COLUMN = 'dp_markers_{0}.npy'
+
+# Archive members holding the image when it is streamed from memory rather
+# than copied from its source file.
+FN_IMAGE = 'dp_image.npy'
+FN_IMAGE_COMPRESSED = 'dp_image.tif'
+# Rows of the image written to an archive at once.
+STREAM_ROWS = 256
+# Tile shape of compressed embedded images.
+TILE_SHAPE = (256, 256)
+# Hash algorithm of image references, and the block size files are read in.
+DIGEST_ALGORITHM = 'sha256'
+DIGEST_BLOCK = 1024 * 1024
 
 
 def _load_image(path, obj):
@@ -42,22 +71,23 @@ def _load_image(path, obj):
     obj.image_path = path
 
     if ext == '.tiff' or ext == '.tif':
-        with tifffile.TiffFile(path) as tif:
-            obj.image = tif.asarray()
-            obj.image_meta = {}
-            for f in tif.flags:
-                obj.image_meta[f] = getattr(tif, f + '_metadata')
+        # Not read into memory, see open_tiff()
+        obj.image, obj.image_meta = open_tiff(path)
+        stack = TiffStack(path)
+        if len(stack) > 1:
+            log.info('Opened frame 1 of {0} in "{1}".'.format(
+                len(stack), path))
+            obj.frames = stack
 
     elif ext == '.png':
         obj.image = imageio.imread(path)
+        # strip all channels except the first one
+        if len(obj.image.shape) > 2:
+            obj.image = np.copy(obj.image[:, :, 0])
 
     else:
         raise RuntimeError(path)
 
-    # strip all channels except the first one
-    if len(obj.image.shape) > 2:
-        obj.image = np.copy(obj.image[:, :, 0])
-
     return obj
 
 
@@ -72,59 +102,476 @@ def _load_dpfile(path, obj):
         io.DisplotData: Displot data object.
 
     """
-    a = tarfile.open(path, 'r')
-    objjson_f = a.extractfile('dp.json')
-    objjson = json.loads(str(objjson_f.read(), 'ascii'))
-    obj.fromDict(objjson)
-
-    image_f = a.extractfile(os.path.basename(objjson['image_path']))
-    with tifffile.TiffFile(image_f) as tif:
-        obj.image = tif.asarray()
+    from . import MARKER_COLUMNS
+
+    with tarfile.open(path, 'r') as a:
+        objjson_f = a.extractfile('dp.json')
+        objjson = json.loads(str(objjson_f.read(), 'ascii'))
+        version = objjson.get('version', 1)
+        if version > DP_VERSION:
+            raise ValueError('Displot data file version {0} is not '
+                'supported.'.format(version))
+        obj.fromDict(objjson)
+
+        if version >= 2:
+            # Copy-on-write, so that features can be edited in place.
+            names = objjson.get('marker_columns', MARKER_COLUMNS)
+            obj.fromColumns({k: _read_npy_member(
+                path, a.getmember(FN_MARKER_COLUMN.format(k)), 'c')
+                for k in names})
+
+        ref = objjson.get('image_ref')
+        if ref is not None:
+            ref_obj = _load_reference(path, ref)
+            obj.image_path = ref_obj.image_path
+            obj.image = ref_obj.image
+            obj.frames = ref_obj.frames
+        else:
+            # Stored uncompressed in the archive, so the image can be
+            # opened in place like a standalone file.
+            image_info = a.getmember(objjson.get(
+                'image_member', os.path.basename(objjson['image_path'])))
+            if image_info.name.endswith('.npy'):
+                obj.image = _read_npy_member(path, image_info, 'c')
+            else:
+                obj.image = open_tiff(
+                    path, image_info.offset_data, image_info.size)[0]
+
+        if FN_PREDICTION in a.getnames():
+            with tifffile.TiffFile(a.extractfile(FN_PREDICTION)) as tif:
+                obj.prediction = tif.asarray()
+        else:
+            obj.prediction = None
+            obj.prediction_meta = None
 
     return obj
 
 
-def _save_dpfile(path, obj):
+def _load_reference(path, ref):
+    """Open the image a displot data file refers to.
+
+    The image is looked for at the path it was saved with, and then next
+    to the data file, in case both have been moved together. The first
+    file matching the stored digest is opened.
+
+    Args:
+        path (str): Path to the displot data file.
+        ref (dict): Image reference. See _image_reference().
+
+    Returns:
+        io.DisplotData: Data object holding only the image.
+
+    """
+    from . import DisplotData
+
+    candidates = [ref['path'], os.path.join(
+        os.path.dirname(os.path.abspath(path)),
+        os.path.basename(ref['path']))]
+    changed = []
+    for p in candidates:
+        if not os.path.isfile(p) or p in changed:
+            continue
+        if _reference_digest(p, ref) != ref['digest']:
+            changed.append(p)
+            continue
+        return _load_image(p, DisplotData())
+
+    if changed:
+        raise ValueError('Image referenced by "{0}" has changed since it '
+            'was saved: {1}'.format(path, ', '.join(changed)))
+    raise FileNotFoundError('Image referenced by "{0}" not found at: '
+        '{1}'.format(path, ', '.join(candidates)))
+
+
+def _read_npy_member(path, info, mode='r'):
+    """Memory-map an uncompressed .npy member of a tar archive.
+
+    Args:
+        path (str): Path to the archive.
+        info (tarfile.TarInfo): Archive member.
+        mode (str): Memory map mode, 'r' for a read-only array or 'c' for
+            copy-on-write.
+
+    Returns:
+        numpy.ndarray: Mapped array.
+
+    """
+    with open(path, 'rb') as f:
+        f.seek(info.offset_data)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        else:
+            header = np.lib.format.read_array_header_2_0(f)
+        shape, fortran, dtype = header
+        offset = f.tell()
+
+    if dtype.hasobject:
+        raise ValueError('Archive member `{0}` holds Python objects.'.format(
+            info.name))
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode=mode, offset=offset,
+        shape=shape, order='F' if fortran else 'C')
+
+
+def _save_dpfile(path, obj, prediction=True, image='embed',
+    compress=False
+):
     """Save a displot data object as a file to disk.
 
     Args:
         path (str): Path to image.
         obj (io.DisplotData): Data object to populate with the data.
+        prediction (bool): If True and the data object has a prediction map,
+            it is stored as a compressed TIFF member.
+        image (str): 'embed' streams the image of the data object into the
+            archive. 'reference' only stores the path to the image file
+            and a digest of it, so the image is only read to hash it,
+            never copied. Falls back to 'embed' if the image file is missing.
+        compress (bool): If True, an embedded image is stored as a tiled
+            zlib compressed TIFF, otherwise as an uncompressed .npy member
+            that can be memory-mapped on load.
 
     Returns:
         None
 
     """
-    objjson = bytes(json.dumps(obj.toDict()), 'ascii')
+    if image not in ('embed', 'reference'):
+        raise ValueError('Unknown image storage mode: {0}'.format(image))
+
+    columns = obj.toColumns()
+    objdict = obj.toDict(markers=False)
+    objdict['version'] = DP_VERSION
+    objdict['marker_columns'] = list(columns)
+    if prediction is False or obj.prediction is None:
+        objdict['prediction_meta'] = None
+
+    if image == 'reference':
+        if obj.image_path is not None and os.path.isfile(obj.image_path):
+            objdict['image_path'] = os.path.abspath(obj.image_path)
+            objdict['image_ref'] = _image_reference(obj.image_path)
+        else:
+            log.warning('Image file "{0}" not found, embedding the image '
+                'instead of referencing it.'.format(obj.image_path))
+            image = 'embed'
+    if image == 'embed' and obj.frames is not None:
+        log.warning('Only the first frame of "{0}" is embedded.'.format(
+            obj.image_path))
+    if image == 'embed':
+        objdict['image_member'] = (
+            FN_IMAGE_COMPRESSED if compress is True else FN_IMAGE)
+    objjson = bytes(json.dumps(objdict), 'ascii')
+    mtime = int(time.time())
+
+    # Written next to the destination first, because the image and markers
+    # of a loaded archive are mapped from the file being replaced.
+    tmp = path + '.part'
+    try:
+        with open(tmp, 'w+b') as f:
+            if image == 'embed' and compress is True:
+                _add_tiff_member(f, FN_IMAGE_COMPRESSED, obj.image, mtime)
+            # Archive members are written after the compressed image.
+            with tarfile.open(fileobj=f, mode='w') as a:
+                if image == 'embed' and compress is False:
+                    stream = _NpyStream(obj.image)
+                    a.addfile(tarinfo=_member(FN_IMAGE, stream.size, mtime),
+                        fileobj=stream)
+
+                a.addfile(tarinfo=_member('dp.json', len(objjson), mtime),
+                    fileobj=io.BytesIO(objjson))
+                for k, col in columns.items():
+                    buf = io.BytesIO()
+                    np.lib.format.write_array(buf, col, allow_pickle=False)
+                    info = _member(
+                        FN_MARKER_COLUMN.format(k), buf.tell(), mtime)
+                    buf.seek(0)
+                    a.addfile(tarinfo=info, fileobj=buf)
+                if prediction is True and obj.prediction is not None:
+                    pred = _tiff_bytes(obj.prediction.astype(np.uint8))
+                    a.addfile(tarinfo=_member(
+                        FN_PREDICTION, len(pred), mtime),
+                        fileobj=io.BytesIO(pred))
+    except BaseException:
+        os.remove(tmp)
+        raise
+    _replace(tmp, path, obj)
+    obj.image_ref = objdict.get('image_ref')
+
+
+def _member(name, size, mtime):
+    """Return the header of a regular file archive member."""
+    info = tarfile.TarInfo(name=name)
+    info.size = size
+    info.type = tarfile.REGTYPE
+    info.mtime = mtime
+    info.mode = 0o0755
+    return info
+
+
+def _add_tiff_member(f, name, image, mtime):
+    """Write an image to a tar archive as a tiled, compressed TIFF member.
+
+    Tiles are encoded straight into the archive, a block of rows at a time,
+    so the image is never copied as a whole. The size of the member is only
+    known once the image is encoded, so its header is written last.
 
-    objjson_info = tarfile.TarInfo(name='dp.json')
-    objjson_info.size = len(objjson)
-    objjson_info.type = tarfile.REGTYPE
-    objjson_info.mtime = int(time.time())
-    objjson_info.mode = 0o0755
+    Args:
+        f (file): Seekable binary file object, positioned where the member
+            is to start.
+        name (str): Member name.
+        image (numpy.ndarray): Image, or any object with shape and dtype
+            attributes supporting row slicing.
+        mtime (int): Member modification time.
+
+    Returns:
+        None
+
+    """
+    start = f.tell()
+    f.write(bytes(tarfile.BLOCKSIZE))
+    _write_tiff(f, lambda: _image_tiles(image, TILE_SHAPE), tile=TILE_SHAPE,
+        shape=tuple(image.shape), dtype=image.dtype)
 
-    a = tarfile.open(path, 'w')
-    a.add(obj.image_path, os.path.basename(obj.image_path))
-    a.addfile(tarinfo=objjson_info, fileobj=io.BytesIO(objjson))
-    # a.list()
-    a.close()
+    f.seek(0, os.SEEK_END)
+    size = f.tell() - start - tarfile.BLOCKSIZE
+    f.write(bytes(-size % tarfile.BLOCKSIZE))
+    end = f.tell()
+    f.seek(start)
+    f.write(_member(name, size, mtime).tobuf())
+    f.seek(end)
 
 
-def _save_csv(path, obj):
-    """Save data object features as a CSV file.
+def _image_tiles(image, tile):
+    """Yield the tiles of an image in row-major order.
+
+    Tiles at the right and bottom edges are zero padded to the full tile
+    shape.
 
     Args:
-        path (str): Path to image.
-        obj (io.DisplotData): Data object to populate with the data.
+        image (numpy.ndarray): Image, or any object with shape and dtype
+            attributes supporting row slicing.
+        tile (tuple): Tile shape in (height, width) format.
+
+    Yields:
+        numpy.ndarray: Tile.
+
+    """
+    h, w = image.shape[:2]
+    for y in range(0, h, tile[0]):
+        rows = np.asarray(image[y:y + tile[0]])
+        for x in range(0, w, tile[1]):
+            t = rows[:, x:x + tile[1]]
+            if t.shape[:2] != tuple(tile):
+                padded = np.zeros(tuple(tile) + t.shape[2:], dtype=t.dtype)
+                padded[:t.shape[0], :t.shape[1]] = t
+                t = padded
+            yield np.ascontiguousarray(t)
+
+
+class _NpyStream(object):
+    """Read-only file object producing an image in .npy format.
+
+    The image is read a block of rows at a time, so it is never copied as
+    a whole, and lazily loaded images are only decoded a block at a time.
+
+    Args:
+        image (numpy.ndarray): Image, or any object with shape and dtype
+            attributes supporting row slicing.
+
+    Attributes:
+        size (int): Total number of bytes produced.
+
+    """
+
+    def __init__(self, image):
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header, {
+            'descr': np.lib.format.dtype_to_descr(np.dtype(image.dtype)),
+            'fortran_order': False,
+            'shape': tuple(image.shape)
+        })
+        self.size = header.tell() + int(
+            np.prod(image.shape)) * np.dtype(image.dtype).itemsize
+
+        self._image = image
+        self._buf = bytearray(header.getvalue())
+        self._row = 0
+
+    def read(self, n=-1):
+        while (n < 0 or len(self._buf) < n) and (
+            self._row < self._image.shape[0]
+        ):
+            block = np.ascontiguousarray(
+                self._image[self._row:self._row + STREAM_ROWS])
+            self._buf += block.data
+            self._row += STREAM_ROWS
+        if n < 0:
+            n = len(self._buf)
+        ret = bytes(self._buf[:n])
+        del self._buf[:n]
+        return ret
+
+
+def _image_reference(path):
+    """Describe an image file so that it can be found and checked later.
+
+    Args:
+        path (str): Path to the image file.
+
+    Returns:
+        dict: Absolute path, size and digest of the file, and the name of
+            the hash algorithm.
+
+    """
+    return {
+        'path': os.path.abspath(path),
+        'size': os.path.getsize(path),
+        'algorithm': DIGEST_ALGORITHM,
+        'digest': _file_digest(path, DIGEST_ALGORITHM)
+    }
+
+
+def _reference_digest(path, ref):
+    """Return the digest of a file the way an image reference was made.
+
+    Args:
+        path (str): Path to the file.
+        ref (dict): Image reference. See _image_reference().
+
+    Returns:
+        str: Hexadecimal hash.
+
+    """
+    if 'algorithm' not in ref:
+        # References made before the algorithm was recorded.
+        return _sampled_digest(path)
+    return _file_digest(path, ref['algorithm'])
+
+
+def _file_digest(path, algorithm=DIGEST_ALGORITHM):
+    """Return a hash of the contents of a file.
+
+    The file is read a block at a time, so memory use does not depend on
+    its size, but the whole file is read.
+
+    Args:
+        path (str): Path to the file.
+        algorithm (str): Name of a hashlib algorithm.
+
+    Returns:
+        str: Hexadecimal hash.
+
+    """
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(DIGEST_BLOCK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _sampled_digest(path, samples=16, block=64 * 1024):
+    """Return a hash of the size and evenly spaced blocks of a file.
+
+    Only used to check image references made before whole files were
+    hashed. Changes between the sampled blocks go unnoticed.
+
+    Args:
+        path (str): Path to the file.
+        samples (int): Number of blocks to read.
+        block (int): Block size in bytes.
+
+    Returns:
+        str: Hexadecimal SHA-256 hash.
+
+    """
+    size = os.path.getsize(path)
+    h = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        if size <= samples * block:
+            h.update(f.read())
+        else:
+            for i in range(samples):
+                f.seek((size - block) * i // (samples - 1))
+                h.update(f.read(block))
+    return h.hexdigest()
+
+
+def _replace(src, dst, obj):
+    """Move a finished file over one a data object may have mapped.
+
+    Args:
+        src (str): Path to the finished file.
+        dst (str): Destination path.
+        obj (io.DisplotData): Data object that may hold an image mapped
+            from the destination.
 
     Returns:
         None
 
     """
-    objdict = obj.toDict()
+    try:
+        os.replace(src, dst)
+    except PermissionError:
+        # Windows does not allow replacing files that are mapped or open,
+        # so the image and markers are read into memory first.
+        image = obj.image
+        obj.image = np.array(image)
+        obj.markers = obj.markers.copy()
+        if hasattr(image, 'close'):
+            image.close()
+        del image
+        gc.collect()
+        os.replace(src, dst)
+
+
+def _tiff_bytes(data):
+    """Encode an array as a zlib compressed TIFF file.
 
-    with open(path, mode='w') as f:
-        writer = csv.DictWriter(f, fieldnames=objdict['markers'][0].keys())
-        writer.writeheader()
-        for row in objdict['markers']:
-            writer.writerow(row)
+    Args:
+        data (numpy.ndarray): Array to encode.
+
+    Returns:
+        bytes: TIFF file contents.
+
+    """
+    buf = io.BytesIO()
+    _write_tiff(buf, data)
+    return buf.getvalue()
+
+
+def _write_tiff(f, data, tile=None, shape=None, dtype=None):
+    """Write an array to a file object as a zlib compressed TIFF file.
+
+    Args:
+        f (file): Seekable binary file object, positioned where the file is
+            to start.
+        data (numpy.ndarray): Array to encode. If shape and dtype are set,
+            a function returning an iterator of the tiles of the array
+            instead. It is called again if encoding has to be retried.
+        tile (tuple): Tile shape in (height, width) format. If None, the
+            image is stored in strips.
+        shape (tuple): Array shape, if data returns tiles.
+        dtype (numpy.dtype): Array type, if data returns tiles.
+
+    Returns:
+        None
+
+    """
+    kwargs = {}
+    if tile is not None:
+        kwargs['tile'] = tile
+    if shape is not None:
+        kwargs.update(shape=shape, dtype=dtype)
+
+    def arg():
+        return data() if shape is not None else data
+
+    start = f.tell()
+    try:
+        tifffile.imwrite(f, arg(), compression='zlib', **kwargs)
+    except (AttributeError, TypeError):
+        # Older tifffile versions
+        f.seek(start)
+        f.truncate()
+        tifffile.imsave(f, arg(), compress=6, **kwargs)
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""displot - Lazily loaded TIFF images.
+
+Large stitched scans are not read into memory when opened. Uncompressed
+images stored contiguously are memory-mapped, and tiled or compressed
+images are decoded one tile or strip at a time as regions are read.
+Only the first channel is exposed, as a view where possible. Multi-page
+files, such as tilt series, are opened as a TiffStack of such images, one
+frame at a time.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import threading
+import collections
+
+import numpy as np
+try:
+    import tifffile
+except ImportError:
+    import skimage.external.tifffile as tifffile
+
+# Number of decoded tiles or strips kept per image, at least.
+SEGMENT_CACHE = 64
+
+
+def open_tiff(path, offset=None, size=None, page=0):
+    """Open a page of a TIFF file without reading it into memory.
+
+    Args:
+        path (str): Path to the TIFF file, or to a file containing it.
+        offset (int): Position of the TIFF data within the file.
+        size (int): Size of the TIFF data within the file.
+        page (int): Index of the page to open.
+
+    Returns:
+        tuple: (numpy.ndarray or TiffImage: first channel of the image,
+            dict: TIFF metadata)
+
+    """
+    tif = tifffile.TiffFile(path, offset=offset, size=size)
+    try:
+        meta = {}
+        for f in tif.flags:
+            meta[f] = getattr(tif, f + '_metadata', None)
+        index = page
+        page = tif.pages[index]
+
+        image = _memmap(path, offset or 0, page, tif.byteorder)
+        if image is None and TiffImage.supports(page):
+            return TiffImage(tif, index), meta
+        if image is None:
+            data = page.asarray()
+            image = _first_channel(data, page)
+            if image is not data:
+                # Do not keep the other channels in memory.
+                image = np.copy(image)
+    except Exception:
+        tif.close()
+        raise
+
+    tif.close()
+    return image, meta
+
+
+class TiffImage(object):
+    """Read-only 2D image decoding tiles or strips of a TIFF page on demand.
+
+    Supports basic slicing, and conversion to a NumPy array, which decodes
+    the whole image. Recently decoded tiles are cached, so reading
+    overlapping sliding windows in row order decodes every tile once.
+
+    Args:
+        tif (tifffile.TiffFile): Open TIFF file. Closed by close().
+        index (int): Index of the page to read.
+
+    Attributes:
+        shape (tuple): Image shape in (height, width) format.
+        dtype (numpy.dtype): Pixel data type.
+        ndim (int): Always 2.
+
+    """
+
+    ndim = 2
+
+    def __init__(self, tif, index=0):
+        self._tif = tif
+        self._page = page = tif.pages[index]
+
+        s = page.shaped
+        self.shape = (s[2], s[3])
+        self.dtype = np.dtype(page.dtype)
+
+        if page.is_tiled:
+            self._seg = (page.tilelength, page.tilewidth)
+        else:
+            self._seg = (min(page.rowsperstrip, self.shape[0]), self.shape[1])
+        self._across = -(-self.shape[1] // self._seg[1])
+
+        self._decode = page.decode
+        self._cache = collections.OrderedDict()
+        self._cache_max = max(SEGMENT_CACHE, 3 * self._across)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def supports(page):
+        """Check if the pages of a TIFF file can be decoded on demand.
+
+        Args:
+            page (tifffile.TiffPage): Page to read.
+
+        Returns:
+            bool: True if a TiffImage can be made of the page.
+
+        """
+        return (callable(getattr(page, 'decode', None))
+            and page.shaped[1] == 1 and len(page.dataoffsets) > 1)
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 2:
+            raise IndexError('Too many indices for a 2D image.')
+        key = key + (slice(None),) * (2 - len(key))
+
+        bounds = []
+        squeeze = []
+        steps = []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                if step < 0:
+                    start, stop = stop + 1, start + 1
+                bounds.append((start, max(start, stop)))
+                steps.append(step)
+                squeeze.append(False)
+            else:
+                k = int(k) + n if int(k) < 0 else int(k)
+                if not 0 <= k < n:
+                    raise IndexError('Index {0} is out of bounds.'.format(k))
+                bounds.append((k, k + 1))
+                steps.append(1)
+                squeeze.append(True)
+
+        ret = self.read(bounds[0][0], bounds[0][1], bounds[1][0],
+            bounds[1][1])
+        if steps[0] < 0:
+            ret = ret[::-1]
+        if steps[1] < 0:
+            ret = ret[:, ::-1]
+        ret = ret[::abs(steps[0]), ::abs(steps[1])]
+        return ret[tuple(0 if s else slice(None) for s in squeeze)]
+
+    def __array__(self, dtype=None, copy=None):
+        ret = self.read(0, self.shape[0], 0, self.shape[1])
+        if dtype is not None:
+            ret = ret.astype(dtype, copy=False)
+        return ret
+
+    def read(self, y1, y2, x1, x2):
+        """Decode a rectangular region of the image.
+
+        Args:
+            y1 (int): First row.
+            y2 (int): Row after the last one.
+            x1 (int): First column.
+            x2 (int): Column after the last one.
+
+        Returns:
+            numpy.ndarray: Region of the image.
+
+        """
+        ret = np.empty((max(y2 - y1, 0), max(x2 - x1, 0)), dtype=self.dtype)
+        if ret.size == 0:
+            return ret
+
+        sh, sw = self._seg
+        for r in range(y1 // sh, (y2 - 1) // sh + 1):
+            for c in range(x1 // sw, (x2 - 1) // sw + 1):
+                seg = self._segment(r * self._across + c)
+                sy, sx = r * sh, c * sw
+                y1_, y2_ = max(y1, sy), min(y2, sy + seg.shape[0])
+                x1_, x2_ = max(x1, sx), min(x2, sx + seg.shape[1])
+                if y2_ <= y1_ or x2_ <= x1_:
+                    continue
+                ret[y1_ - y1:y2_ - y1, x1_ - x1:x2_ - x1] = \
+                    seg[y1_ - sy:y2_ - sy, x1_ - sx:x2_ - sx]
+        return ret
+
+    def close(self):
+        """Close the underlying TIFF file.
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            self._cache.clear()
+            self._tif.close()
+
+    def _segment(self, i):
+        """Return a decoded tile or strip, first channel only."""
+        with self._lock:
+            if i in self._cache:
+                self._cache.move_to_end(i)
+                return self._cache[i]
+
+            page = self._page
+            fh = self._tif.filehandle
+            fh.seek(page.dataoffsets[i])
+            data = fh.read(page.databytecounts[i])
+            seg = self._decode(data, i, jpegtables=page.jpegtables)[0]
+            seg = np.asarray(seg)
+            seg = np.copy(seg.reshape(seg.shape[-3:])[:, :, 0])
+
+            self._cache[i] = seg
+            while len(self._cache) > self._cache_max:
+                self._cache.popitem(last=False)
+            return seg
+
+
+class TiffStack(object):
+    """Multi-page TIFF file whose frames are opened one at a time.
+
+    Frames are the pages with the same shape and type as the first one, so
+    reduced resolution copies and thumbnails are skipped. Indexing opens a
+    frame like open_tiff() does, and nothing is kept open in between.
+
+    Args:
+        path (str): Path to the TIFF file.
+
+    Attributes:
+        shape (tuple): Stack shape in (frames, height, width) format.
+        dtype (numpy.dtype): Pixel data type.
+        path
+
+    """
+
+    ndim = 3
+
+    def __init__(self, path):
+        self.path = path
+        with tifffile.TiffFile(path) as tif:
+            first = tif.pages[0]
+            self._pages = [i for i, page in enumerate(tif.pages)
+                if page.shaped == first.shaped and page.dtype == first.dtype
+                and not getattr(page, 'is_reduced', False)]
+            s = first.shaped
+            self.shape = (len(self._pages), s[2], s[3])
+            self.dtype = np.dtype(first.dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, i):
+        if not isinstance(i, (int, np.integer)):
+            raise TypeError('Frames can only be indexed one at a time.')
+        return self.frame(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.frame(i)
+
+    def frame(self, i):
+        """Open a frame of the stack.
+
+        Args:
+            i (int): Frame index.
+
+        Returns:
+            numpy.ndarray or TiffImage: First channel of the frame. A
+                TiffImage should be closed once no longer needed.
+
+        """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Frame index out of range.')
+        return open_tiff(self.path, page=self._pages[i])[0]
+
+
+def _memmap(path, offset, page, byteorder):
+    """Memory-map the first channel of an uncompressed contiguous page.
+
+    The mapping is copy-on-write, so the image can be modified in memory
+    without changing the file.
+
+    Args:
+        path (str): Path to the file.
+        offset (int): Position of the TIFF data within the file.
+        page (tifffile.TiffPage): Page to map.
+        byteorder (str): Byte order of the TIFF file.
+
+    Returns:
+        numpy.ndarray: First channel of the mapped image, or None if the
+            page cannot be memory-mapped.
+
+    """
+    if int(page.compression) != 1 or page.is_tiled:
+        return None
+    if int(getattr(page, 'fillorder', 1)) != 1:
+        return None
+
+    dtype = np.dtype(page.dtype)
+    if dtype.kind not in 'uif' or page.bitspersample % 8 != 0:
+        return None
+    dtype = dtype.newbyteorder(byteorder)
+
+    offsets = page.dataoffsets
+    counts = page.databytecounts
+    shape = page.shaped
+    if sum(counts) != int(np.prod(shape)) * dtype.itemsize:
+        return None
+    for i in range(1, len(offsets)):
+        if offsets[i - 1] + counts[i - 1] != offsets[i]:
+            return None
+
+    m = np.memmap(path, dtype=dtype, mode='c',
+        offset=offset + offsets[0], shape=shape)
+    return m[0, 0, :, :, 0]
+
+
+def _first_channel(image, page):
+    """Return the first channel of a decoded page as a view."""
+    if image.ndim == 2:
+        return image
+    if int(page.planarconfig) == 2:
+        return image[0]
+    return image[:, :, 0]
@@ -11,6 +11,15 @@ import tensorflow.keras.layers as L
 import numpy as np
 
 
+# Rough number of full resolution activation tensors alive at once while the
+# top level of the network is being evaluated, and an overhead multiplier for
+# convolution workspace buffers allocated by the framework.
+_WORKING_TENSORS = 4
+_WORKSPACE_OVERHEAD = 1.5
+
+# Context in pixels the network sees on each side of an image tile.
+PAD = 64
+
 es_callback = tf.keras.callbacks.EarlyStopping(
     monitor='val_loss',
     min_delta=1e-2,
@@ -122,9 +131,8 @@ def conv_residual_conv(feat_maps_out, act_fn, input):
     return conv_3
 
 
-def build(lr=0.001, input_shape=(640, 640, 1)):
+def build(lr=0.001, input_shape=(640, 640, 1), n_filters=32):
     inputs = L.Input(input_shape)
-    n_filters = 32
 
     def act_fn_encoder(input):
         return L.LeakyReLU(alpha=0.2)(input)
@@ -174,12 +182,46 @@ def build(lr=0.001, input_shape=(640, 640, 1)):
     return model
 
 
-def pack_data(X):
+def memory_footprint(input_shape=(640, 640, 1), n_filters=32, depth=4,
+    dtype_size=4
+):
+    """Estimate the peak activation memory needed to infer a single sample.
+
+    The encoder keeps the output of each level alive until the decoder
+    merges it back in, while the full resolution levels hold several
+    activation tensors at once. Both are accounted for.
+
+    Args:
+        input_shape (tuple): Network input shape in (height, width, channels)
+            format.
+        n_filters (int): Number of filters in the first encoder level.
+        depth (int): Number of encoder levels before the bridge.
+        dtype_size (int): Size of a single activation value in bytes.
+
+    Returns:
+        int: Estimated memory in bytes.
+
+    """
+    h, w, c = input_shape
+
+    # Every level halves the resolution and doubles the filters.
+    level_0 = h * w * n_filters
+    skips = sum(level_0 / 2**i for i in range(depth))
+    working = _WORKING_TENSORS * level_0
+    io = 2 * h * w * c
+
+    return int((skips + working + io) * dtype_size * _WORKSPACE_OVERHEAD)
+
+
+def pack_data(X, pad=True):
     """Convert array of images to machine trainable data.
 
     Args:
         X (numpy.ndarray): Image data represented as a single image
             or array of images.
+        pad (bool): If True, images are reflect padded by PAD pixels on
+            each side. Set to False if the images already include that much
+            context around them.
 
     Returns:
         numpy.ndarray: Transformed image data.
@@ -188,7 +230,8 @@ def pack_data(X):
     # scale image data to (0, 1)
     X = (X.astype('float32') / 255.0)
     # pad image
-    X = np.pad(X, ((0, 0), (64, 64), (64, 64)), 'reflect')
+    if pad is True:
+        X = np.pad(X, ((0, 0), (PAD, PAD), (PAD, PAD)), 'reflect')
     # add channel dimension
     X = np.expand_dims(X, axis=-1)
     return X
@@ -208,7 +251,7 @@ def unpack_data(X):
     # unpad image
     X_ = []
     for i in X:
-        X_.append(i[64:-64, 64:-64])
+        X_.append(i[PAD:-PAD, PAD:-PAD])
     X = np.array(X_)
     # clip image data to avoid out of bounds values
     X = np.clip(X, 0., 1.)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""displot - Detection pipeline profiling.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import sys
+import json
+import time
+import threading
+import contextlib
+import collections
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class StageProfiler(object):
+    """Record time and memory use of named processing stages.
+
+    Every stage may be entered any number of times, and its measurements
+    are accumulated. For each stage the wall time, the CPU time of this
+    process and the peak resident set size (RSS) of this process are kept.
+    Work done in other processes, such as blob detection workers, is only
+    counted in the wall time.
+
+    The peak RSS is the high-water mark of the process at the end of the
+    stage. The growth of the high-water mark during the stage is recorded
+    too, which attributes new memory peaks to the stage causing them.
+    Memory is not recorded on platforms without the resource module.
+
+    Attributes:
+        stages (collections.OrderedDict): Measurements by stage name, in the
+            order the stages were first entered.
+        counters (collections.OrderedDict): Counts by counter name.
+        info (dict): Free-form description of the profiled run.
+
+    """
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.info = {}
+
+        self._lock = threading.Lock()
+        self._start = (time.perf_counter(), time.process_time())
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measure the enclosed block as part of a stage.
+
+        Args:
+            name (str): Stage name.
+
+        Yields:
+            None
+
+        """
+        rss = peak_rss()
+        t, c = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - t
+            cpu = time.process_time() - c
+            rss_ = peak_rss()
+
+            with self._lock:
+                s = self.stages.setdefault(name, {
+                    'calls': 0, 'wall_s': 0., 'cpu_s': 0.,
+                    'peak_rss_mb': None, 'rss_growth_mb': None
+                })
+                s['calls'] += 1
+                s['wall_s'] += wall
+                s['cpu_s'] += cpu
+                if rss_ is not None:
+                    s['peak_rss_mb'] = max(s['peak_rss_mb'] or 0, rss_)
+                    s['rss_growth_mb'] = (s['rss_growth_mb'] or 0) + rss_ - rss
+
+    def iterate(self, name, iterable):
+        """Measure the time taken to produce every item of an iterable.
+
+        Useful for generators that do their work lazily.
+
+        Args:
+            name (str): Stage name.
+            iterable (iterable): Iterable to measure.
+
+        Yields:
+            Items of the iterable.
+
+        """
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, n=1):
+        """Increase a counter.
+
+        Args:
+            name (str): Counter name.
+            n (int): Amount to increase the counter by.
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def report(self):
+        """Return all measurements as a structure serialisable to JSON.
+
+        Returns:
+            dict: Report with 'info', 'stages', 'counters' and 'total' keys.
+
+        """
+        with self._lock:
+            return {
+                'info': dict(self.info),
+                'stages': collections.OrderedDict(
+                    (k, dict(v)) for k, v in self.stages.items()),
+                'counters': collections.OrderedDict(self.counters),
+                'total': {
+                    'wall_s': time.perf_counter() - self._start[0],
+                    'cpu_s': time.process_time() - self._start[1],
+                    'peak_rss_mb': peak_rss()
+                }
+            }
+
+    def summary(self):
+        """Format the measurements as human readable lines.
+
+        Returns:
+            list: List of strings, one per stage, counter and the total.
+
+        """
+        r = self.report()
+        fmt = '{0:<16} {1:>9.3f}s wall {2:>9.3f}s CPU {3}'
+
+        lines = []
+        for name, s in r['stages'].items():
+            lines.append(fmt.format(
+                name, s['wall_s'], s['cpu_s'], _format_rss(s)))
+        lines.append(fmt.format(
+            'total', r['total']['wall_s'], r['total']['cpu_s'],
+            _format_rss(r['total'])))
+        if len(r['counters']) > 0:
+            lines.append(', '.join(
+                '{0}: {1}'.format(k, v) for k, v in r['counters'].items()))
+        return lines
+
+    def save(self, path):
+        """Write the report to a JSON file.
+
+        Args:
+            path (str): Path to file.
+
+        Returns:
+            None
+
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def peak_rss():
+    """Return the peak resident set size of this process.
+
+    Returns:
+        float: Peak RSS in megabytes, or None if it is not available.
+
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux, but in bytes on macOS.
+    if sys.platform == 'darwin':
+        return rss / 1024**2
+    return rss / 1024
+
+
+def _format_rss(s):
+    if s.get('peak_rss_mb') is None:
+        return ''
+    ret = '{0:>8.0f} MB peak RSS'.format(s['peak_rss_mb'])
+    if s.get('rss_growth_mb'):
+        ret += ' (+{0:.0f} MB)'.format(s['rss_growth_mb'])
+    return ret
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""displot - Job progress reporting and cooperative cancellation.
+
+Long running jobs report their progress through a Progress object, which
+estimates the time remaining from the throughput measured so far, and poll
+a CancelToken between units of work. Setting the token from another thread
+makes the job raise Cancelled at the next check.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import time
+import logging
+import threading
+
+log = logging.getLogger('displot')
+
+
+class Cancelled(Exception):
+    """Raised by a job when its cancellation token has been set."""
+
+
+class CancelToken(object):
+    """Thread safe flag requesting a running job to stop.
+
+    Attributes:
+        cancelled (bool): True once cancel() has been called.
+
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        """Request the job to stop at its next check.
+
+        Returns:
+            None
+
+        """
+        self._event.set()
+
+    def check(self):
+        """Raise Cancelled if cancellation has been requested.
+
+        Returns:
+            None
+
+        """
+        if self._event.is_set():
+            raise Cancelled()
+
+
+def check(token):
+    """Raise Cancelled if a token has been set.
+
+    Args:
+        token (CancelToken): Cancellation token or None.
+
+    Returns:
+        None
+
+    """
+    if token is not None:
+        token.check()
+
+
+class Progress(object):
+    """Progress of a job made of a known number of work units.
+
+    Every advance() emits the progress percent and a status message with
+    the estimated time remaining through the signal object, if one is set.
+    The estimate assumes the remaining units take as long on average as
+    the ones done so far.
+
+    Args:
+        total (int): Number of work units.
+        signals (ui.WorkerSignals): Signal object or None.
+        label (str): Job description shown in status messages.
+        unit (str): Name of the work units shown in status messages.
+        span (tuple): Range of progress percent covered by the job,
+            in (start, end) format.
+
+    Attributes:
+        done (int): Number of work units done.
+        total
+        label
+        unit
+        span
+
+    """
+
+    def __init__(self, total, signals=None, label='Processing',
+        unit='tiles', span=(0, 100)
+    ):
+        self.total = max(total, 1)
+        self.label = label
+        self.unit = unit
+        self.span = span
+        self.done = 0
+
+        self._signals = signals
+        self._start = time.perf_counter()
+
+    @property
+    def percent(self):
+        """int: Progress percent within the span."""
+        f = min(self.done / self.total, 1.)
+        return int(self.span[0] + f * (self.span[1] - self.span[0]))
+
+    @property
+    def eta(self):
+        """float: Estimated seconds remaining, or None before any unit
+        has been done."""
+        if self.done == 0:
+            return None
+        elapsed = time.perf_counter() - self._start
+        return elapsed / self.done * max(self.total - self.done, 0)
+
+    def status(self):
+        """Return a status message describing the progress.
+
+        Returns:
+            str: Status message.
+
+        """
+        msg = '{0}: {1}/{2} {3}'.format(
+            self.label, self.done, self.total, self.unit)
+        eta = self.eta
+        if eta is not None and self.done < self.total:
+            msg += ', {0} remaining'.format(format_eta(eta))
+        return msg
+
+    def start(self):
+        """Restart the clock and emit the initial progress.
+
+        Returns:
+            None
+
+        """
+        self._start = time.perf_counter()
+        self._emit()
+
+    def advance(self, n=1):
+        """Mark work units as done and emit the progress.
+
+        Args:
+            n (int): Number of units done since the last call.
+
+        Returns:
+            None
+
+        """
+        self.done += n
+        self._emit()
+
+    def _emit(self):
+        if self._signals is None:
+            return
+        _emit(self._signals, 'progress', self.percent)
+        _emit(self._signals, 'status', self.status())
+
+
+def format_eta(seconds):
+    """Format a duration in seconds as a short human readable string.
+
+    Args:
+        seconds (float): Duration.
+
+    Returns:
+        str: Duration in '1h 02m', '3m 05s' or '12s' format.
+
+    """
+    seconds = int(round(seconds))
+    h, rem = divmod(seconds, 3600)
+    m, s = divmod(rem, 60)
+    if h > 0:
+        return '{0}h {1:02d}m'.format(h, m)
+    if m > 0:
+        return '{0}m {1:02d}s'.format(m, s)
+    return '{0}s'.format(s)
+
+
+def _emit(signals, name, value):
+    """Emit a signal of a signal object if it has one by that name."""
+    sig = getattr(signals, name, None)
+    if callable(sig) and hasattr(sig, 'emit'):
+        sig.emit(value)
@@ -6,58 +6,313 @@ University of Strathclyde Physics Department
 """
 
 import logging
+import threading
+import collections
 import numpy as np
 import tensorflow as tf
 
 import displot.models as models
 import displot.weights as weights
+import displot.tflite
+import displot.progress
+from displot.profiling import StageProfiler
 
 log = logging.getLogger('displot')
 
+# Memory budget for inference activations used when none is specified.
+DEFAULT_MEMORY_BUDGET_MB = 2048
 
-def predict(X, model_id, weights_id):
+
+class ModelRegistry(object):
+    """Process-wide store of loaded Keras models.
+
+    Loading a trained model from disk is expensive, so models are kept
+    resident after first use and handed out again on subsequent requests.
+    Models are evicted in least recently used order once the combined size
+    of their weights exceeds the memory cap.
+
+    Args:
+        max_memory (int): Memory cap in bytes for all resident models.
+            If None, models are never evicted automatically.
+
+    Attributes:
+        hits (int): Number of requests served from memory.
+        misses (int): Number of requests that required loading from disk.
+        max_memory
+
+    """
+
+    def __init__(self, max_memory=2 * 1024**3):
+        self.max_memory = max_memory
+        self.hits = 0
+        self.misses = 0
+
+        self._models = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    @property
+    def memory(self):
+        """int: Combined weight size of all resident models in bytes."""
+        with self._lock:
+            return sum(m[1] for m in self._models.values())
+
+    def get(self, model_id, iter_id=None):
+        """Return a trained model, loading it from disk if not resident.
+
+        Args:
+            model_id (str): The identifier of the model used for generating
+                the weights.
+            iter_id (str): Iteration identifier. If not set, the latest
+                iteration will be used.
+
+        Returns:
+            tensorflow.keras.Model: Trained Keras model.
+
+        """
+        if iter_id is None:
+            iter_id = weights.list_weights(model_id)[-1][1]
+        key = (model_id, iter_id)
+
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                self.hits += 1
+                log.info('Model registry hit: {0} ({1}).'.format(*key))
+                return self._models[key][0]
+
+            self.misses += 1
+            log.info('Model registry miss: {0} ({1}).'.format(*key))
+            model_nn = weights.load_weights(model_id, iter_id, compile=False)
+            self._models[key] = (model_nn, _model_size(model_nn))
+            self._evict(keep=key)
+            return model_nn
+
+    def put(self, model_nn, model_id, iter_id):
+        """Make an already built model resident under the given identifiers.
+
+        Allows models that do not come from a weights file, such as randomly
+        initialised ones, to be used with predict().
+
+        Args:
+            model_nn (tensorflow.keras.Model): Keras model.
+            model_id (str): Model identifier to register the model under.
+            iter_id (str): Iteration identifier to register the model under.
+
+        Returns:
+            None
+
+        """
+        key = (model_id, iter_id)
+        with self._lock:
+            self._models[key] = (model_nn, _model_size(model_nn))
+            self._models.move_to_end(key)
+            self._evict(keep=key)
+
+    def unload(self, model_id=None, iter_id=None):
+        """Remove resident models from the registry.
+
+        Args:
+            model_id (str): Only unload models with this identifier.
+                If None, all models are unloaded.
+            iter_id (str): Only unload the model with this iteration
+                identifier. Ignored if model_id is None.
+
+        Returns:
+            int: Number of models unloaded.
+
+        """
+        with self._lock:
+            keys = [k for k in self._models
+                if model_id is None
+                or (k[0] == model_id and iter_id in (None, k[1]))]
+            for k in keys:
+                del self._models[k]
+                log.debug('Model registry unloaded: {0} ({1}).'.format(*k))
+
+        return len(keys)
+
+    def _evict(self, keep=None):
+        """Unload least recently used models until under the memory cap.
+
+        Args:
+            keep (tuple): Registry key that must not be evicted.
+
+        Returns:
+            None
+
+        """
+        if self.max_memory is None:
+            return
+
+        while self.memory > self.max_memory:
+            key = next((k for k in self._models if k != keep), None)
+            if key is None:
+                log.warning('Model ({0}, {1}) exceeds the model registry '
+                    'memory cap.'.format(*keep))
+                break
+            del self._models[key]
+            log.info('Model registry evicted: {0} ({1}).'.format(*key))
+
+
+registry = ModelRegistry()
+
+
+def unload(model_id=None, iter_id=None):
+    """Unload models kept resident by the process-wide model registry.
+
+    See ModelRegistry.unload() for the argument description.
+
+    Returns:
+        int: Number of models unloaded.
+
+    """
+    return registry.unload(model_id, iter_id)
+
+
+def predict(
+    X, model_id, weights_id, batch_size=None, memory_budget_mb=None,
+    backend='keras', padded=False, profiler=None, cancel=None,
+    callback=None
+):
     """Output predictions for input samples using selected trained model.
 
+    Samples are packed, predicted and unpacked in batches, so only a single
+    batch is held in the network input format at any time.
+
     Args:
         X (numpy.ndarray): Input data to use for predictions.
         model_id (str): Model identifier in string format.
         weights_id (tuple): Weights file identifier in tuple of strings format.
             The tuple should be of the form: (model_id, iteration_id).
+        batch_size (int): Number of samples to predict at once. If not set,
+            it is derived from memory_budget_mb. See auto_batch_size().
+        memory_budget_mb (int): Memory available for inference activations
+            in megabytes. Ignored if batch_size is set.
+        backend (str): 'keras' predicts using the float32 Keras model.
+            Any of displot.tflite.QUANTIZATIONS predicts using a quantised
+            Tensorflow Lite model, which must have been converted from the
+            weights beforehand. See displot.tflite.load().
+        padded (bool): If True, samples already include the context the
+            model needs around them, and are not padded by its pack_data().
+        profiler (displot.profiling.StageProfiler): If set, the pack_data,
+            predict and unpack_data stages are recorded in it.
+        cancel (displot.progress.CancelToken): If set, it is checked before
+            every batch, and displot.progress.Cancelled raised once it is set.
+        callback (callable): Called with the number of samples predicted
+            after every batch.
 
     Returns:
         numpy.ndarray: Predictions.
 
     """
     model = models.load_model(model_id)
-    model_nn = weights.load_weights(weights_id[0], weights_id[1])
 
     single_image = False
     if len(X.shape) == 2:
         single_image = True
         X = np.array([X])
 
-    X = model.pack_data(X)
-    log.debug(
-        "after pack: min(X)={0}, max(X)={1}, avg(X)={2}, var(X)={3}".format(
-            np.min(X), np.max(X), np.average(X), np.var(X)
+    if backend == 'keras':
+        model_nn = registry.get(weights_id[0], weights_id[1])
+    else:
+        model_nn = displot.tflite.load(weights_id[0], weights_id[1], backend)
+
+    if batch_size is None:
+        batch_size = auto_batch_size(model_id, memory_budget_mb)
+
+    if profiler is None:
+        profiler = StageProfiler()
+
+    pred_all = None
+    for i in range(0, len(X), batch_size):
+        displot.progress.check(cancel)
+        with profiler.stage('pack_data'):
+            if padded is True:
+                X_ = model.pack_data(X[i:i + batch_size], pad=False)
+            else:
+                X_ = model.pack_data(X[i:i + batch_size])
+        log.debug(
+            "after pack: min(X)={0}, max(X)={1}, avg(X)={2}, var(X)={3}"
+            .format(np.min(X_), np.max(X_), np.average(X_), np.var(X_))
         )
-    )
 
-    pred = model_nn.predict(X)
-    log.debug(
-        "after predict: min(X)={0}, max(X)={1}, avg(X)={2}, var(X)={3}".format(
-            np.min(pred), np.max(pred), np.average(pred), np.var(pred)
+        with profiler.stage('predict'):
+            pred = model_nn.predict(X_, batch_size=batch_size)
+        log.debug(
+            "after predict: min(X)={0}, max(X)={1}, avg(X)={2}, var(X)={3}"
+            .format(np.min(pred), np.max(pred), np.average(pred), np.var(pred))
         )
-    )
 
-    pred = model.unpack_data(pred)
+        with profiler.stage('unpack_data'):
+            pred = model.unpack_data(pred)
+        if pred_all is None:
+            pred_all = np.empty((len(X),) + pred.shape[1:], dtype=pred.dtype)
+        pred_all[i:i + batch_size] = pred
+        if callback is not None:
+            callback(len(pred))
+        del X_, pred
 
     if single_image is True:
-        pred = np.squeeze(pred)
+        pred_all = np.squeeze(pred_all)
+
+    return pred_all
+
+
+def auto_batch_size(model_id, memory_budget_mb=None):
+    """Derive the inference batch size from a memory budget.
+
+    The model schema is expected to provide a memory_footprint() function
+    returning the activation memory needed per sample. If it does not,
+    samples are predicted one at a time.
+
+    Args:
+        model_id (str): Model identifier in string format.
+        memory_budget_mb (int): Memory available for inference activations
+            in megabytes. If not set, DEFAULT_MEMORY_BUDGET_MB is used.
+
+    Returns:
+        int: Batch size.
+
+    """
+    if memory_budget_mb is None:
+        memory_budget_mb = DEFAULT_MEMORY_BUDGET_MB
+
+    model = models.load_model(model_id)
+    footprint = getattr(model, 'memory_footprint', None)
+    if footprint is None:
+        log.warning('Model `{0}` does not report its memory footprint. '
+            'Using batch size 1.'.format(model_id))
+        return 1
+
+    batch_size = max(1, int(memory_budget_mb * 1024**2 // footprint()))
+    log.info('Batch size {0} for a {1} MB memory budget '
+        '({2:.0f} MB per sample).'.format(
+            batch_size, memory_budget_mb, footprint() / 1024**2))
+    return batch_size
+
+
+def set_threads(n):
+    """Limit the number of threads Tensorflow uses for inference.
+
+    Must be called before Tensorflow executes any operation, otherwise the
+    setting has no effect. Also applies to Tensorflow Lite models loaded
+    afterwards.
+
+    Args:
+        n (int): Number of threads used within and across operations.
+
+    Returns:
+        None
+
+    """
+    displot.tflite.set_threads(n)
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(n)
+        tf.config.threading.set_inter_op_parallelism_threads(n)
+    except RuntimeError as e:
+        log.warning('Could not set Tensorflow thread count: {0}'.format(e))
+
 
-    return pred
-    
-    
 def detect_gpu_support():
     """Output information about the state of GPU support to STDERR.
 
@@ -73,3 +328,16 @@ def detect_gpu_support():
         "Physical GPUs: {0}".format(len(pgpus))
     )
 
+
+def _model_size(model_nn):
+    """Return the combined size of all weights of a model in bytes.
+
+    Args:
+        model_nn (tensorflow.keras.Model): Keras model.
+
+    Returns:
+        int: Size in bytes.
+
+    """
+    return int(sum(
+        np.prod(w.shape.as_list()) * w.dtype.size for w in model_nn.weights))
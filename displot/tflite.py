@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""Reduced precision inference using Tensorflow Lite.
+
+Stored Keras weights are converted to quantised Tensorflow Lite models
+ahead of time, using `python -m displot convert` and reference images like
+the ones to be processed, and saved in the per user cache directory given
+by displot.weights.cache_dir(). A converted model is out of date once its
+weights file is newer than it, and has to be converted again.
+
+Every conversion is checked against the float32 Keras model on a set of
+reference tiles. The agreement is logged and saved next to the converted
+model.
+
+There is no bfloat16 mode. Tensorflow Lite has no bfloat16 kernels, and its
+converter does not act on tf.bfloat16 in target_spec.supported_types:
+Tensorflow 2.15 silently produces a float32 model, and the Tensorflow 2.1
+converter only knows float16 as a reduced float type. Reduced precision
+floats are covered by the float16 mode.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import os
+import json
+import inspect
+import logging
+import threading
+
+import numpy as np
+
+import displot.models as models
+import displot.weights as weights
+
+log = logging.getLogger('displot')
+
+# Supported quantisation modes. 'float16' stores weights as half precision
+# floats, 'dynamic' stores weights as int8 and quantises activations on the
+# fly, 'int8' quantises weights and activations using calibration data.
+QUANTIZATIONS = ('float16', 'dynamic', 'int8')
+FN_TFLITE = '{0}_{1}.{2}.tflite'
+
+_num_threads = None
+_models = {}
+_lock = threading.Lock()
+
+
+class LiteModel(object):
+    """Tensorflow Lite model with a Keras-like predict() method.
+
+    Args:
+        path (str): Path to the .tflite file.
+        num_threads (int): Number of threads used by the interpreter.
+            If None, or not supported by the installed Tensorflow, the
+            Tensorflow Lite default is used.
+
+    Attributes:
+        path
+
+    """
+
+    def __init__(self, path, num_threads=None):
+        import tensorflow as tf
+
+        self.path = path
+
+        kwargs = {}
+        if num_threads is not None:
+            # Tensorflow 2.1 interpreters do not take a number of threads.
+            params = inspect.signature(tf.lite.Interpreter).parameters
+            if 'num_threads' in params:
+                kwargs['num_threads'] = num_threads
+            else:
+                log.warning('This version of Tensorflow Lite does not '
+                    'support setting the number of threads.')
+        self._interpreter = tf.lite.Interpreter(model_path=path, **kwargs)
+        self._input = self._interpreter.get_input_details()[0]['index']
+        self._output = self._interpreter.get_output_details()[0]['index']
+        self._shape = None
+        self._lock = threading.Lock()
+
+    def predict(self, X, batch_size=None):
+        """Output predictions for a batch of packed samples.
+
+        Args:
+            X (numpy.ndarray): Packed input data.
+            batch_size (int): Number of samples run through the interpreter
+                at once. If not set, all samples are run at once.
+
+        Returns:
+            numpy.ndarray: Predictions.
+
+        """
+        if batch_size is None:
+            batch_size = len(X)
+
+        ret = []
+        with self._lock:
+            for i in range(0, len(X), batch_size):
+                X_ = np.ascontiguousarray(X[i:i + batch_size], dtype='float32')
+                if X_.shape != self._shape:
+                    self._interpreter.resize_tensor_input(
+                        self._input, X_.shape)
+                    self._interpreter.allocate_tensors()
+                    self._shape = X_.shape
+                self._interpreter.set_tensor(self._input, X_)
+                self._interpreter.invoke()
+                ret.append(self._interpreter.get_tensor(self._output).copy())
+        return np.concatenate(ret)
+
+
+def path(model_id, iter_id, quantization):
+    """Return the path to a cached Tensorflow Lite model.
+
+    Args:
+        model_id (str): Model identifier.
+        iter_id (str): Iteration identifier.
+        quantization (str): Quantisation mode. See QUANTIZATIONS.
+
+    Returns:
+        str: Path to file.
+
+    """
+    return os.path.join(weights.cache_dir(),
+        FN_TFLITE.format(model_id, iter_id, quantization))
+
+
+def is_current(model_id, iter_id, quantization):
+    """Check if a cached Tensorflow Lite model is newer than its weights.
+
+    Args:
+        model_id (str): Model identifier.
+        iter_id (str): Iteration identifier.
+        quantization (str): Quantisation mode. See QUANTIZATIONS.
+
+    Returns:
+        bool: True if the cached model exists and is up to date.
+
+    """
+    p = path(model_id, iter_id, quantization)
+    if not os.path.exists(p):
+        return False
+    return os.path.getmtime(p) >= os.path.getmtime(
+        weights.path(model_id, iter_id))
+
+
+def set_threads(n):
+    """Set the number of threads used by Tensorflow Lite interpreters.
+
+    Only affects models loaded afterwards.
+
+    Args:
+        n (int): Number of threads.
+
+    Returns:
+        None
+
+    """
+    global _num_threads
+    _num_threads = n
+
+
+def require(model_id, iter_id, quantization):
+    """Check that a converted Tensorflow Lite model is up to date.
+
+    Args:
+        model_id (str): Model identifier.
+        iter_id (str): Iteration identifier.
+        quantization (str): Quantisation mode. See QUANTIZATIONS.
+
+    Returns:
+        None
+
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError('Unknown quantization: {0}'.format(quantization))
+    if not is_current(model_id, iter_id, quantization):
+        raise ValueError('The {0} Tensorflow Lite model of {1} ({2}) has '
+            'not been converted, or is older than its weights. Convert it '
+            'with: python -m displot convert -w {1}:{2} -q {0} '
+            'REFERENCE_IMAGES'.format(quantization, model_id, iter_id))
+
+
+def load(model_id, iter_id, quantization):
+    """Return a converted Tensorflow Lite model.
+
+    Models are kept loaded after first use.
+
+    Args:
+        model_id (str): Model identifier.
+        iter_id (str): Iteration identifier.
+        quantization (str): Quantisation mode. See QUANTIZATIONS.
+
+    Returns:
+        LiteModel: Quantised model.
+
+    """
+    p = path(model_id, iter_id, quantization)
+    with _lock:
+        require(model_id, iter_id, quantization)
+        if p not in _models:
+            log.info('Loading quantised model from "{0}".'.format(p))
+            _models[p] = LiteModel(p, _num_threads)
+        return _models[p]
+
+
+def convert(model_id, iter_id, quantization, reference, batch_size=4):
+    """Convert stored weights to a quantised Tensorflow Lite model.
+
+    The converted model is saved to the per user cache directory, and its
+    output compared to the float32 Keras model on the reference tiles.
+    The result of the comparison is saved next to it as JSON.
+
+    Args:
+        model_id (str): Model identifier.
+        iter_id (str): Iteration identifier.
+        quantization (str): Quantisation mode. See QUANTIZATIONS.
+        reference (numpy.ndarray): Stack of unpacked image tiles. Used to
+            calibrate activation ranges in int8 mode, and to measure the
+            agreement with the float32 model.
+        batch_size (int): Number of reference tiles predicted at once.
+
+    Returns:
+        dict: Agreement with the float32 model. See agreement().
+
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError('Unknown quantization: {0}'.format(quantization))
+
+    import tensorflow as tf
+
+    model = models.load_model(model_id)
+    model_nn = weights.load_weights(model_id, iter_id, compile=False)
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model_nn)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        def representative():
+            for tile in reference:
+                yield [model.pack_data(tile[np.newaxis])]
+        converter.representative_dataset = representative
+        # Operations without an int8 kernel fall back to float.
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8,
+            tf.lite.OpsSet.TFLITE_BUILTINS
+        ]
+
+    log.info('Converting {0} ({1}) to {2} Tensorflow Lite model.'.format(
+        model_id, iter_id, quantization))
+    buf = converter.convert()
+
+    p = path(model_id, iter_id, quantization)
+    os.makedirs(os.path.dirname(p), exist_ok=True)
+    with open(p + '.part', 'wb') as f:
+        f.write(buf)
+    os.replace(p + '.part', p)
+    with _lock:
+        _models.pop(p, None)
+
+    expected = []
+    got = []
+    lite = LiteModel(p, _num_threads)
+    for i in range(0, len(reference), batch_size):
+        X = model.pack_data(reference[i:i + batch_size])
+        expected.append(model.unpack_data(model_nn.predict(X)))
+        got.append(model.unpack_data(lite.predict(X)))
+
+    report = agreement(np.concatenate(expected), np.concatenate(got))
+    report.update(quantization=quantization, n_tiles=len(reference),
+        size_mb=len(buf) / 1024**2)
+    with open(os.path.splitext(p)[0] + '.json', 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    log.info('Agreement of {0} model with float32 on {1} tiles: '
+        'max. difference {2}, mean difference {3:.3f}, {4:.2%} of pixels '
+        'within 1 grey level.'.format(
+            quantization, len(reference), report['max_abs_diff'],
+            report['mean_abs_diff'], report['within_1']))
+    return report
+
+
+def agreement(expected, got):
+    """Compare two sets of unpacked uint8 predictions.
+
+    Args:
+        expected (numpy.ndarray): Reference predictions.
+        got (numpy.ndarray): Predictions to compare.
+
+    Returns:
+        dict: Maximum and mean absolute difference in grey levels, fraction
+            of pixels differing by at most 1 grey level, and peak signal to
+            noise ratio in dB.
+
+    """
+    d = np.abs(expected.astype(np.int16) - got.astype(np.int16))
+    mse = np.mean(d.astype(float)**2)
+    if mse > 0:
+        psnr = 10 * np.log10(255**2 / mse)
+    else:
+        psnr = float('inf')
+    return {
+        'max_abs_diff': int(d.max()),
+        'mean_abs_diff': float(d.mean()),
+        'within_1': float(np.mean(d <= 1)),
+        'psnr_db': float(psnr)
+    }
+
+
+def reference_tiles(images, n=16, hw=(512, 512)):
+    """Cut an evenly spread set of reference tiles from images.
+
+    Args:
+        images (list): List of greyscale images.
+        n (int): Maximum number of tiles.
+        hw (tuple): Tile size in (height, width) format.
+
+    Returns:
+        numpy.ndarray: Stack of tiles.
+
+    """
+    tiles = []
+    for im in images:
+        im = np.squeeze(im)
+        for y in range(0, im.shape[0] - hw[0] + 1, hw[0]):
+            for x in range(0, im.shape[1] - hw[1] + 1, hw[1]):
+                tiles.append(im[y:y + hw[0], x:x + hw[1]])
+    if len(tiles) == 0:
+        raise ValueError('Reference images are smaller than a tile.')
+
+    keep = np.linspace(0, len(tiles) - 1, min(n, len(tiles))).astype(int)
+    return np.array([tiles[i] for i in keep])
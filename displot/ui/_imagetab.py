@@ -6,7 +6,9 @@ University of Strathclyde Physics Department
 """
 
 import logging
+import collections
 
+import numpy as np
 from PyQt5 import QtCore, QtGui, QtWidgets
 
 from .ui_displot_image import Ui_ImageTabPrototype
@@ -15,9 +17,16 @@ from ._imagetab_tablemodel import ImageTabTableModel
 from ._imagetab_feature import ImageTabFeature
 from ._threading import Worker
 from displot import Displot
+import displot.io
+import displot.tflite
+import displot.progress
 
 log = logging.getLogger('displot')
 
+# Frame of a multi-frame image shown in the tab. Markers of other frames,
+# as found by `displot detect` on a stack, are kept but not shown.
+DISPLAYED_FRAME = 0
+
 
 class ImageTab(QtWidgets.QWidget, Displot):
     """Image tab UI functionality container.
@@ -56,6 +65,10 @@ class ImageTab(QtWidgets.QWidget, Displot):
         self.featureList = self.layout.featureList
 
         self.featuresHidden = False
+        self.inclusionBox = None
+        self.cancelToken = None
+        # Tiling mode has no control, it follows the stored prediction map
+        self.tiling = 'reflect'
 
         # Set up feature list table and data model
         self.featureModel = ImageTabTableModel()
@@ -94,7 +107,17 @@ class ImageTab(QtWidgets.QWidget, Displot):
         cb = self.layout.value_MLModel
         for w in self.window.weights:
             cb_label = '{0} ({1})'.format(w[0], w[1])
-            cb.addItem(cb_label, w)
+            cb.addItem(cb_label, (w, 'keras'))
+        # Only quantised models converted with `displot convert` are listed
+        for q in displot.tflite.QUANTIZATIONS:
+            for w in self.window.weights:
+                if not displot.tflite.is_current(w[0], w[1], q):
+                    continue
+                cb_label = '{0} ({1}) [TFLite {2}]'.format(w[0], w[1], q)
+                cb.addItem(cb_label, (w, q))
+        self.layout.blobModeComboBox.addItem('Tiles', 'tile')
+        self.layout.blobModeComboBox.addItem('Whole image', 'mosaic')
+        self.syncPredictionSettingsToUi()
 
         # Set events
         cm = self.window.cursorMode
@@ -181,6 +204,34 @@ class ImageTab(QtWidgets.QWidget, Displot):
         self.miniView.pixmap.setPixmap(qpixmap)
         self.miniView.pixmap.setScale(self.miniView.getMinimapRatio())
 
+    def setInclusionBox(self, box):
+        """Set the area of the image detection is restricted to.
+
+        Replaces the previous area, if any.
+
+        Args:
+            box (ui.InclusionBox): Graphics item covering the area.
+
+        Returns:
+            None
+
+        """
+        self.removeInclusionBox()
+        self.inclusionBox = box
+        self.imView.addGraphicsItem(box)
+
+    def removeInclusionBox(self):
+        """Remove the area detection is restricted to.
+
+        Returns:
+            None
+
+        """
+        if self.inclusionBox is None:
+            return
+        self.imView.removeGraphicsItem(self.inclusionBox)
+        self.inclusionBox = None
+
     def _selectFeature_ev(self, e):
         """Mouse event handler.
 
@@ -452,7 +503,10 @@ class ImageTab(QtWidgets.QWidget, Displot):
 
         """
         self.removeAllFeatures()
-        for feature in self.data_obj.markers:
+        markers = self.data_obj.markers
+        if self.hasOtherFrames():
+            markers = markers[markers.frame == DISPLAYED_FRAME]
+        for feature in markers:
             uifeature = ImageTabFeature(self)
             uifeature.fromParent(feature)
             self.addFeature(uifeature)
@@ -465,38 +519,137 @@ class ImageTab(QtWidgets.QWidget, Displot):
     def syncFeaturesFromUi(self):
         """Populate the internal data object with features defined in the UI.
 
+        Additional feature table columns are carried over, and markers of
+        frames other than the displayed one are kept as they are.
+
         Returns:
             None
 
         """
-        self.data_obj.markers = []
-        for feature in self.featureModel.getModelData():
-            self.data_obj.markers.append(feature.toParent())
+        markers = self.data_obj.markers
+        columns = collections.OrderedDict(
+            (name, values.dtype) for name, values in markers.columns.items()
+            if name not in displot.io.COLUMNS)
+        table = displot.io.FeatureTable.fromFeatures(
+            (f.toParent() for f in self.featureModel.getModelData()),
+            columns)
+        if 'frame' in columns:
+            table.frame[:] = DISPLAYED_FRAME
+        if self.hasOtherFrames():
+            table = displot.io.FeatureTable.concatenate([
+                table, markers[markers.frame != DISPLAYED_FRAME]])
+        self.data_obj.markers = table
+
+    def syncPredictionSettingsToUi(self):
+        """Set prediction settings to those of the stored prediction map.
+
+        A scan with the settings unchanged then reuses the map, if it can.
+
+        Returns:
+            None
+
+        """
+        meta = self.data_obj.prediction_meta
+        if self.data_obj.prediction is None or meta is None:
+            return
+
+        lt = self.layout
+        for i in range(lt.value_MLModel.count()):
+            weights, backend = lt.value_MLModel.itemData(i)
+            if (list(weights) == meta.get('weights')
+            and backend == meta.get('backend')):
+                lt.value_MLModel.setCurrentIndex(i)
+                break
+        if 'stride' in meta:
+            lt.strideVerticalSpinBox.setValue(meta['stride'][0])
+            lt.strideHorizontalSpinBox.setValue(meta['stride'][1])
+        i = lt.blobModeComboBox.findData(meta.get('blob_mode'))
+        if i >= 0:
+            lt.blobModeComboBox.setCurrentIndex(i)
+        lt.keepPredictionCheckBox.setChecked(True)
+        self.tiling = meta.get('tiling', self.tiling)
+
+    def hasOtherFrames(self):
+        """Check if there are markers of frames that are not displayed.
+
+        Returns:
+            bool: True if the markers have a 'frame' column holding other
+                frames than the displayed one.
+
+        """
+        markers = self.data_obj.markers
+        return ('frame' in markers.columns
+            and bool((markers.frame != DISPLAYED_FRAME).any()))
+
+    def _refuseOtherFrames(self, action):
+        """Refuse an action that would change the markers of every frame.
+
+        Args:
+            action (str): Name of the action, for the message shown.
+
+        Returns:
+            bool: True if the action must not run.
+
+        """
+        if not self.hasOtherFrames():
+            return False
+        msg = ('{0} is not available for markers of several frames, only '
+            'the first frame is displayed. Use `displot detect` on the '
+            'image instead.'.format(action))
+        log.warning(msg)
+        self.window.setStatusBarMsg(msg, 5000)
+        return True
 
     def _detection_ev(self):
         lt = self.layout
 
-        lt.button_Scan.setEnabled(False)
+        # The scan button doubles as the cancel button of a running job.
+        if self.cancelToken is not None:
+            log.info('Cancelling detection.')
+            self.cancelToken.cancel()
+            lt.button_Scan.setEnabled(False)
+            return
+
+        if lt.value_MLModel.currentData() is None:
+            log.error('Could not begin: No model selected for detection. '
+            'This means you probably have no models present in your '
+            'displot/weights directory.')
+            return
+        weights, backend = lt.value_MLModel.currentData()
+        if self._refuseOtherFrames('Scan'):
+            return
+        if backend != 'keras':
+            try:
+                displot.tflite.require(weights[0], weights[1], backend)
+            except ValueError as e:
+                log.error(str(e))
+                self.window.setStatusBarMsg(str(e), 10000)
+                return
+
+        scan_text = lt.button_Scan.text()
+        lt.button_Scan.setText('Cancel')
         lt.button_Discrimination.setEnabled(False)
         lt.button_RemoveHidden.setEnabled(False)
         self._progressBar(0)
+        self.cancelToken = displot.progress.CancelToken()
 
         def ui_finished():
+            self.cancelToken = None
+            lt.button_Scan.setText(scan_text)
             lt.button_Scan.setEnabled(True)
             lt.button_Discrimination.setEnabled(True)
             lt.button_RemoveHidden.setEnabled(True)
 
-        weights = lt.value_MLModel.currentData()
-        if weights is None:
-            log.error('Could not begin: No model selected for detection. '
-            'This means you probably have no models present in your '
-            'displot/weights directory.')
-            return
+        def ui_cancelled():
+            self._progressBar(0)
+            self.window.setStatusBarMsg('Detection cancelled.', 5000)
 
         stride = (
             int(lt.strideVerticalSpinBox.cleanText()),
             int(lt.strideHorizontalSpinBox.cleanText())
         )
+        blob_mode = lt.blobModeComboBox.currentData()
+        keep_prediction = lt.keepPredictionCheckBox.isChecked()
         min_r = int(lt.minBlobRadiusSpinBox.cleanText())
         max_r = int(lt.maxBlobRadiusSpinBox.cleanText())
 
@@ -509,22 +662,41 @@ class ImageTab(QtWidgets.QWidget, Displot):
         td_overlap = int(lt.overlapToleranceSpinBox.cleanText())
         pred_tolerance = float(lt.predictionThresholdDoubleSpinBox.cleanText())
 
+        # Restrict detection to the inclusion box if there is one. Markers
+        # outside of it, including manual edits, are kept.
+        roi = None
+        if self.inclusionBox is not None:
+            box = self.inclusionBox
+            roi = (box.x1, box.y1, box.x2, box.y2)
+            self.syncFeaturesFromUi()
+
+        # Displot.scan() reuses the prediction map stored with the data if
+        # repeating blob detection on it gives what a full run with these
+        # settings would, skipping the neural network entirely
         worker = Worker(
-            self.detection,
-            self.data_obj.image, weights, model=weights[0], stride=stride,
+            self.scan,
+            self.data_obj.image, weights, roi=roi,
+            model=weights[0], stride=stride, tiling=self.tiling,
+            blob_mode=blob_mode, keep_prediction=keep_prediction,
             min_r=min_r, max_r=max_r,
             min_sigma=min_sigma, max_sigma=max_sigma,
             num_sigma=num_sigma, threshold=threshold,
             td_border=td_border, td_overlap=td_overlap,
-            pred_tolerance=pred_tolerance
+            pred_tolerance=pred_tolerance, pool=self.window.blobPool,
+            backend=backend, cache=self.window.predictionCache,
+            cancel=self.cancelToken
         )
         worker.signals.progress.connect(self._progressBar)
+        worker.signals.status.connect(self.window.setStatusBarMsg)
         worker.signals.finished.connect(self.syncFeaturesToUi)
         worker.signals.finished.connect(ui_finished)
+        worker.signals.cancelled.connect(ui_cancelled)
         self.window.threadpool.start(worker)
 
     def _discrimination_ev(self):
         lt = self.layout
+        if self._refuseOtherFrames('Discrimination'):
+            return
 
         lt.button_Scan.setEnabled(False)
         lt.button_Discrimination.setEnabled(False)
@@ -562,6 +734,9 @@ def grayscale_to_QImage(image):
     Args:
         imageData: numpy ndarray of the image.
     """
+    # Memory-mapped images may be channel views with gaps between pixels,
+    # and lazily decoded ones are not arrays at all.
+    image = np.ascontiguousarray(image)
     h, w = image.shape
 
     # Load data directly from the numpy array into QImage
@@ -7,7 +7,7 @@ University of Strathclyde Physics Department
 
 from PyQt5 import QtCore
 from ._cursormode import CursorMode
-from ._imageview_symbols import FeatureMarker
+from ._imageview_symbols import FeatureMarker, InclusionBox
 
 
 class ImageTabCursors(QtCore.QObject):
@@ -31,6 +31,13 @@ class ImageTabCursors(QtCore.QObject):
         self.cursorMode.defineEvent(self.clearCursor,
             CursorMode.MOUSE_LEAVE, 'feature_move')
 
+        self.cursorMode.defineEvent(self.inclusionNew,
+            CursorMode.MOUSE_PRESS, 'inclusion_new')
+        self.cursorMode.defineEvent(self.inclusionDraw,
+            CursorMode.MOUSE_MOVE, 'inclusion_new_draw')
+        self.cursorMode.defineEvent(self.inclusionDone,
+            CursorMode.MOUSE_RELEASE, 'inclusion_new_draw')
+
     def clearCursor(self, e=None):
         if self._cursor is None:
             return
@@ -73,3 +80,37 @@ class ImageTabCursors(QtCore.QObject):
             e.y() - self._cursor.height / 2
         )
         self._cursor.setPos(x, y)
+
+    def inclusionNew(self, e):
+        it = self.window.imageTabCurrent()
+        if it is None:
+            return
+
+        x, y = it.imView.mouseSceneCoords(e.x(), e.y())
+        box = InclusionBox(x, y, x, y,
+            max_x=it.data_obj.image_width, max_y=it.data_obj.image_height)
+        it.setInclusionBox(box)
+        self.cursorMode.setMode('inclusion_new_draw')
+
+    def inclusionDraw(self, e):
+        it = self.window.imageTabCurrent()
+        if it is None or it.inclusionBox is None:
+            return
+
+        x, y = it.imView.mouseSceneCoords(e.x(), e.y())
+        it.inclusionBox.resize(x, y)
+        it.inclusionBox.update()
+
+    def inclusionDone(self, e):
+        it = self.window.imageTabCurrent()
+        if it is None or it.inclusionBox is None:
+            return
+
+        self.inclusionDraw(e)
+        box = it.inclusionBox
+        if box.width < box.resizeBoxWidth or box.height < box.resizeBoxWidth:
+            it.removeInclusionBox()
+        else:
+            self.window.setStatusBarMsg('Detection area: x {0}-{1}, '
+                'y {2}-{3}.'.format(box.x1, box.x2, box.y1, box.y2), 3000)
+        self.cursorMode.resetMode()
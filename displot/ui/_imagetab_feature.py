@@ -29,6 +29,9 @@ class ImageTabFeature(DisplotDataFeature):
         self.imViewRef = None
         self.miniViewRef = None
 
+        # Values of feature table columns without an attribute here.
+        self.columns = {}
+
         self.color = self.itab.window.styles.defaultColour
         self._prevColor = None
 
@@ -41,20 +44,25 @@ class ImageTabFeature(DisplotDataFeature):
         """Populate the current object using a base class object instance.
 
         Args:
-            obj (io.DisplotDataFeature): Base class object.
+            obj (io.DisplotDataFeature or io.FeatureView): Base class
+                object, or view of a feature table row.
 
         Returns:
             None
 
         """
-        for attr, value in obj.__dict__.items():
-            setattr(self, attr, value)
+        base = DisplotDataFeature().__dict__
+        for attr, value in obj.toDict().items():
+            if attr in base:
+                setattr(self, attr, value)
+            else:
+                self.columns[attr] = value
 
     def toParent(self):
         """Return the current object as its base object type.
 
         Transfers all attributes set in this object that als exist in the
-        parent.
+        parent, and the values of any additional feature table columns.
 
         Returns:
             io.DisplotDataFeature: Data object.
@@ -63,6 +71,8 @@ class ImageTabFeature(DisplotDataFeature):
         obj = DisplotDataFeature()
         for attr, value in obj.__dict__.items():
             setattr(obj, attr, getattr(self, attr))
+        for attr, value in self.columns.items():
+            setattr(obj, attr, value)
         return obj
 
     def show(self):
@@ -281,6 +281,26 @@ class ExclusionBox(DisplotSymbolRect):
         self.setZValue(1000)
 
 
+class InclusionBox(ExclusionBox):
+    """Area of the image that detection is restricted to.
+
+    Drawn like an exclusion box, in green.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.penNormal = QtGui.QPen(QtGui.QColor.fromRgb(25, 200, 25))
+        self.brushNormal = QtGui.QBrush(
+            QtGui.QColor.fromRgb(25, 200, 25, 20))
+        self.penSelected = QtGui.QPen(QtGui.QColor.fromRgb(155, 255, 25))
+        self.brushSelected = QtGui.QBrush(
+            QtGui.QColor.fromRgb(155, 255, 25, 20))
+        self.penResizeBox = QtGui.QPen(QtGui.QColor.fromRgb(155, 255, 25))
+        self.brushResizeBox = QtGui.QBrush(QtGui.QColor.fromRgb(155, 255, 25))
+
+
 class FeatureMarker(DisplotSymbolRect):
     """Work image view GUI representation of a Displot feature.
 
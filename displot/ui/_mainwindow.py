@@ -13,11 +13,14 @@ import os
 import sys
 import json
 import logging
+import threading
 import markdown
 from PyQt5 import QtCore, QtWidgets
 
+import displot.cache
 import displot.io
 import displot.weights
+import displot.workers
 from ._cursormode import CursorMode
 from ._dialog import GenericDialog, AboutDialog
 from ._imagetab import ImageTab
@@ -41,6 +44,8 @@ class DisplotUi(QtWidgets.QMainWindow):
             Qt pen and brush definitions.
         tabWidget (QtWidgets.QTabWidget): Reference to the QTabWidget object
             holding the opened images.
+        blobPool (displot.workers.BlobWorkerPool): Blob detection worker
+            pool shared by all image tabs for the lifetime of the program.
         appTitle (str): Application title as shown on the title bar.
         appVersion (str): Application version as shown on the title bar.
         titleFormat (str): Template for string displayed on the title bar.
@@ -52,6 +57,16 @@ class DisplotUi(QtWidgets.QMainWindow):
         self.app = QtWidgets.QApplication(sys.argv)
         self.threadpool = QtCore.QThreadPool()
 
+        # Start blob detection workers in the background so they are ready
+        # by the time the first detection runs
+        self.blobPool = displot.workers.get_pool()
+        threading.Thread(target=self.blobPool.warm, daemon=True).start()
+
+        # Network predictions can be cached on disk, so that detection can
+        # be rerun with different parameters without predicting again. The
+        # cache is off until enabled in the File menu.
+        self.predictionCache = None
+
         super().__init__()
 
         # Set up layout
@@ -104,6 +119,9 @@ class DisplotUi(QtWidgets.QMainWindow):
         lt.actionExport_Features.triggered.connect(self.imageTabExportFeatures)
         lt.actionExport_Bitmap.triggered.connect(self.imageTabExport)
         lt.actionCloseImage.triggered.connect(self.imageTabClose)
+        lt.actionCachePredictions.toggled.connect(self.setPredictionCache)
+        lt.actionClearPredictionCache.triggered.connect(
+            self.clearPredictionCache)
         lt.actionExit.triggered.connect(self.exit)
         lt.actionAbout.triggered.connect(self.openAbout)
         self.updateMenuBar()
@@ -117,7 +135,9 @@ class DisplotUi(QtWidgets.QMainWindow):
             'exclusion_new',
             'exclusion_new_draw',
             'exclusion_move',
-            'exclusion_resize'
+            'exclusion_resize',
+            'inclusion_new',
+            'inclusion_new_draw'
         ])
 
         # Setup events
@@ -139,6 +159,7 @@ class DisplotUi(QtWidgets.QMainWindow):
 
     def exit(self):
         """Exits the program gracefully."""
+        displot.workers.shutdown_pool()
         gc.collect(1)
         self.app.quit()
 
@@ -152,6 +173,40 @@ class DisplotUi(QtWidgets.QMainWindow):
         dlg.show()
         dlg.exec_()
 
+    def setPredictionCache(self, enable):
+        """Turn caching of network predictions on disk on or off.
+
+        Args:
+            enable (bool): True uses the cache in displot.cache.DEFAULT_PATH
+                for all following detections, False stops using it.
+
+        Returns:
+            None
+
+        """
+        if enable is True:
+            self.predictionCache = displot.cache.PredictionCache()
+            log.info('Caching predictions in "{0}".'.format(
+                self.predictionCache.path))
+        else:
+            self.predictionCache = None
+            log.info('Prediction cache disabled.')
+
+    def clearPredictionCache(self):
+        """Remove all cached network predictions from disk.
+
+        Returns:
+            None
+
+        """
+        cache = self.predictionCache or displot.cache.PredictionCache()
+        size = cache.size
+        cache.clear()
+        msg = 'Prediction cache cleared: {0:.1f} MB freed.'.format(
+            size / 1024**2)
+        log.info(msg)
+        self.setStatusBarMsg(msg, 3000)
+
     def setStatusBarMsg(self, message="", timeout=0):
         """Shows a short message in the status bar at the bottom of the window.
 
@@ -390,7 +445,12 @@ class DisplotUi(QtWidgets.QMainWindow):
         dlg.setOption(QtWidgets.QFileDialog.DontUseNativeDialog)
         dlg.setAcceptMode(QtWidgets.QFileDialog.AcceptSave)
         dlg.setFileMode(QtWidgets.QFileDialog.AnyFile)
-        dlg.setNameFilter('CSV file (*.csv)')
+        dlg.setNameFilters([
+            'CSV file (*.csv)',
+            'NumPy array (*.npy)',
+            'NumPy archive (*.npz)',
+            'HDF5 file (*.h5 *.hdf5)'
+        ])
 
         ret = dlg.exec_()
         self._lastDir = dlg.history()[-1]
@@ -402,7 +462,9 @@ class DisplotUi(QtWidgets.QMainWindow):
 
         splitext = os.path.splitext(path)
         if splitext[1] == '':
-            path = path + '.csv'
+            # Extension of the first pattern of the selected filter.
+            flt = dlg.selectedNameFilter()
+            path = path + flt[flt.index('*') + 1:].split()[0].rstrip(')')
 
         self.setStatusBarMsg('Exporting file: ' + path)
         it.syncFeaturesFromUi()
@@ -10,6 +10,8 @@ import traceback
 
 from PyQt5 import QtCore
 
+from displot.progress import Cancelled
+
 
 class WorkerSignals(QtCore.QObject):
     """Object containing signals usable from a running worker thread.
@@ -20,6 +22,10 @@ class WorkerSignals(QtCore.QObject):
             ( exception type, value, traceback.format_exc() )
         result (QtCore.pyqtSignal): Accepts any object type.
         progress (QtCore.pyqtSignal): Accepts int indicating progress percent.
+        status (QtCore.pyqtSignal): Accepts str describing the progress,
+            such as the estimated time remaining.
+        cancelled (QtCore.pyqtSignal): Accepts no data. Emitted instead of
+            result if the function stopped because it was cancelled.
 
     """
 
@@ -27,6 +33,8 @@ class WorkerSignals(QtCore.QObject):
     error = QtCore.pyqtSignal(tuple)
     result = QtCore.pyqtSignal(object)
     progress = QtCore.pyqtSignal(int)
+    status = QtCore.pyqtSignal(str)
+    cancelled = QtCore.pyqtSignal()
 
 
 class Worker(QtCore.QRunnable):
@@ -35,6 +43,10 @@ class Worker(QtCore.QRunnable):
     Constructor accepts as arguments a callable function reference, followed by
     a list of arguments to pass to the function when calle.d
 
+    Functions supporting cancellation are passed a
+    displot.progress.CancelToken by the caller, and raise
+    displot.progress.Cancelled once it is set.
+
     Args:
         fn (callable): Function to call in a worker thread.
 
@@ -70,6 +82,8 @@ class Worker(QtCore.QRunnable):
         """
         try:
             result = self.fn(*self.args, **self.kwargs)
+        except Cancelled:
+            self.signals.cancelled.emit()
         except Exception:
             traceback.print_exc()
             exctype, value = sys.exc_info()[:2]
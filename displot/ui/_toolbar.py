@@ -27,6 +27,8 @@ class Toolbar(QtWidgets.QToolBar):
             'selectFeature': lt.actionSelectFeature,
             'addFeature': lt.actionAddFeature,
             'hideAllFeatures': lt.actionHideAllFeatures,
+            'addInclusion': lt.actionAddInclusion,
+            'removeInclusion': lt.actionRemoveInclusion,
             # 'addExclusion': lt.actionAddExclusion,
             # 'removeExclusion': lt.actionRemoveExclusion
         }
@@ -68,6 +70,10 @@ class Toolbar(QtWidgets.QToolBar):
             self.btns['addFeature'].setChecked(True)
         if cm.currentMode in ['exclusion_new', 'exclusion_new_draw']:
             self.btns['addExclusion'].setChecked(True)
+        if cm.currentMode in ['inclusion_new', 'inclusion_new_draw']:
+            self.btns['addInclusion'].setChecked(True)
+        if getattr(it, 'inclusionBox', None) is None:
+            self.btns['removeInclusion'].setEnabled(False)
 
         if hasattr(it, 'featuresHidden'):
             self.btns['hideAllFeatures'].setChecked(it.featuresHidden)
@@ -112,3 +118,19 @@ class Toolbar(QtWidgets.QToolBar):
 
     def on_removeExclusion(self, checked=False):
         self.updateButtons()
+
+    def on_addInclusion(self, checked=False):
+        if checked is True:
+            self.window.cursorMode.setMode('inclusion_new')
+        else:
+            self.window.cursorMode.resetMode()
+
+        self.updateButtons()
+
+    def on_removeInclusion(self, checked=False):
+        it = self.window.imageTabCurrent()
+        if it is None:
+            return
+
+        it.removeInclusionBox()
+        self.updateButtons()
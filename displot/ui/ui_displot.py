@@ -165,6 +165,22 @@ class Ui_MainWindow(object):
         self.actionExport_Bitmap.setObjectName("actionExport_Bitmap")
         self.actionExport_Features = QtWidgets.QAction(MainWindow)
         self.actionExport_Features.setObjectName("actionExport_Features")
+        self.actionAddInclusion = QtWidgets.QAction(MainWindow)
+        self.actionAddInclusion.setCheckable(True)
+        icon5 = QtGui.QIcon()
+        icon5.addPixmap(QtGui.QPixmap(":/feathericons/3rdparty/feather/icons/crop.svg"), QtGui.QIcon.Normal, QtGui.QIcon.Off)
+        self.actionAddInclusion.setIcon(icon5)
+        self.actionAddInclusion.setObjectName("actionAddInclusion")
+        self.actionRemoveInclusion = QtWidgets.QAction(MainWindow)
+        icon6 = QtGui.QIcon()
+        icon6.addPixmap(QtGui.QPixmap(":/feathericons/3rdparty/feather/icons/x-square.svg"), QtGui.QIcon.Normal, QtGui.QIcon.Off)
+        self.actionRemoveInclusion.setIcon(icon6)
+        self.actionRemoveInclusion.setObjectName("actionRemoveInclusion")
+        self.actionCachePredictions = QtWidgets.QAction(MainWindow)
+        self.actionCachePredictions.setCheckable(True)
+        self.actionCachePredictions.setObjectName("actionCachePredictions")
+        self.actionClearPredictionCache = QtWidgets.QAction(MainWindow)
+        self.actionClearPredictionCache.setObjectName("actionClearPredictionCache")
         self.menuFile.addAction(self.actionOpenImage)
         self.menuFile.addSeparator()
         self.menuFile.addAction(self.actionSaveImageAs)
@@ -172,6 +188,9 @@ class Ui_MainWindow(object):
         self.menuFile.addAction(self.actionExport_Bitmap)
         self.menuFile.addAction(self.actionCloseImage)
         self.menuFile.addSeparator()
+        self.menuFile.addAction(self.actionCachePredictions)
+        self.menuFile.addAction(self.actionClearPredictionCache)
+        self.menuFile.addSeparator()
         self.menuFile.addAction(self.actionExit)
         self.menuHelp.addAction(self.actionAbout)
         self.menubar.addAction(self.menuFile.menuAction())
@@ -180,6 +199,8 @@ class Ui_MainWindow(object):
         self.toolBar.addAction(self.actionAddFeature)
         self.toolBar.addAction(self.actionHideAllFeatures)
         self.toolBar.addSeparator()
+        self.toolBar.addAction(self.actionAddInclusion)
+        self.toolBar.addAction(self.actionRemoveInclusion)
 
         self.retranslateUi(MainWindow)
         self.tabWidget.setCurrentIndex(0)
@@ -219,6 +240,14 @@ class Ui_MainWindow(object):
         self.actionAddFeature.setToolTip(_translate("MainWindow", "Add a new feature marker to the image."))
         self.actionExport_Bitmap.setText(_translate("MainWindow", "Export Bitmap"))
         self.actionExport_Features.setText(_translate("MainWindow", "Export Features"))
+        self.actionAddInclusion.setText(_translate("MainWindow", "Detection Area"))
+        self.actionAddInclusion.setToolTip(_translate("MainWindow", "Draw an area on the image to restrict the next scan to. Features outside of it are kept."))
+        self.actionRemoveInclusion.setText(_translate("MainWindow", "Clear Detection Area"))
+        self.actionRemoveInclusion.setToolTip(_translate("MainWindow", "Remove the detection area, so that the next scan covers the whole image."))
+        self.actionCachePredictions.setText(_translate("MainWindow", "Cache Predictions"))
+        self.actionCachePredictions.setToolTip(_translate("MainWindow", "Keep network predictions on disk, so that scanning an image again with different blob detection parameters skips the network."))
+        self.actionClearPredictionCache.setText(_translate("MainWindow", "Clear Prediction Cache"))
+        self.actionClearPredictionCache.setToolTip(_translate("MainWindow", "Remove all cached network predictions from disk."))
 from displot.ui._console import Console
 from displot.ui._toolbar import Toolbar
 from . import feathericons_rc
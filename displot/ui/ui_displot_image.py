@@ -161,6 +161,15 @@ class Ui_ImageTabPrototype(object):
         self.strideVerticalSpinBox.setProperty("value", 256)
         self.strideVerticalSpinBox.setObjectName("strideVerticalSpinBox")
         self.step1Layout.setWidget(1, QtWidgets.QFormLayout.FieldRole, self.strideVerticalSpinBox)
+        self.blobModeLabel = QtWidgets.QLabel(self.imageToolsScrollArea)
+        self.blobModeLabel.setObjectName("blobModeLabel")
+        self.step1Layout.setWidget(2, QtWidgets.QFormLayout.LabelRole, self.blobModeLabel)
+        self.blobModeComboBox = QtWidgets.QComboBox(self.imageToolsScrollArea)
+        self.blobModeComboBox.setObjectName("blobModeComboBox")
+        self.step1Layout.setWidget(2, QtWidgets.QFormLayout.FieldRole, self.blobModeComboBox)
+        self.keepPredictionCheckBox = QtWidgets.QCheckBox(self.imageToolsScrollArea)
+        self.keepPredictionCheckBox.setObjectName("keepPredictionCheckBox")
+        self.step1Layout.setWidget(3, QtWidgets.QFormLayout.SpanningRole, self.keepPredictionCheckBox)
         self.verticalLayout_4.addLayout(self.step1Layout)
         self.BlobDetectionLabel = QtWidgets.QLabel(self.imageToolsScrollArea)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Maximum)
@@ -476,6 +485,7 @@ class Ui_ImageTabPrototype(object):
         self.MLModelLabel.setBuddy(self.value_MLModel)
         self.strideHorizontalLabel.setBuddy(self.strideHorizontalSpinBox)
         self.strideVerticalLabel.setBuddy(self.strideVerticalSpinBox)
+        self.blobModeLabel.setBuddy(self.blobModeComboBox)
         self.minBlobRadiusLabel.setBuddy(self.minBlobRadiusSpinBox)
         self.maxBlobRadiusLabel.setBuddy(self.maxBlobRadiusSpinBox)
         self.minSigmaLabel.setBuddy(self.minSigmaSpinBox)
@@ -504,6 +514,10 @@ class Ui_ImageTabPrototype(object):
         self.strideHorizontalSpinBox.setSuffix(_translate("ImageTabPrototype", "px"))
         self.strideVerticalLabel.setText(_translate("ImageTabPrototype", "Stride (vertical)"))
         self.strideVerticalSpinBox.setSuffix(_translate("ImageTabPrototype", "px"))
+        self.blobModeLabel.setToolTip(_translate("ImageTabPrototype", "Find blobs on each tile, or once on the whole stitched prediction map."))
+        self.blobModeLabel.setText(_translate("ImageTabPrototype", "Blob detection on"))
+        self.keepPredictionCheckBox.setToolTip(_translate("ImageTabPrototype", "Keep the prediction map and save it with the data file. Maps made on the whole image let later scans skip prediction."))
+        self.keepPredictionCheckBox.setText(_translate("ImageTabPrototype", "Keep prediction map"))
         self.BlobDetectionLabel.setText(_translate("ImageTabPrototype", "<html><head/><body><p><span style=\" font-weight:600;\">Settings:</span> Blob Detection</p></body></html>"))
         self.minBlobRadiusLabel.setToolTip(_translate("ImageTabPrototype", "Minimum blob radius in pixels."))
         self.minBlobRadiusLabel.setText(_translate("ImageTabPrototype", "Minimum blob radius"))
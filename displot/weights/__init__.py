@@ -9,13 +9,18 @@ import os
 import errno
 import re
 import logging
+import getpass
+import tempfile
 
-import tensorflow as tf
+import displot.cache
 
 
 log = logging.getLogger('displot')
 
 PATH_WEIGHTS = os.path.dirname(os.path.abspath(__file__))
+# Files derived from weights, such as converted models, are kept here.
+# See cache_dir().
+PATH_CACHE = os.path.join(displot.cache.CACHE_DIR, 'models')
 FN_WEIGHTS = '{0}_{1}.h5'
 FN_LOG = '{0}_{1}.log'
 
@@ -89,7 +94,38 @@ def available(model_id, iter_id='0'):
     return model_id, new_iter_id
 
 
-def load_weights(model_id, iter_id=None):
+def cache_dir():
+    """Return the directory files derived from weights are kept in.
+
+    This is PATH_CACHE, unless it cannot be created or written to, such as
+    when the home directory is read-only. A directory in the system
+    temporary directory is used then.
+
+    Returns:
+        str: Path to directory. It is not created.
+
+    """
+    if _writable(PATH_CACHE):
+        return PATH_CACHE
+    try:
+        user = getpass.getuser()
+    except (KeyError, OSError):
+        user = 'user'
+    return os.path.join(tempfile.gettempdir(),
+        'displot-{0}'.format(user), 'models')
+
+
+def _writable(path):
+    """Check if a directory exists and is writable, or can be created."""
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+    return os.path.isdir(path) and os.access(path, os.W_OK)
+
+
+def load_weights(model_id, iter_id=None, compile=True):
     """Load a previously trained model.
 
     Args:
@@ -97,18 +133,23 @@ def load_weights(model_id, iter_id=None):
             these weights.
         iter_id (str): Iteration identifier. If not set, the latest
             iteration will be loaded.
+        compile (bool): If False, the optimizer state and training
+            configuration are not restored. Sufficient for inference.
 
     Returns:
         tensorflow.keras.Model: Trained Keras model.
 
     """
+    # Tensorflow takes seconds to import, and is only needed from here on.
+    import tensorflow as tf
+
     if iter_id is None:
         iter_id = list_weights(model_id)[-1][1]
 
     p = path(model_id, iter_id)
     if os.path.exists(p):
         log.info('Loading model from "{0}".'.format(p))
-        return tf.keras.models.load_model(p)
+        return tf.keras.models.load_model(p, compile=compile)
     else:
         raise FileNotFoundError(
             errno.ENOENT, os.strerror(errno.ENOENT), p)
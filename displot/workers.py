@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""displot - Persistent blob detection worker pool.
+
+Worker processes are started using the spawn method, so they do not inherit
+the Qt and Tensorflow state of the parent process. Each worker only imports
+NumPy and scikit-image once, when it is started, and is then reused for
+every subsequent detection. For this to hold, importing the displot package
+itself must not import Tensorflow.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import atexit
+import logging
+import threading
+import multiprocessing as mp
+
+import numpy as np
+
+import displot.progress
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+log = logging.getLogger('displot')
+
+# Seconds between cancellation checks while waiting for the workers.
+POLL_INTERVAL = .1
+
+
+class BlobWorkerPool(object):
+    """Long-lived pool of blob detection worker processes.
+
+    The pool is started lazily on first use, or ahead of time with warm().
+    Worker processes import only this module and displot.blobs. This
+    module does not import displot.blobs itself, so that starting the pool
+    does not load scikit-image in the main process.
+    Prediction tiles are handed to the workers through a shared memory block
+    when multiprocessing.shared_memory is available, and pickled otherwise.
+
+    Args:
+        processes (int): Number of worker processes. If None, the number of
+            CPUs is used.
+
+    Attributes:
+        processes
+
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes
+
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        """bool: True if the worker processes have been started."""
+        return self._pool is not None
+
+    def start(self):
+        """Start the worker processes if they are not running.
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            if self._pool is not None:
+                return
+            ctx = mp.get_context('spawn')
+            self._pool = ctx.Pool(self.processes, initializer=_worker_init)
+            log.debug('Blob worker pool started.')
+
+    def warm(self):
+        """Start the worker processes and wait until all are initialised.
+
+        Returns:
+            None
+
+        """
+        self.start()
+        n = self.processes or mp.cpu_count()
+        self._pool.map(_worker_ping, range(n), chunksize=1)
+        log.debug('Blob worker pool warmed up ({0} processes).'.format(n))
+
+    def blob_detect(self, tiles, offsets, cancel=None, callback=None,
+        **kwargs
+    ):
+        """Perform blob detection on a stack of tiles in the worker processes.
+
+        See displot.blobs.blob_detect() for the keyword arguments.
+
+        Args:
+            tiles (numpy.ndarray): Stack of tiles of shape (n, height, width).
+            offsets (list): List of (x_offset, y_offset) tuples, one per tile.
+            cancel (displot.progress.CancelToken): If set, it is polled
+                while waiting for the workers, and displot.progress.Cancelled
+                raised once it is set. Tiles still being processed are
+                abandoned; call terminate() to stop the workers.
+            callback (callable): Called with no arguments whenever a tile
+                has been processed.
+
+        Returns:
+            list: List of arrays of detected blobs, one per tile, with each
+                row in (x, y, radius, confidence) format.
+
+        """
+        self.start()
+
+        if shared_memory is None:
+            tasks = [(tile, o, kwargs) for tile, o in zip(tiles, offsets)]
+            return self._collect(
+                _worker_blob_detect, tasks, cancel, callback)
+
+        tiles = np.ascontiguousarray(tiles)
+        shm = shared_memory.SharedMemory(
+            create=True, size=max(tiles.nbytes, 1))
+        try:
+            buf = np.ndarray(tiles.shape, dtype=tiles.dtype, buffer=shm.buf)
+            buf[:] = tiles
+            del buf
+
+            tasks = [
+                (shm.name, tiles.shape, tiles.dtype.str, i, o, kwargs)
+                for i, o in enumerate(offsets)
+            ]
+            return self._collect(
+                _worker_blob_detect_shm, tasks, cancel, callback)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def _collect(self, fn, tasks, cancel, callback):
+        """Run tasks in the workers and return their results in order."""
+        if cancel is None and callback is None:
+            return self._pool.map(fn, tasks)
+
+        ret = []
+        it = self._pool.imap(fn, tasks)
+        while len(ret) < len(tasks):
+            displot.progress.check(cancel)
+            try:
+                ret.append(it.next(timeout=POLL_INTERVAL))
+            except mp.TimeoutError:
+                continue
+            if callback is not None:
+                callback()
+        return ret
+
+    def terminate(self):
+        """Stop the worker processes immediately.
+
+        Work in progress is discarded. The pool will be restarted on next use.
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            if self._pool is None:
+                return
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            log.debug('Blob worker pool terminated.')
+
+    def close(self):
+        """Stop the worker processes after they finish their current work.
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            if self._pool is None:
+                return
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            log.debug('Blob worker pool closed.')
+
+
+_default_pool = None
+
+
+def get_pool():
+    """Return the process-wide blob worker pool, creating it if necessary.
+
+    Returns:
+        BlobWorkerPool: Worker pool.
+
+    """
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = BlobWorkerPool()
+    return _default_pool
+
+
+@atexit.register
+def shutdown_pool():
+    """Stop the process-wide blob worker pool if it was started.
+
+    Returns:
+        None
+
+    """
+    if _default_pool is not None:
+        _default_pool.terminate()
+
+
+def _worker_init():
+    # Loaded up front, so that the first tiles are not slowed down by it.
+    import displot.blobs
+
+
+def _worker_ping(i):
+    return i
+
+
+def _worker_blob_detect(task):
+    import displot.blobs
+
+    tile, offset, kwargs = task
+    return displot.blobs.blob_detect(tile, offset[0], offset[1], **kwargs)
+
+
+def _worker_blob_detect_shm(task):
+    import displot.blobs
+
+    name, shape, dtype, i, offset, kwargs = task
+
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        tiles = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        ret = displot.blobs.blob_detect(
+            tiles[i], offset[0], offset[1], **kwargs)
+        del tiles
+    finally:
+        shm.close()
+    return ret
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Tests of the prediction cache.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import displot.cache
+
+
+PARAMS = dict(model='fusionnet', weights=['fusionnet', 'a'],
+    weights_mtime=1.5, stride=[256, 256], tiling='reflect', backend='keras')
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return displot.cache.PredictionCache(str(tmp_path / 'cache'))
+
+
+@pytest.fixture
+def image():
+    return np.random.RandomState(0).randint(0, 256, (600, 300)).astype(
+        np.uint8)
+
+
+def test_key_is_stable(cache, image):
+    key = cache.key(image, **PARAMS)
+    assert key == cache.key(image.copy(), **dict(reversed(PARAMS.items())))
+    assert key == displot.cache.PredictionCache('elsewhere').key(
+        image, **PARAMS)
+
+
+def test_key_reads_lazy_images_in_blocks(cache, image, tmp_path):
+    path = str(tmp_path / 'image.npy')
+    np.save(path, image)
+    mapped = np.load(path, mmap_mode='r')
+    assert cache.key(mapped, **PARAMS) == cache.key(image, **PARAMS)
+
+
+@pytest.mark.parametrize('name, value', [
+    ('model', 'unet'), ('weights', ['fusionnet', 'b']),
+    ('weights_mtime', 2.5), ('stride', [128, 256]), ('tiling', 'context'),
+    ('backend', 'int8'),
+])
+def test_key_depends_on_parameters(cache, image, name, value):
+    params = dict(PARAMS, **{name: value})
+    assert cache.key(image, **params) != cache.key(image, **PARAMS)
+
+
+def test_key_depends_on_image(cache, image):
+    key = cache.key(image, **PARAMS)
+
+    changed = image.copy()
+    changed[-1, -1] ^= 1
+    assert cache.key(changed, **PARAMS) != key
+    assert cache.key(image.astype(np.uint16), **PARAMS) != key
+    assert cache.key(image.reshape(300, 600), **PARAMS) != key
+
+
+def test_write_and_read(cache, image):
+    key = cache.key(image, **PARAMS)
+    assert cache.get(key) is None
+
+    batches = [np.full((4, 8, 8), i, dtype=np.uint8) for i in range(12)]
+    writer = cache.writer(key, n_tiles=48)
+    for Y in batches:
+        writer.write(Y)
+    assert cache.get(key) is None
+    writer.commit()
+
+    reader = cache.get(key)
+    assert reader.meta == {'n_tiles': 48}
+    read = list(reader.batches())
+    assert len(read) == len(batches)
+    for Y, Y_ in zip(batches, read):
+        np.testing.assert_array_equal(Y, Y_)
+
+
+def test_discarded_writes_leave_nothing(cache):
+    with pytest.raises(RuntimeError):
+        with cache.writer('abc') as writer:
+            writer.write(np.zeros((1, 8, 8), dtype=np.uint8))
+            raise RuntimeError()
+    assert cache.get('abc') is None
+    assert os.listdir(cache.path) == []
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = displot.cache.PredictionCache(str(tmp_path), max_bytes=None)
+    Y = np.random.RandomState(0).randint(0, 256, (4, 64, 64)).astype(
+        np.uint8)
+    for i, key in enumerate('abc'):
+        with cache.writer(key) as writer:
+            writer.write(Y)
+            writer.commit()
+        t = 1000000 + i
+        os.utime(cache._path(key), (t, t))
+
+    cache.max_bytes = cache.size - 1
+    cache.evict()
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
+    assert cache.get('c') is not None
+
+    cache.clear()
+    assert cache.size == 0
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Tests of discrimination and the spatial index it uses.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import numpy as np
+import pytest
+
+import displot.detection as detection
+from displot.io import DisplotDataFeature, FeatureTable
+
+
+def baseline_discrimination(image, tds, td_border=3, td_overlap=2,
+    pred_tolerance=0.33, detect_samples=1
+):
+    """List based discrimination, as it was before FeatureTable."""
+    tds_pruned = []
+    for td in tds:
+        if (td.x <= td_border or td.x >= (image.shape[1] - td_border)
+        or td.y < td_border or td.y >= (image.shape[0] - td_border)):
+            continue
+        if td.confidence < 0.01:
+            continue
+        tds_pruned.append(td)
+
+    tds_final = []
+    tds_visited = []
+    pred_avg = []
+    for i, td in enumerate(tds_pruned):
+        if i in tds_visited:
+            continue
+
+        overlap_list = [td]
+        for j, td_ in enumerate(tds_pruned):
+            d = np.hypot(td.x - td_.x, td.y - td_.y)
+            if d >= (td.r + td_.r - td_overlap):
+                continue
+            overlap_list.append(td_)
+            tds_visited.append(j)
+
+        overlap_list = sorted(
+            overlap_list, key=lambda x: x.confidence, reverse=True)
+        overlap_list = overlap_list[:detect_samples]
+        pred_list = [x.confidence for x in overlap_list]
+        pred_list += [0] * (detect_samples - len(overlap_list))
+        pred = np.average(pred_list)
+        if pred < pred_tolerance:
+            continue
+
+        overlap_list[0].confidence = pred
+        tds_final.append(overlap_list[0])
+        pred_avg.append(pred)
+
+    return tds_final, np.average(pred_avg)
+
+
+def random_blobs(rng, n, shape):
+    return np.column_stack((
+        rng.uniform(0, shape[1], n), rng.uniform(0, shape[0], n),
+        rng.uniform(3, 12, n), rng.uniform(0, 1, n)))
+
+
+def to_features(blobs):
+    ret = []
+    for x, y, r, conf in blobs:
+        f = DisplotDataFeature(int(x), int(y))
+        f.r = float(r)
+        f.confidence = float(conf)
+        ret.append(f)
+    return ret
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('detect_samples', [1, 4])
+def test_discrimination_matches_baseline(seed, detect_samples):
+    rng = np.random.RandomState(seed)
+    image = np.zeros((400, 500), dtype=np.uint8)
+    blobs = random_blobs(rng, 800, image.shape)
+
+    expected, expected_avg = baseline_discrimination(
+        image, to_features(blobs), detect_samples=detect_samples)
+    tds, avg = detection.discrimination(
+        image, detection._features(blobs), 3, 2, .33, detect_samples)
+
+    assert isinstance(tds, FeatureTable)
+    assert [(f.x, f.y, f.r, f.confidence) for f in expected] == list(zip(
+        tds.x.tolist(), tds.y.tolist(), tds.r.tolist(),
+        tds.confidence.tolist()))
+    assert avg == expected_avg
+
+
+@pytest.mark.parametrize('cell', [0.5, 7, 40])
+def test_spatial_grid_finds_all_close_points(cell):
+    rng = np.random.RandomState(1)
+    x = rng.uniform(-50, 250, 500)
+    y = rng.uniform(-50, 250, 500)
+    grid = detection._SpatialGrid(x, y, cell)
+
+    for qx, qy in rng.uniform(-60, 260, (100, 2)):
+        found = grid.neighbours(qx, qy)
+        assert np.all(np.diff(found) > 0)
+        close = np.nonzero(np.hypot(x - qx, y - qy) < cell)[0]
+        assert set(close.tolist()) <= set(found.tolist())
+
+
+def test_spatial_grid_empty():
+    empty = detection._SpatialGrid(np.zeros(0), np.zeros(0), 10)
+    assert len(empty.neighbours(0, 0)) == 0
+    no_reach = detection._SpatialGrid(np.arange(5.), np.arange(5.), 0)
+    assert len(no_reach.neighbours(2, 2)) == 0
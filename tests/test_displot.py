@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Tests of the program functionality class.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import numpy as np
+import pytest
+import tifffile
+
+import displot
+import displot.io
+import displot.detection
+from displot.io import FeatureTable
+
+
+WEIGHTS = ('fusionnet', 'a')
+SETTINGS = dict(model='fusionnet', stride=(128, 128), tiling='context',
+    backend='keras', blob_mode='mosaic')
+
+
+@pytest.fixture
+def dp(monkeypatch):
+    # Constructing Displot would check for GPU support using Tensorflow.
+    monkeypatch.setattr(displot, 'detect_gpu_support', lambda: None)
+    return displot.Displot()
+
+
+@pytest.fixture
+def dpa_path(tmp_path, dp):
+    """Data file with a prediction map made in 'mosaic' blob mode."""
+    image_path = str(tmp_path / 'image.tif')
+    image = np.random.RandomState(0).randint(0, 256, (120, 90))
+    tifffile.imwrite(image_path, image.astype(np.uint8))
+
+    dp.load_data(image_path)
+    dp.data_obj.prediction = np.zeros((120, 90), dtype=np.uint8)
+    dp.data_obj.prediction_meta = dp._prediction_meta(WEIGHTS, **SETTINGS)
+    path = str(tmp_path / 'data.dpa')
+    dp.save_data(path)
+    return path
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+
+    def detection(image, weights, threshold=.1, **kwargs):
+        calls.append(('detection', threshold))
+        return FeatureTable(0), 0., None
+
+    # Arguments redetection() does not take would raise a TypeError.
+    def redetection(image, prediction, threshold=.1, profiler=None):
+        calls.append(('redetection', threshold))
+        return FeatureTable(0), 0.
+
+    monkeypatch.setattr(displot.detection, 'detection', detection)
+    monkeypatch.setattr(displot.detection, 'redetection', redetection)
+    return calls
+
+
+def test_scan_reuses_stored_prediction(dp, dpa_path, calls):
+    dp.load_data(dpa_path)
+    dp.scan(dp.data_obj.image, WEIGHTS, threshold=.2, cache=None,
+        keep_prediction=False, **SETTINGS)
+
+    assert calls == [('redetection', .2)]
+    assert dp.data_obj.prediction is not None
+
+
+@pytest.mark.parametrize('name, value', [
+    ('stride', (256, 256)), ('tiling', 'reflect'), ('backend', 'int8'),
+    ('blob_mode', 'tile'),
+])
+def test_scan_predicts_with_other_settings(dp, dpa_path, calls, name, value):
+    dp.load_data(dpa_path)
+    settings = dict(SETTINGS, **{name: value})
+    dp.scan(dp.data_obj.image, WEIGHTS, **settings)
+    assert [c[0] for c in calls] == ['detection']
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""Tests of displot data files.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import io
+import os
+import json
+import time
+import tarfile
+
+import numpy as np
+import pytest
+import tifffile
+
+import displot.io
+from displot.io import FeatureTable
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = str(tmp_path / 'image.tif')
+    image = np.random.RandomState(0).randint(0, 256, (120, 90))
+    tifffile.imwrite(path, image.astype(np.uint8))
+    return path
+
+
+def sample_markers(n=50, seed=0):
+    rng = np.random.RandomState(seed)
+    table = FeatureTable(n,
+        x=rng.randint(0, 90, n), y=rng.randint(0, 120, n),
+        r=rng.uniform(5, 14, n), confidence=rng.uniform(0, 1, n),
+        isHidden=rng.uniform(0, 1, n) < .2)
+    table.addColumn('frame', np.int32, 0)
+    table.frame[:] = rng.randint(0, 3, n)
+    return table
+
+
+def assert_tables_equal(a, b):
+    assert list(a.columns) == list(b.columns)
+    for k in a.columns:
+        assert a[k].dtype == b[k].dtype
+        np.testing.assert_array_equal(a[k], b[k])
+
+
+def write_v1(path, image_path, markers):
+    """Write an archive the way displot did before format version 2."""
+    obj = {
+        'image_path': image_path,
+        'image_meta': None,
+        'editor_data': {},
+        'markers': markers
+    }
+    objjson = bytes(json.dumps(obj), 'ascii')
+    info = tarfile.TarInfo(name='dp.json')
+    info.size = len(objjson)
+    info.mtime = int(time.time())
+    with tarfile.open(path, 'w') as a:
+        a.add(image_path, os.path.basename(image_path))
+        a.addfile(tarinfo=info, fileobj=io.BytesIO(objjson))
+
+
+def test_load_v1(tmp_path, image_path):
+    rows = [
+        {'x': 10, 'y': 20, 'r': 7.5, 'confidence': .5, 'isHidden': False},
+        {'x': 30, 'y': 40, 'r': 10, 'confidence': 1, 'isHidden': True},
+    ]
+    path = str(tmp_path / 'v1.dpa')
+    write_v1(path, image_path, rows)
+
+    obj = displot.io.load_displot_data(path)
+    np.testing.assert_array_equal(obj.image, tifffile.imread(image_path))
+    assert obj.markers.toDicts() == rows
+    assert obj.prediction is None
+
+
+def test_v1_resaved_as_v2(tmp_path, image_path):
+    rows = [{'x': 1, 'y': 2, 'r': 3, 'confidence': .25, 'isHidden': False}]
+    path = str(tmp_path / 'v1.dpa')
+    write_v1(path, image_path, rows)
+
+    displot.io.save_displot_data(path, displot.io.load_displot_data(path))
+    obj = displot.io.load_displot_data(path)
+    assert obj.markers.toDicts() == rows
+    with tarfile.open(path) as a:
+        objjson = json.loads(a.extractfile('dp.json').read().decode())
+    assert objjson['version'] == 2
+
+
+@pytest.mark.parametrize('image, compress', [
+    ('embed', False), ('embed', True), ('reference', False),
+])
+def test_round_trip(tmp_path, image_path, image, compress):
+    obj = displot.io.load_displot_data(image_path)
+    obj.markers = sample_markers()
+    obj.prediction = np.random.RandomState(1).randint(
+        0, 256, obj.image.shape).astype(np.uint8)
+    obj.prediction_meta = {'blob_mode': 'mosaic', 'stride': [256, 256]}
+    obj.editor_data = {'note': 'test'}
+
+    path = str(tmp_path / 'data.dpa')
+    displot.io.save_displot_data(path, obj, image=image, compress=compress)
+    loaded = displot.io.load_displot_data(path)
+
+    np.testing.assert_array_equal(loaded.image, obj.image)
+    np.testing.assert_array_equal(loaded.prediction, obj.prediction)
+    assert loaded.prediction_meta == obj.prediction_meta
+    assert loaded.editor_data == obj.editor_data
+    assert_tables_equal(loaded.markers, obj.markers)
+    assert (loaded.image_ref is None) == (image == 'embed')
+
+
+def test_save_over_loaded_archive(tmp_path, image_path):
+    path = str(tmp_path / 'data.dpa')
+    obj = displot.io.load_displot_data(image_path)
+    obj.markers = sample_markers()
+    displot.io.save_displot_data(path, obj)
+
+    # The image and markers are mapped from the file being replaced.
+    loaded = displot.io.load_displot_data(path)
+    loaded.markers.x[0] += 1
+    expected = loaded.markers.copy()
+    displot.io.save_displot_data(path, loaded, prediction=False)
+
+    again = displot.io.load_displot_data(path)
+    assert_tables_equal(again.markers, expected)
+    np.testing.assert_array_equal(again.image, obj.image)
+    assert again.prediction is None
+
+
+def test_moved_reference(tmp_path, image_path):
+    obj = displot.io.load_displot_data(image_path)
+    obj.markers = sample_markers(5)
+    path = str(tmp_path / 'data.dpa')
+    displot.io.save_displot_data(path, obj, image='reference')
+
+    moved = tmp_path / 'moved'
+    moved.mkdir()
+    os.replace(path, str(moved / 'data.dpa'))
+    os.replace(image_path, str(moved / 'image.tif'))
+    loaded = displot.io.load_displot_data(str(moved / 'data.dpa'))
+    np.testing.assert_array_equal(loaded.image, obj.image)
+
+    tifffile.imwrite(str(moved / 'image.tif'), np.zeros((2, 2), np.uint8))
+    with pytest.raises(ValueError):
+        displot.io.load_displot_data(str(moved / 'data.dpa'))
+
+
+def test_reference_hashes_whole_file(tmp_path):
+    # Large enough for a sampled hash to miss changes.
+    image_path = str(tmp_path / 'large.tif')
+    tifffile.imwrite(image_path, np.zeros((2000, 2000), np.uint8))
+    obj = displot.io.load_displot_data(image_path)
+    path = str(tmp_path / 'data.dpa')
+    displot.io.save_displot_data(path, obj, image='reference')
+    assert obj.image_ref['algorithm'] == 'sha256'
+
+    with open(image_path, 'r+b') as f:
+        f.seek(os.path.getsize(image_path) // 2)
+        f.write(b'\x01')
+    with pytest.raises(ValueError):
+        displot.io.load_displot_data(path)
+
+
+def test_reference_skips_changed_candidates(tmp_path, image_path):
+    obj = displot.io.load_displot_data(image_path)
+    moved = tmp_path / 'moved'
+    moved.mkdir()
+    path = str(moved / 'data.dpa')
+    displot.io.save_displot_data(path, obj, image='reference')
+
+    # The original path now holds another image, the one saved was moved
+    # next to the data file.
+    os.replace(image_path, str(moved / 'image.tif'))
+    tifffile.imwrite(image_path, np.zeros((2, 2), np.uint8))
+    loaded = displot.io.load_displot_data(path)
+    np.testing.assert_array_equal(loaded.image, obj.image)
+    assert loaded.image_path == str(moved / 'image.tif')
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Tests of feature export.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import csv
+
+import numpy as np
+import pytest
+
+import displot.io
+from displot.io import FeatureTable
+
+
+def sample_markers(n=50, seed=0):
+    rng = np.random.RandomState(seed)
+    table = FeatureTable(n,
+        x=rng.randint(0, 90, n), y=rng.randint(0, 120, n),
+        r=rng.uniform(5, 14, n), confidence=rng.uniform(0, 1, n),
+        isHidden=rng.uniform(0, 1, n) < .2)
+    table.addColumn('frame', np.int32, 0)
+    table.frame[:] = rng.randint(0, 3, n)
+    return table
+
+
+METADATA = {'image': 'a, "b".tif', 'image_width': 90, 'image_height': 120}
+
+
+def test_export_csv(tmp_path):
+    table = sample_markers()
+    path = str(tmp_path / 'features.csv')
+    displot.io.export_features(path, table, METADATA, chunk=7)
+
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert list(rows[0]) == list(table.columns) + list(METADATA)
+    assert len(rows) == len(table)
+    for row, expected in zip(rows, table.toDicts()):
+        assert int(row['x']) == expected['x']
+        assert float(row['r']) == expected['r']
+        assert float(row['confidence']) == expected['confidence']
+        assert row['isHidden'] == str(expected['isHidden'])
+        assert int(row['frame']) == expected['frame']
+        assert row['image'] == METADATA['image']
+        assert int(row['image_width']) == METADATA['image_width']
+
+
+def test_export_csv_empty(tmp_path):
+    path = str(tmp_path / 'features.csv')
+    displot.io.export_features(path, FeatureTable(0))
+    with open(path, newline='') as f:
+        assert f.read() == ','.join(displot.io.COLUMNS) + '\r\n'
+
+
+def test_export_npy(tmp_path):
+    table = sample_markers()
+    path = str(tmp_path / 'features.npy')
+    displot.io.export_features(path, table, METADATA, chunk=7)
+
+    rec = np.load(path)
+    assert rec.dtype.names == tuple(table.columns) + tuple(METADATA)
+    for k in table.columns:
+        np.testing.assert_array_equal(rec[k], table[k])
+    assert set(rec['image'].tolist()) == {METADATA['image']}
+
+
+def test_export_npz(tmp_path):
+    table = sample_markers()
+    path = str(tmp_path / 'features.npz')
+    displot.io.export_features(path, table, METADATA, chunk=7)
+
+    with np.load(path) as npz:
+        assert sorted(npz.files) == sorted(
+            list(table.columns) + list(METADATA))
+        for k in table.columns:
+            np.testing.assert_array_equal(npz[k], table[k])
+        assert npz['image_height'].tolist() == [120] * len(table)
+
+
+def test_export_hdf5(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    table = sample_markers()
+    path = str(tmp_path / 'features.h5')
+    displot.io.export_features(path, table, METADATA, chunk=7)
+
+    with h5py.File(path, 'r') as f:
+        for k in table.columns:
+            np.testing.assert_array_equal(f[k][()], table[k])
+        assert f['image'][0].decode() == METADATA['image']
+
+
+def test_export_errors(tmp_path):
+    table = sample_markers(3)
+    with pytest.raises(ValueError):
+        displot.io.export_features(str(tmp_path / 'f.txt'), table)
+    with pytest.raises(ValueError):
+        displot.io.export_features(
+            str(tmp_path / 'f.csv'), table, {'frame': 1})
+    with pytest.raises(ValueError):
+        displot.io.export_features(
+            str(tmp_path / 'f.csv'), table, {'image': [1, 2]})
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Tests of the columnar feature container.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import numpy as np
+import pytest
+
+import displot.io
+import displot.detection as detection
+from displot.io import DisplotDataFeature, FeatureTable, FeatureView
+
+
+def sample_table():
+    return FeatureTable(
+        x=[1, 2, 3], y=[4, 5, 6], r=[7., 8., 9.],
+        confidence=[.1, .5, .9], isHidden=[False, True, False])
+
+
+def test_default_columns():
+    table = FeatureTable(2, x=[1, 2])
+    assert list(table.columns) == list(displot.io.COLUMNS)
+    for name, (dtype, default) in displot.io.COLUMNS.items():
+        assert table[name].dtype == dtype
+    assert table.y.tolist() == [0, 0]
+    assert table.r.tolist() == [10, 10]
+    assert table.isHidden.tolist() == [False, False]
+    assert len(FeatureTable()) == 0
+
+
+def test_column_shape_is_checked():
+    with pytest.raises(ValueError):
+        FeatureTable(3, x=[1, 2])
+    table = sample_table()
+    with pytest.raises(ValueError):
+        table.r = [1, 2]
+    with pytest.raises(TypeError):
+        table[0:2] = [1, 2]
+
+
+def test_assigned_columns_keep_their_type():
+    table = sample_table()
+    table.x = [1.7, 2.2, 3.9]
+    assert table.x.dtype == np.int32
+    assert table.x.tolist() == [1, 2, 3]
+    table['extra'] = np.arange(3, dtype=np.uint8)
+    assert table.extra.dtype == np.uint8
+
+
+def test_add_column():
+    table = sample_table()
+    table.addColumn('frame', np.int32, 2)
+    assert list(table.columns)[-1] == 'frame'
+    assert table.frame.tolist() == [2, 2, 2]
+    with pytest.raises(ValueError):
+        table.addColumn('frame', np.int32)
+
+
+def test_indexing():
+    table = sample_table()
+    assert isinstance(table[1], FeatureView)
+    assert table[-1].x == 3
+    with pytest.raises(IndexError):
+        table[3]
+
+    sub = table[table.confidence > .2]
+    assert isinstance(sub, FeatureTable)
+    assert sub.x.tolist() == [2, 3]
+    assert table[np.array([2, 0])].y.tolist() == [6, 4]
+    assert table[1:].r.tolist() == [8., 9.]
+
+
+def test_views_read_and_write_the_table():
+    table = sample_table()
+    view = table[1]
+    assert view.toDict() == table.toDicts()[1]
+    assert isinstance(view.x, int)
+
+    view.isHidden = False
+    view.confidence = .25
+    assert table.isHidden.tolist() == [False, False, False]
+    assert table.confidence[1] == .25
+    with pytest.raises(AttributeError):
+        view.colour = 'red'
+    with pytest.raises(AttributeError):
+        view.colour
+
+    assert [f.x for f in table] == [1, 2, 3]
+
+
+def test_views_compare_to_feature_objects():
+    table = sample_table()
+    f = DisplotDataFeature(2, 5)
+    f.r = 8.
+    assert table[1] == f
+    assert f == table[1]
+    assert table[0] != f
+    assert table[1] != 'feature'
+
+
+def test_copy_is_independent():
+    table = sample_table()
+    copy = table.copy()
+    copy.x[0] = 100
+    assert table.x[0] == 1
+
+
+def test_dicts_round_trip():
+    rows = [
+        {'x': 1, 'y': 2, 'r': 3., 'confidence': .5, 'isHidden': True},
+        {'x': 4, 'y': 5, 'frame': 2},
+    ]
+    table = FeatureTable.fromDicts(rows)
+    assert table.frame.tolist() == [0, 2]
+    assert table.toDicts()[1] == {'x': 4, 'y': 5, 'r': 10., 'confidence': 1.,
+        'isHidden': False, 'frame': 2}
+
+
+def test_concatenate_fills_missing_columns():
+    a = sample_table()
+    b = FeatureTable(2, x=[10, 11])
+    b.addColumn('frame', np.int32, 1)
+    table = FeatureTable.concatenate([a, b])
+
+    assert len(table) == 5
+    assert table.x.tolist() == [1, 2, 3, 10, 11]
+    assert table.r.tolist() == [7., 8., 9., 10., 10.]
+    assert table.frame.tolist() == [0, 0, 0, 1, 1]
+    assert table.frame.dtype == np.int32
+    assert len(FeatureTable.concatenate([])) == 0
+
+
+def test_markers_from_feature_objects():
+    features = [DisplotDataFeature(1, 2), DisplotDataFeature(3, 4)]
+    features[1].frame = 5
+    table = FeatureTable.fromFeatures(features, {'frame': np.int32})
+    assert table.x.tolist() == [1, 3]
+    assert table.frame.tolist() == [0, 5]
+    assert table.frame.dtype == np.int32
+
+    data = displot.io.DisplotData()
+    data.markers = features
+    assert isinstance(data.markers, FeatureTable)
+    assert data.markers.y.tolist() == [2, 4]
+
+
+def test_discrimination_accepts_feature_lists():
+    rng = np.random.RandomState(7)
+    image = np.zeros((300, 300), dtype=np.uint8)
+    blobs = np.column_stack((
+        rng.uniform(0, 300, 200), rng.uniform(0, 300, 200),
+        rng.uniform(3, 12, 200), rng.uniform(0, 1, 200)))
+    features = []
+    for x, y, r, conf in blobs:
+        f = DisplotDataFeature(int(x), int(y))
+        f.r = float(r)
+        f.confidence = float(conf)
+        features.append(f)
+
+    from_list = detection.discrimination(image, features)[0]
+    from_table = detection.discrimination(
+        image, detection._features(blobs))[0]
+    assert from_list.columns.keys() == from_table.columns.keys()
+    for k in from_table.columns:
+        np.testing.assert_array_equal(from_list[k], from_table[k])
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""Tests of lazy imports at startup.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import os
+import sys
+import subprocess
+
+import pytest
+
+import displot.detection as detection
+
+
+def test_cli_import_is_light():
+    code = ('import sys, displot.cli; print(sorted(m for m in '
+        '("tensorflow", "skimage", "scipy") if m in sys.modules))')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, '-c', code], cwd=root,
+        check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    assert out.strip() == '[]'
+
+
+def test_blob_backend_names():
+    blobs = pytest.importorskip('displot.blobs')
+    assert tuple(sorted(blobs.BACKENDS)) == detection.BLOB_BACKENDS
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""Tests of the Tensorflow Lite backend that do not need Tensorflow.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+import displot.tflite
+import displot.weights
+import displot.detection as detection
+
+
+def test_unconverted_model_is_refused():
+    with pytest.raises(ValueError, match='python -m displot convert'):
+        displot.tflite.require('fusionnet', 'missing', 'int8')
+    with pytest.raises(ValueError, match='Unknown quantization'):
+        displot.tflite.require('fusionnet', 'missing', 'bfloat16')
+
+
+def test_detection_does_not_convert(monkeypatch):
+    def convert(*args, **kwargs):
+        raise AssertionError('Weights converted during detection.')
+    monkeypatch.setattr(displot.tflite, 'convert', convert)
+
+    image = np.zeros((300, 300), dtype=np.uint8)
+    with pytest.raises(ValueError, match='python -m displot convert'):
+        detection.detection(image, ('fusionnet', 'missing'),
+            backend='float16')
+
+
+def test_models_are_kept_in_user_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(displot.weights, 'PATH_CACHE',
+        str(tmp_path / 'cache' / 'models'))
+    p = displot.tflite.path('fusionnet', 'a', 'int8')
+    assert p == str(tmp_path / 'cache' / 'models' / 'fusionnet_a.int8.tflite')
+
+    # A cache that cannot be created falls back to the temporary directory.
+    (tmp_path / 'cache').write_bytes(b'')
+    p = displot.tflite.path('fusionnet', 'a', 'int8')
+    assert p.startswith(tempfile.gettempdir())
+    assert not p.startswith(str(tmp_path))
+    assert p.endswith(os.path.join('models', 'fusionnet_a.int8.tflite'))
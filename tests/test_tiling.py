@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Tests of tile generation and stitching.
+
+Author: Bohdan Starosta
+University of Strathclyde Physics Department
+"""
+
+import numpy as np
+import pytest
+
+import displot.detection as detection
+
+
+def padded_tiles(image, stride, hw, padding, mode='constant', margin=0):
+    """Tiles cut from an explicitly padded copy of the image."""
+    l_pad, t_pad, r_pad, b_pad = padding
+    padded = np.pad(image, (
+        (t_pad + margin, b_pad + margin + hw[0]),
+        (l_pad + margin, r_pad + margin + hw[1])
+    ), mode)
+    h = t_pad + image.shape[0] + b_pad
+    w = l_pad + image.shape[1] + r_pad
+    return [
+        (r // stride[0], c // stride[1],
+            padded[r:r + hw[0] + 2 * margin, c:c + hw[1] + 2 * margin])
+        for r in range(0, h - stride[0], stride[0])
+        for c in range(0, w - stride[1], stride[1])
+    ]
+
+
+SHAPES = [(100, 130), (64, 64), (257, 300)]
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('stride', [(32, 32), (16, 48)])
+def test_tiles_match_padded_image(shape, stride):
+    hw = (64, 64)
+    image = np.random.RandomState(0).randint(1, 256, shape).astype(np.uint8)
+    padding = detection._padding(shape, stride, hw)
+
+    tiles = list(detection._tiles(image, stride, hw, padding))
+    expected = padded_tiles(image, stride, hw, padding)
+    assert len(tiles) == len(expected)
+    for (r, c, tile), (r_, c_, tile_) in zip(tiles, expected):
+        assert (r, c) == (r_, c_)
+        np.testing.assert_array_equal(tile, tile_)
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_stitch_and_fuse_average_overlapping_tiles(shape):
+    hw, stride = (64, 64), (32, 32)
+    rng = np.random.RandomState(2)
+    padding = detection._padding(shape, stride, hw)
+    windows = list(detection._tiles(np.zeros(shape), stride, hw, padding))
+    Y = rng.randint(0, 256, (len(windows),) + hw).astype(np.uint8)
+    offsets = [(c * stride[1] - padding[0], r * stride[0] - padding[1])
+        for r, c, _ in windows]
+
+    # Stitched in two batches, like streaming detection does.
+    mosaic_sum = np.zeros(shape, dtype=np.uint16)
+    mosaic_n = np.zeros(shape, dtype=np.uint8)
+    half = len(Y) // 2
+    detection._stitch(mosaic_sum, mosaic_n, Y[:half], offsets[:half])
+    detection._stitch(mosaic_sum, mosaic_n, Y[half:], offsets[half:])
+    mosaic = detection._fuse(mosaic_sum, mosaic_n)
+
+    # Reference sums on a canvas large enough for every tile.
+    canvas = (shape[0] + 2 * padding[3] + hw[0],
+        shape[1] + 2 * padding[2] + hw[1])
+    total = np.zeros(canvas)
+    count = np.zeros(canvas)
+    for Y_, (x, y) in zip(Y, offsets):
+        y += padding[1]
+        x += padding[0]
+        total[y:y + hw[0], x:x + hw[1]] += Y_
+        count[y:y + hw[0], x:x + hw[1]] += 1
+    inside = (slice(padding[1], padding[1] + shape[0]),
+        slice(padding[0], padding[0] + shape[1]))
+    total = total[inside]
+    count = count[inside]
+
+    assert count.min() > 0
+    np.testing.assert_array_equal(mosaic_n, count)
+    np.testing.assert_array_equal(
+        mosaic, np.floor(total / count + 0.5).astype(np.uint8))
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_context_tiles_match_reflect_padded_image(shape):
+    hw, stride, margin = (64, 64), (32, 32), 8
+    image = np.random.RandomState(0).randint(1, 256, shape).astype(np.uint8)
+    padding = detection._padding(shape, stride, hw)
+
+    tiles = detection._context_tiles(image, stride, hw, padding, margin)
+    plain = list(detection._tiles(image, stride, hw, padding))
+    assert [t[:2] for t in tiles] == [t[:2] for t in plain]
+
+    # Tiles are views into one reflect padded copy.
+    l_pad, t_pad = padding[0], padding[1]
+    for r, c, tile in tiles:
+        assert tile.shape == (hw[0] + 2 * margin, hw[1] + 2 * margin)
+        assert not tile.flags.writeable
+        y = r * stride[0] - t_pad
+        x = c * stride[1] - l_pad
+        inside = tile[margin:margin + hw[0], margin:margin + hw[1]]
+        y1, x1 = max(y, 0), max(x, 0)
+        y2 = min(y + hw[0], shape[0])
+        x2 = min(x + hw[1], shape[1])
+        np.testing.assert_array_equal(
+            inside[y1 - y:y2 - y, x1 - x:x2 - x], image[y1:y2, x1:x2])